@@ -7,6 +7,15 @@ import shutil
 import sciris as sc
 import covasim as cv
 import numpy as np
+import sinks
+import sweeps as sw
+import datacache as dc
+import archive as ar
+import screening as sr
+import designs as ds
+import refinement as rf
+import ensembles as ens
+import crn
 
 ########################################################################
 # Settings and initialisation
@@ -24,6 +33,8 @@ save_sim = 1
 do_show = 0
 verbose = 1
 seed    = 1
+use_crn = 0 # Whether the current and optimal scenarios share common random numbers, so their differences are less noisy
+use_screening = 0 # Whether the full fit stops runs once they can no longer be among the best-fitting ones
 to_plot = sc.objdict({
     'Cumulative diagnoses': ['cum_diagnoses'],
     'Cumulative infections': ['cum_infections'],
@@ -37,6 +48,7 @@ runoptions = ['quickfit', # Does a quick preliminary calibration. Quick to run,
               'finalisefit', # Processes the results of the previous step to produce a calibration with the best seeds
               'scens', # Takes the best-fitting runs and projects these forward under different mask and TTI assumptions
               'tti_sweeps', # Sweeps over future testing/tracing values to create data for heatmaps
+              'tti_adaptive', # As tti_sweeps, but starts with a coarse grid and only refines it where the outcomes change or cross epidemic control
               'mean_calcs',
               'test_msim'
               ]
@@ -46,6 +58,7 @@ whattorun = runoptions[-2] #Select which of the above to run
 data_path = 'UK_Covid_cases_august28.xlsx'
 resfolder = 'results'
 cachefolder = 'cache'
+sinkfolder = f'{resfolder}/tti_sweeps_sink' # Where the per-sim summaries of the TTI sweeps are written, if used
 
 # Important dates
 start_day = '2020-01-21'
@@ -92,7 +105,7 @@ def make_sim(seed=None, calibration=True, scenario=None, future_symp_test=None,
         #rel_crit_prob = 2.3,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     sim['prognoses']['sus_ORs'][0] = 1.0 # ages 20-30
     sim['prognoses']['sus_ORs'][1] = 1.0 # ages 20-30
 
@@ -200,7 +213,7 @@ def make_sim(seed=None, calibration=True, scenario=None, future_symp_test=None,
         intervention.do_plot = False
 
     # Store metadata
-#    sim.meta = meta
+    sim.meta = meta
 
     return sim
 
@@ -252,8 +265,19 @@ def save_cached_sim(sim, cachefile, statusfile, do_save):
     return
 
 
-def run_sim(sim, do_load=True, do_save=True, do_shrink=True):
-    ''' Run a simulation, loading from cache if possible '''
+def summarise(sim):
+    ''' Reduce a finished sim to the values used for the TTI heatmaps '''
+    data_end_day = sim.day(data_end)
+    summary = dict(
+        cum_inf        = sim.results['cum_infections'].values[-1]-sim.results['cum_infections'].values[data_end_day],
+        cum_death      = sim.results['cum_deaths'].values[-1]-sim.results['cum_deaths'].values[data_end_day],
+        new_infections = sim.results['new_infections'].values[data_end_day:], # Kept whole, since the peak is taken after averaging over seeds
+    )
+    return summary
+
+
+def run_sim(sim, do_load=True, do_save=True, do_shrink=True, use_sink=False):
+    ''' Run a simulation, loading from cache if possible; if use_sink, write its summary to the sink and return only its indices '''
 
     # Caching -- WARNING, needs testing!
     seed = sim.meta.vals.seed
@@ -269,12 +293,39 @@ def run_sim(sim, do_load=True, do_save=True, do_shrink=True):
     # Actually run the (rest of the) sim
     sim.run()
 
+    if use_sink:
+        sink = sinks.result_sink(sinkfolder, index_names=['scenario', 'symp_test', 'trace_eff', 'seed'])
+        sink.write(sim.meta.inds, **summarise(sim))
+        return sim.meta.inds
+
     if do_shrink:
         sim.shrink()
 
     return sim
 
 
+def save_sink_summaries(scenarios, sy_npts, tr_npts, fill=False):
+    '''
+    Average the TTI sweep summaries in the sink over seeds, and save them in the same
+    format as the sweep_summary from the MultiSims. Note, this always uses the mean;
+    grid points with no finished sims yet are NaN, unless fill is True, in which case
+    they are interpolated (e.g. for the cells that a design does not run).
+    '''
+    sink = sinks.result_sink(sinkfolder, index_names=['scenario', 'symp_test', 'trace_eff', 'seed'])
+    means = sink.group_mean(by=['scenario', 'symp_test', 'trace_eff'])
+    shape = (len(scenarios), sy_npts, tr_npts)
+    grids = {key:np.full(shape, np.nan) for key in ['cum_inf', 'peak_inf', 'cum_death']}
+    if len(means.scenario):
+        inds = (means.scenario, means.symp_test, means.trace_eff)
+        grids['cum_inf'][inds]   = means.cum_inf
+        grids['peak_inf'][inds]  = means.new_infections.max(axis=1)
+        grids['cum_death'][inds] = means.cum_death
+    for i_sc,scenname in enumerate(scenarios):
+        sweep_summary = {key:(ds.fill_grid(grid[i_sc]) if fill else grid[i_sc]).tolist() for key,grid in grids.items()}
+        cv.save(f'{resfolder}/uk_tti_sweeps_{scenname}.obj', sweep_summary)
+    return
+
+
 def make_msims(sims):
     ''' Take a slice of sims and turn it into a multisim '''
     msim = cv.MultiSim(sims)
@@ -291,14 +342,55 @@ def make_msims(sims):
     msim.meta.vals.pop('seed')
     print(f'Processing multisim {msim.meta.vals.values()}...')
 
-    if save_sim: # NB, generates ~2 GB of files for a full run
+    if save_sim: # Only the results are archived, rather than pickling the whole multisim (~2 GB of files for a full run)
         id_str = '_'.join([str(i) for i in msim.meta.inds])
-        msimfile = f'{cachefolder}/final_msim{id_str}.msim' # File to save the partially run sim to
-        msim.save(msimfile)
+        msimfile = f'{cachefolder}/final_msim{id_str}.cvar' # File to save the results to
+        ar.save_archive(msimfile, msim, meta=msim.meta)
 
     return msim
 
 
+def daily_test_prob(future_symp_test):
+    ''' Convert the probability of a symptomatic person testing into a daily probability (over ~10 days of symptoms) '''
+    return np.round(1 - (1 - future_symp_test) ** (1 / 10), 3) if future_symp_test<1 else 0.4
+
+
+def run_cells(i_sc, scenname, cells, seeds, symp_test_vals, trace_eff_vals):
+    '''
+    Run the TTI sweep for one scenario at some cells of the grid, and return the values
+    for the sweep_summary at each, plus the mean R_eff after the end of the data (which
+    is below 1 where the epidemic is under control)
+    '''
+    ikw = []
+    for i_fst,i_fte in cells:
+        for i_s,seed in enumerate(seeds):
+            meta = sc.objdict()
+            meta.count = len(ikw) + 1
+            meta.n_sims = len(cells)*len(seeds)
+            meta.inds = [i_sc, i_fst, i_fte, i_s]
+            meta.vals = sc.objdict(scenario=scenname, future_symp_test=daily_test_prob(symp_test_vals[i_fst]), future_t_eff=trace_eff_vals[i_fte], seed=seed)
+            ikw.append(sc.dcp(meta.vals))
+            ikw[-1].meta = meta
+
+    sim_configs = sc.parallelize(make_sim, iterkwargs=ikw, kwargs=dict(calibration=False, end_day='2020-10-23'))
+    all_sims = sc.parallelize(run_sim, iterarg=sim_configs, kwargs=dict(do_load=False, do_save=False))
+    groups = {}
+    for sim in all_sims:
+        groups.setdefault(tuple(sim.meta.inds[1:3]), []).append(sim)
+    all_msims = sc.parallelize(make_msims, iterarg=[groups[cell] for cell in cells])
+
+    values = {}
+    for cell,msim in zip(cells, all_msims):
+        data_end_day = msim.sims[0].day(data_end)
+        values[cell] = dict(
+            cum_inf   = msim.results['cum_infections'].values[-1]-msim.results['cum_infections'].values[data_end_day],
+            peak_inf  = max(msim.results['new_infections'].values[data_end_day:]),
+            cum_death = msim.results['cum_deaths'].values[-1]-msim.results['cum_deaths'].values[data_end_day],
+            r_eff     = np.nanmean(msim.results['r_eff'].values[data_end_day:]),
+        )
+    return values
+
+
 ########################################################################
 # Run calibration and scenarios
 ########################################################################
@@ -327,23 +419,19 @@ if __name__ == '__main__':
 
         n_runs = 3000
 
-        fitsummary = []
-        s0 = make_sim(seed=1, end_day='2020-08-25', verbose=-1)
-        sims = []
-        for seed in range(n_runs):
-            sim = s0.copy()
-            sim['rand_seed'] = seed
-            sim.set_seed()
-            sim.label = f"Sim {seed}"
-            sims.append(sim)
-        msim = cv.MultiSim(sims)
-        msim.run()
-#        msim.run(par_args={'n_cpus':24})
-
-        # Figure out the seeds that give a good fit
-        mismatches = np.array([sim.compute_fit().mismatch for sim in msim.sims])
-        threshold = np.quantile(mismatches, 0.01) # Take the best 1%
-        goodseeds = [i for i in range(len(mismatches)) if mismatches[i] < threshold]
+        if use_screening:
+            screen = sr.screen_seeds(sr.reseeded(make_sim, end_day='2020-08-25', verbose=-1), seeds=range(n_runs), keep=0.01) # Take the best 1%
+            goodseeds = screen.goodseeds
+        else:
+            fitsummary = []
+            s0 = make_sim(seed=1, end_day='2020-08-25', verbose=-1)
+            # Each worker copies and reseeds s0 itself, and sends back only the mismatch
+            mismatches = np.array([mismatch for seed,mismatch in ens.run_ensemble(s0, range(n_runs), ordered=True, func=ens.fit_mismatch)])
+#            mismatches = np.array([mismatch for seed,mismatch in ens.run_ensemble(s0, range(n_runs), n_cpus=24, ordered=True, func=ens.fit_mismatch)])
+
+            # Figure out the seeds that give a good fit
+            threshold = np.quantile(mismatches, 0.01) # Take the best 1%
+            goodseeds = [i for i in range(len(mismatches)) if mismatches[i] < threshold]
         cv.save(f'{resfolder}/goodseeds.obj',goodseeds)
 
 
@@ -391,6 +479,9 @@ if __name__ == '__main__':
             sims_cur, sims_opt = [], []
             s_cur = make_sim(seed=1, calibration=False, scenario=scenname, future_symp_test=None, end_day='2020-10-23', verbose=0.1)
             s_opt = make_sim(seed=1, calibration=False, scenario=scenname, future_symp_test=future_symp_test, end_day='2020-10-23', verbose=0.1)
+            if use_crn: # Each copy uses the streams for its own seed
+                crn.use_crn(s_cur)
+                crn.use_crn(s_opt)
             for seed in goodseeds:
                 sim_cur = s_cur.copy()
                 sim_cur['rand_seed'] = seed
@@ -427,11 +518,15 @@ if __name__ == '__main__':
 
         do_load = False # Whether to load files from cache, if available
         do_save = False # Whether to save files to cache, if rerun
+        use_sink = False # Whether to run a restartable sweep that writes each sim's summary to the sink as it finishes, rather than keeping all the sims in memory
         sy_npts = [41, 5][debug]
         tr_npts = [41, 5][debug]
         max_seeds = [10, 4][debug]
+        sweep_design = 'grid' # Which cells of the grid to run: all of them, or those nearest the points of a 'sparse', 'sobol' or 'lhs' design, interpolating the rest
+        design_kwargs = dict(level=[6, 3][debug]) # The level of a sparse grid (exact for 2**(level-1)+1 points per side), or n and seed for 'sobol' or 'lhs'
         symp_test_vals = np.linspace(0, 1, sy_npts)
         trace_eff_vals = np.linspace(0, 1, tr_npts)
+        cells = set(ds.grid_cells(sweep_design, (sy_npts, tr_npts), **design_kwargs))
         scenarios = ['masks30','masks30_notschools','masks15','masks15_notschools']
         n_scenarios = len(scenarios)
         goodseeds = cv.load(f'{resfolder}/goodseeds.obj')[:max_seeds]
@@ -453,14 +548,16 @@ if __name__ == '__main__':
         if os.path.isfile(sims_file) and do_load: # Don't run, just load
             sim_configs = cv.load(sims_file)
         else:
-            n_sims = n_scenarios*sy_npts*tr_npts*max_seeds
+            n_sims = n_scenarios*len(cells)*max_seeds
             count = 0
             ikw = []
             for i_sc,scenname in enumerate(scenarios):
                 for i_fst,future_symp_test in enumerate(symp_test_vals):
                     print(f'Creating arguments for sim {count} of {n_sims}...')
-                    daily_test = np.round(1 - (1 - future_symp_test) ** (1 / 10), 3) if future_symp_test<1 else 0.4
+                    daily_test = daily_test_prob(future_symp_test)
                     for i_fte,future_t_eff in enumerate(trace_eff_vals):
+                        if (i_fst, i_fte) not in cells:
+                            continue
                         for i_s,seed in enumerate(goodseeds):
                             count += 1
                             meta = sc.objdict()
@@ -478,42 +575,79 @@ if __name__ == '__main__':
                 cv.save(filename=sims_file, obj=sim_configs)
 
         # Run sims
-        all_sims = sc.parallelize(run_sim, iterarg=sim_configs, kwargs=dict(do_load=do_load, do_save=do_save))
-        sims = np.empty((n_scenarios, sy_npts, tr_npts, max_seeds), dtype=object)
-        for sim in all_sims: # Unflatten array
-            i_sc, i_fst, i_fte, i_s = sim.meta.inds
-            sims[i_sc, i_fst, i_fte, i_s] = sim
-
-        # Convert to msims
-        all_sims_semi_flat = []
-        for i_sc in range(n_scenarios):
-            for i_fst in range(sy_npts):
-                for i_fte in range(tr_npts):
-                    sim_seeds = sims[i_sc, i_fst, i_fte, :].tolist()
-                    all_sims_semi_flat.append(sim_seeds)
-        msims = np.empty((n_scenarios, sy_npts, tr_npts), dtype=object)
-        all_msims = sc.parallelize(make_msims, iterarg=all_sims_semi_flat)
-        for msim in all_msims: # Unflatten array
-            i_sc, i_fst, i_fte = msim.meta.inds
-            msims[i_sc, i_fst, i_fte] = msim
-
-        # Do processing and store results
-        for i_sc,scenname in enumerate(scenarios):
-            sweep_summary = {'cum_inf':[],'peak_inf':[],'cum_death':[]}
-            for i_fst in range(sy_npts):
-                cum_inf, peak_inf, cum_death = [], [], []
-                for i_fte in range(tr_npts):
-                    msim = msims[i_sc, i_fst, i_fte]
-                    data_end_day = msim.sims[0].day(data_end)
-                    cum_inf.append(msim.results['cum_infections'].values[-1]-msim.results['cum_infections'].values[data_end_day])
-                    peak_inf.append(max(msim.results['new_infections'].values[data_end_day:]))
-                    cum_death.append(msim.results['cum_deaths'].values[-1]-msim.results['cum_deaths'].values[data_end_day])
+        if use_sink: # Skips any sims already finished, and saves the summaries so far after every full row of the grid
+            tasks = {'_'.join(str(i) for i in sim.meta.inds):dict(sim=sim) for sim in sim_configs}
+            flush = lambda: save_sink_summaries(scenarios, sy_npts, tr_npts, fill=(sweep_design != 'grid'))
+            sw.run_sweep(run_sim, tasks, folder=sinkfolder, kwargs=dict(do_load=do_load, do_save=do_save, use_sink=True), flush=flush, flush_every=tr_npts*max_seeds)
 
-                sweep_summary['cum_inf'].append(cum_inf)
-                sweep_summary['peak_inf'].append(peak_inf)
-                sweep_summary['cum_death'].append(cum_death)
+        else:
+            all_sims = sc.parallelize(run_sim, iterarg=sim_configs, kwargs=dict(do_load=do_load, do_save=do_save))
+            sims = np.empty((n_scenarios, sy_npts, tr_npts, max_seeds), dtype=object)
+            for sim in all_sims: # Unflatten array
+                i_sc, i_fst, i_fte, i_s = sim.meta.inds
+                sims[i_sc, i_fst, i_fte, i_s] = sim
+
+            # Convert to msims
+            all_sims_semi_flat = []
+            for i_sc in range(n_scenarios):
+                for i_fst in range(sy_npts):
+                    for i_fte in range(tr_npts):
+                        if (i_fst, i_fte) in cells:
+                            sim_seeds = sims[i_sc, i_fst, i_fte, :].tolist()
+                            all_sims_semi_flat.append(sim_seeds)
+            msims = np.empty((n_scenarios, sy_npts, tr_npts), dtype=object)
+            all_msims = sc.parallelize(make_msims, iterarg=all_sims_semi_flat)
+            for msim in all_msims: # Unflatten array
+                i_sc, i_fst, i_fte = msim.meta.inds
+                msims[i_sc, i_fst, i_fte] = msim
+
+            # Do processing and store results
+            for i_sc,scenname in enumerate(scenarios):
+                sweep_summary = {'cum_inf':[],'peak_inf':[],'cum_death':[]}
+                for i_fst in range(sy_npts):
+                    cum_inf, peak_inf, cum_death = [], [], []
+                    for i_fte in range(tr_npts):
+                        msim = msims[i_sc, i_fst, i_fte]
+                        if msim is None: # Not in the design; interpolated below
+                            cum_inf.append(np.nan)
+                            peak_inf.append(np.nan)
+                            cum_death.append(np.nan)
+                            continue
+                        data_end_day = msim.sims[0].day(data_end)
+                        cum_inf.append(msim.results['cum_infections'].values[-1]-msim.results['cum_infections'].values[data_end_day])
+                        peak_inf.append(max(msim.results['new_infections'].values[data_end_day:]))
+                        cum_death.append(msim.results['cum_deaths'].values[-1]-msim.results['cum_deaths'].values[data_end_day])
+
+                    sweep_summary['cum_inf'].append(cum_inf)
+                    sweep_summary['peak_inf'].append(peak_inf)
+                    sweep_summary['cum_death'].append(cum_death)
+
+                sweep_summary = {key:ds.fill_grid(grid).tolist() for key,grid in sweep_summary.items()}
+                cv.save(f'{resfolder}/uk_tti_sweeps_{scenname}.obj', sweep_summary)
+        sc.toc(T)
 
+
+    # As tti_sweeps, but only run the cells of the grid needed to resolve the heatmaps
+    elif whattorun=='tti_adaptive':
+
+        sy_npts = [41, 9][debug]
+        tr_npts = [41, 9][debug]
+        max_seeds = [10, 4][debug]
+        coarse_step = [8, 4][debug] # Spacing of the initial lattice of cells
+        refine_tol = 0.1 # Refine wherever interpolation is off by more than this fraction of an output's range
+        symp_test_vals = np.linspace(0, 1, sy_npts)
+        trace_eff_vals = np.linspace(0, 1, tr_npts)
+        scenarios = ['masks30','masks30_notschools','masks15','masks15_notschools']
+        goodseeds = cv.load(f'{resfolder}/goodseeds.obj')[:max_seeds]
+        T = sc.tic()
+
+        for i_sc,scenname in enumerate(scenarios):
+            sc.heading(f'Refining the sweep for {scenname}...')
+            evaluate = lambda cells: run_cells(i_sc, scenname, cells, goodseeds, symp_test_vals, trace_eff_vals)
+            refined = rf.refine_grid(evaluate, shape=(sy_npts, tr_npts), step=coarse_step, thresholds=dict(r_eff=1), tol=refine_tol)
+            sweep_summary = {key:grid.tolist() for key,grid in refined.grids.items()} # As for tti_sweeps, plus the mean R_eff
             cv.save(f'{resfolder}/uk_tti_sweeps_{scenname}.obj', sweep_summary)
+            print(f'Ran {len(refined.cells)} of {sy_npts*tr_npts} cells ({refined.frac_run:0.1%}) for {scenname}')
         sc.toc(T)
 
 
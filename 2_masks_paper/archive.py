@@ -0,0 +1,565 @@
+'''
+Save the results of a sim or multisim as a compressed columnar archive, rather than
+pickling the whole multisim.
+
+Only the results are stored: one array per result, with one row per sim (and one per
+variant for the variant results), plus the values/low/high of the reduced results if the
+multisim has been reduced. Each array is split into chunks of chunk_len days, which are
+compressed separately, so reading a date range only decompresses the chunks it overlaps.
+The bytes of each chunk are shuffled before compression (all the first bytes of each
+number, then all the second bytes, etc.), which compresses floating-point results better.
+With compression=None the arrays are memory-mapped directly from the file instead.
+
+The file is a short magic string, the length of the header, a JSON header (the dates,
+sim labels and seeds, any metadata, and the shape, dtype and chunk offsets of each
+array), and then the chunks.
+
+Array names are:
+
+    sims/<key>                  (n_sims, npts) for each result, e.g. sims/new_diagnoses
+    sims/variant/<key>          (n_sims, n_variants, npts), e.g. sims/variant/new_infections_by_variant
+    results/<key>/<values|low|high>           the reduced results, if any
+    results/variant/<key>/<values|low|high>
+    data/<column>               the numeric columns of the first sim's data, if any
+
+lazy_msim() opens an archive (or a pickled multisim, which is converted to an archive the
+first time) as a stand-in for a multisim, e.g. for plotting.
+
+**Example**::
+
+    msim.reduce(quantiles=[0.1, 0.9])
+    save_archive('results/uk_sim.cvar', msim)
+    ...
+    with result_archive('results/uk_sim.cvar') as arch:
+        inds = arch.day(['2021-01-01', '2022-01-01'])
+        diagnoses = arch['sims/new_diagnoses'][:, inds[0]:inds[1]] # Only decompresses these days
+        high = arch['results/new_diagnoses/high'][inds[0]:inds[1]]
+'''
+
+import os
+import json
+import zlib
+import mmap
+import numpy as np
+import pandas as pd
+import sciris as sc
+import covasim as cv
+
+
+magic = b'CVARCH01'
+archive_version = 1
+chunk_len = 128 # Days per chunk
+
+
+def _sims_of(obj):
+    ''' Get the list of sims from a sim, multisim, or list of sims '''
+    if isinstance(obj, cv.MultiSim):
+        return obj.sims
+    elif isinstance(obj, cv.Sim):
+        return [obj]
+    return list(obj)
+
+
+def _result_arrays(results, prefix, keys=None):
+    ''' Get the arrays (and names) of the results in a sim or reduced multisim '''
+    arrays = {}
+    names = {}
+    for key,res in results.items():
+        if isinstance(res, cv.Result) and (keys is None or key in keys):
+            arrays[f'{prefix}{key}'] = res
+            names[key] = res.name
+        elif key == 'variant':
+            for vkey,vres in res.items():
+                if keys is None or vkey in keys:
+                    arrays[f'{prefix}variant/{vkey}'] = vres
+                    names[vkey] = vres.name
+    return arrays, names
+
+
+def _shuffle(arr):
+    ''' Group the bytes of the array by their position within each number '''
+    arr = np.ascontiguousarray(arr)
+    return arr.view(np.uint8).reshape(-1, arr.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype, shape):
+    ''' Reverse _shuffle() '''
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+
+def save_archive(filename, obj, keys=None, meta=None, compression='zlib', level=6, chunk_len=chunk_len):
+    '''
+    Save the results of a sim, multisim, or list of sims.
+
+    Args:
+        filename    (str):      the file to save to, e.g. 'results/uk_sim.cvar'
+        obj         (MultiSim): the multisim, sim, or list of sims; all must have the same dates
+        keys        (list):     the results to save (default: all)
+        meta        (dict):     any other information to store in the header, e.g. the scenario parameters; must be JSON-compatible
+        compression (str):      'zlib', or None to store the arrays uncompressed so they can be memory-mapped
+        level       (int):      the zlib compression level
+        chunk_len   (int):      the number of days in each chunk
+
+    Returns:
+        The filename
+    '''
+    if compression not in ['zlib', None]:
+        errormsg = f'Compression "{compression}" not supported; choices are "zlib" or None'
+        raise ValueError(errormsg)
+    sims = _sims_of(obj)
+    if not sims:
+        errormsg = 'There are no sims to save'
+        raise ValueError(errormsg)
+    base = sims[0]
+    dates = [str(d) for d in base.results['date']]
+    for sim in sims:
+        if len(sim.results['date']) != len(dates) or str(sim.results['date'][0]) != dates[0]:
+            errormsg = f'Sim "{sim.label}" has different dates to sim "{base.label}", so they cannot be saved together'
+            raise ValueError(errormsg)
+
+    # Stack each result across the sims
+    arrays = {}
+    per_sim, names = _result_arrays(base.results, prefix='sims/', keys=keys)
+    for name in per_sim.keys():
+        rkey = name.split('/')[-1]
+        if name.startswith('sims/variant/'):
+            arrays[name] = np.array([sim.results['variant'][rkey].values for sim in sims])
+        else:
+            arrays[name] = np.array([sim.results[rkey].values for sim in sims])
+    if isinstance(obj, cv.MultiSim) and obj.which in ['reduced', 'combined']:
+        reduced, _ = _result_arrays(obj.results, prefix='results/', keys=keys)
+        for name,res in reduced.items():
+            for attr in ['values', 'low', 'high']:
+                if getattr(res, attr, None) is not None:
+                    arrays[f'{name}/{attr}'] = np.asarray(getattr(res, attr))
+    data_dates = None
+    if base.data is not None: # The numeric columns of the data, e.g. for plotting against
+        data_dates = [str(d) for d in base.data.index]
+        for col in base.data.columns:
+            if base.data[col].dtype.kind in 'biuf':
+                arrays[f'data/{col}'] = base.data[col].values
+
+    # Compress each array in chunks along the time axis
+    header = dict(
+        version    = archive_version,
+        dates      = dates,
+        labels     = [sim.label for sim in sims],
+        seeds      = [sim['rand_seed'] for sim in sims],
+        names      = names,
+        reduced    = isinstance(obj, cv.MultiSim) and obj.which,
+        pars       = {k:base[k] for k in ['start_day', 'end_day', 'n_days']},
+        data_dates = data_dates,
+        meta       = meta,
+        arrays     = {},
+    )
+    blocks = []
+    offset = 0
+    for name,arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        entry = dict(dtype=arr.dtype.str, shape=list(arr.shape), compression=compression, chunk_len=chunk_len, chunks=[])
+        if compression is None:
+            data = arr.tobytes()
+            entry['chunks'].append([offset, len(data)])
+            blocks.append(data)
+            offset += len(data)
+        else:
+            for start in range(0, arr.shape[-1], chunk_len):
+                data = zlib.compress(_shuffle(arr[..., start:start+chunk_len]), level)
+                entry['chunks'].append([offset, len(data)])
+                blocks.append(data)
+                offset += len(data)
+        header['arrays'][name] = entry
+
+    # Write to a temporary file, then move it into place
+    header_bytes = json.dumps(sc.jsonify(header)).encode()
+    header_bytes += b' '*(-len(header_bytes) % 8) # Align the data, so uncompressed arrays can be mapped
+    folder = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(folder, exist_ok=True)
+    tmpfile = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(magic)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for data in blocks:
+            f.write(data)
+    os.replace(tmpfile, filename)
+    return filename
+
+
+def convert(objfile, filename=None, **kwargs):
+    ''' Convert a pickled sim or multisim (e.g. uk_sim.obj) to an archive, by default with the same name and a .cvar extension '''
+    if filename is None:
+        filename = os.path.splitext(objfile)[0] + '.cvar'
+    obj = cv.load(objfile)
+    return save_archive(filename, obj, meta=sc.jsonify(getattr(obj, 'meta', None)), **kwargs)
+
+
+class archived_array(sc.prettyobj):
+    '''
+    An array in an archive, read on demand. Index it like a NumPy array; only the
+    chunks that overlap the days selected on the last axis are decompressed.
+    '''
+
+    def __init__(self, archive, name, entry):
+        self.archive     = archive
+        self.name        = name
+        self.shape       = tuple(entry['shape'])
+        self.dtype       = np.dtype(entry['dtype'])
+        self.compression = entry['compression']
+        self.chunk_len   = entry['chunk_len']
+        self.chunks      = entry['chunks']
+        return
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, c):
+        ''' Decompress a single chunk '''
+        offset, nbytes = self.chunks[c]
+        buffer = self.archive._buffer(offset, nbytes)
+        start = c*self.chunk_len
+        shape = self.shape[:-1] + (min(self.chunk_len, self.shape[-1]-start),)
+        return _unshuffle(zlib.decompress(buffer), self.dtype, shape)
+
+    def mmap(self):
+        ''' Return the whole array without copying it; only for arrays saved without compression '''
+        if self.compression is not None:
+            errormsg = f'Array "{self.name}" is compressed, so it cannot be memory-mapped; save with compression=None'
+            raise ValueError(errormsg)
+        offset, nbytes = self.chunks[0]
+        return np.frombuffer(self.archive._buffer(offset, nbytes), dtype=self.dtype).reshape(self.shape)
+
+    def __getitem__(self, key):
+        if self.compression is None:
+            return np.array(self.mmap()[key])
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key): # Expand it, so the last index is always the days
+            e = [k is Ellipsis for k in key].index(True)
+            key = key[:e] + (slice(None),)*(self.ndim - len(key) + 1) + key[e+1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+        if len(key) > self.ndim:
+            errormsg = f'Too many indices for array "{self.name}" with shape {self.shape}'
+            raise IndexError(errormsg)
+        lead, tkey = key[:-1], key[-1]
+        tinds = np.arange(self.shape[-1])[tkey]
+        scalar = np.ndim(tinds) == 0
+        tinds = np.atleast_1d(tinds)
+        chunk_inds = tinds // self.chunk_len
+        out = None
+        for c in np.unique(chunk_inds):
+            block = self._chunk(c)[lead]
+            if out is None:
+                out = np.empty(block.shape[:-1] + (len(tinds),), dtype=self.dtype)
+            pos = np.nonzero(chunk_inds == c)[0]
+            out[..., pos] = block[..., tinds[pos] - c*self.chunk_len]
+        if out is None: # Nothing selected
+            out = np.empty(np.empty(self.shape[:-1] + (0,))[lead].shape, dtype=self.dtype)
+        return out[..., 0] if scalar else out
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[...]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+class result_archive(sc.prettyobj):
+    '''
+    Open an archive saved by save_archive(). The file is memory-mapped, and arrays are
+    only read when they are indexed.
+
+    Args:
+        filename (str): the archive to open
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        if self._file.read(len(magic)) != magic:
+            self._file.close()
+            errormsg = f'{filename} is not a results archive'
+            raise ValueError(errormsg)
+        header_len = int(np.frombuffer(self._file.read(8), dtype=np.uint64)[0])
+        header = json.loads(self._file.read(header_len))
+        if header['version'] > archive_version:
+            self._file.close()
+            errormsg = f'{filename} is archive version {header["version"]}, but only versions up to {archive_version} are supported'
+            raise ValueError(errormsg)
+        self.data_start = len(magic) + 8 + header_len
+        self._mmap      = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.dates      = header['dates']
+        self.labels     = header['labels']
+        self.seeds      = header['seeds']
+        self.names      = header['names']
+        self.reduced    = header['reduced']
+        self.pars       = header.get('pars', {})
+        self.data_dates = header.get('data_dates')
+        self.meta       = header['meta']
+        self.arrays     = sc.objdict({name:archived_array(self, name, entry) for name,entry in header['arrays'].items()})
+        return
+
+    def _buffer(self, offset, nbytes):
+        start = self.data_start + offset
+        return memoryview(self._mmap)[start:start+nbytes]
+
+    @property
+    def n_sims(self):
+        return len(self.labels)
+
+    @property
+    def npts(self):
+        return len(self.dates)
+
+    def keys(self):
+        return list(self.arrays.keys())
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        try:
+            return self.arrays[name]
+        except KeyError:
+            errormsg = f'Array "{name}" is not in {self.filename}; choices are: {sc.newlinejoin(self.keys())}'
+            raise KeyError(errormsg) from None
+
+    def _results(self, prefix, row=None, make_load=None):
+        ''' Make lazy results from the arrays with this prefix: one row of the per-sim arrays, the stored reduced results, or results computed by make_load(name) '''
+        results = {}
+        variant = {}
+        for name,arr in self.arrays.items():
+            if not name.startswith(prefix + '/'):
+                continue
+            parts = name[len(prefix)+1:].split('/')
+            is_variant = parts[0] == 'variant'
+            key = parts[1] if is_variant else parts[0]
+            target = variant if is_variant else results
+            if key in target:
+                continue
+            if make_load is not None:
+                load = make_load(name)
+            elif row is not None:
+                load = lambda arr=arr: dict(values=arr[row])
+            else:
+                base = name.rsplit('/', 1)[0]
+                load = lambda base=base: {attr:self.arrays[f'{base}/{attr}'][...] for attr in ['values', 'low', 'high'] if f'{base}/{attr}' in self.arrays}
+            target[key] = lazy_result(self.names.get(key, key), load)
+        return lazy_results(results, variant=lazy_results(variant) if variant else None, dates=self.dates)
+
+    def day(self, dates):
+        ''' Convert one or more dates to indices, like sim.day() '''
+        return cv.day(dates, start_date=self.dates[0])
+
+    def close(self):
+        ''' Close the file; arrays that were memory-mapped from it can no longer be used '''
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError: # Memory-mapped arrays are still in use; leave it to the garbage collector
+                pass
+            self._file.close()
+            self._mmap = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+
+class lazy_result(sc.prettyobj):
+    ''' Stand-in for a cv.Result, whose values (and low and high, if any) are only read when first used '''
+
+    def __init__(self, name, load):
+        self.name   = name
+        self._load  = load # Function returning a dict of values, low, and high
+        self._cache = None
+        return
+
+    def _get(self, attr):
+        if self._cache is None:
+            self._cache = self._load()
+        return self._cache.get(attr)
+
+    @property
+    def values(self):
+        return self._get('values')
+
+    @property
+    def low(self):
+        return self._get('low')
+
+    @property
+    def high(self):
+        return self._get('high')
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.values, dtype=dtype)
+
+
+class lazy_results(sc.prettyobj):
+    ''' Stand-in for sim.results: a dict of lazy_result objects, plus the variant results under 'variant' '''
+
+    def __init__(self, results, variant=None, dates=None):
+        self._results = results
+        self._variant = variant
+        self._dates   = dates
+        return
+
+    def keys(self):
+        return list(self._results.keys()) + (['variant'] if self._variant is not None else [])
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key == 'variant' and self._variant is not None:
+            return self._variant
+        elif key == 'date':
+            return np.array([sc.date(d) for d in self._dates])
+        elif key == 't':
+            return np.arange(len(self._dates))
+        try:
+            return self._results[key]
+        except KeyError:
+            errormsg = f'Result "{key}" is not in the archive; choices are: {sc.newlinejoin(self.keys())}'
+            raise KeyError(errormsg) from None
+
+
+class lazy_sim(sc.prettyobj):
+    ''' Stand-in for one sim of an archive, with its results, dates, and data '''
+
+    def __init__(self, archive, index):
+        self.archive = archive
+        self.index   = index
+        self.label   = archive.labels[index]
+        self.results = archive._results('sims', row=index)
+        self._data   = None
+        return
+
+    def __getitem__(self, key):
+        ''' Get the parameters that are stored, e.g. sim['start_day'] '''
+        if key == 'rand_seed':
+            return self.archive.seeds[self.index]
+        elif key in ['start_day', 'end_day']:
+            return sc.date(self.archive.pars[key])
+        elif key in self.archive.pars:
+            return self.archive.pars[key]
+        errormsg = f'Parameter "{key}" is not stored in the archive; only rand_seed and {sc.strjoin(self.archive.pars.keys())} are'
+        raise KeyError(errormsg)
+
+    @property
+    def npts(self):
+        return self.archive.npts
+
+    @property
+    def tvec(self):
+        return np.arange(self.npts)
+
+    def day(self, day, *args):
+        return cv.day(day, *args, start_date=self.archive.dates[0])
+
+    def date(self, ind, *args, **kwargs):
+        return cv.date(ind, *args, start_date=self.archive.dates[0], **kwargs)
+
+    @property
+    def data(self):
+        ''' The data as a dataframe indexed by date, as in sim.data, loaded on first use '''
+        if self._data is None and self.archive.data_dates is not None:
+            dates = [sc.date(d) for d in self.archive.data_dates]
+            cols = {name[len('data/'):]:self.archive[name][...] for name in self.archive.keys() if name.startswith('data/')}
+            self._data = pd.DataFrame(sc.mergedicts({'date':dates}, cols), index=pd.Index(dates, name='date'))
+        return self._data
+
+
+class lazy_msim(sc.prettyobj):
+    '''
+    Open a saved multisim for reading its results, without loading the people,
+    interventions, or any results that are not used.
+
+    If given a pickled sim or multisim (e.g. uk_sim.obj) rather than an archive, it is
+    converted to an archive with the same name and a .cvar extension the first time (or
+    whenever the pickle is newer), so later loads are fast. If only the archive was
+    saved, it is opened instead.
+
+    Args:
+        filename (str): the archive or pickled multisim
+
+    **Example**::
+
+        msim = lazy_msim('results/uk_sim.obj')
+        msim.reduce() # Only computed for the results that are used
+        high = msim.results['new_diagnoses'].high
+        r_eff = [sim.results['r_eff'].values for sim in msim.sims]
+    '''
+
+    def __init__(self, filename):
+        if not filename.endswith('.cvar'):
+            archive_file = os.path.splitext(filename)[0] + '.cvar'
+            if os.path.isfile(filename): # Otherwise only the archive was saved
+                if not os.path.isfile(archive_file) or os.path.getmtime(archive_file) < os.path.getmtime(filename):
+                    print(f'Converting {filename} to {archive_file}...')
+                    convert(filename, archive_file)
+            elif not os.path.isfile(archive_file):
+                errormsg = f'Neither {filename} nor its archive {archive_file} exists'
+                raise FileNotFoundError(errormsg)
+            filename = archive_file
+        self.filename = filename
+        self.archive  = result_archive(filename)
+        self.meta     = self.archive.meta
+        self.sims     = [lazy_sim(self.archive, i) for i in range(self.archive.n_sims)]
+        self.which    = self.archive.reduced or None
+        self._results = self.archive._results('results') if self.which else None
+        return
+
+    def __len__(self):
+        return len(self.sims)
+
+    @property
+    def base_sim(self):
+        return self.sims[0]
+
+    @property
+    def results(self):
+        if self._results is None:
+            errormsg = 'This multisim was not reduced before it was saved; call reduce() first'
+            raise ValueError(errormsg)
+        return self._results
+
+    def reduce(self, quantiles=None, use_mean=False, bounds=None):
+        ''' As MultiSim.reduce(), but each result is only reduced when it is first used '''
+        if use_mean:
+            bounds = 2 if bounds is None else bounds
+        else:
+            if quantiles is None:
+                quantiles = cv.make_metapars()['quantiles']
+            if not isinstance(quantiles, dict):
+                quantiles = {'low':float(quantiles[0]), 'high':float(quantiles[1])}
+
+        def reducer(name):
+            def load():
+                raw = self.archive[name][...]
+                if use_mean:
+                    r_mean = np.mean(raw, axis=0)
+                    r_std  = np.std(raw, axis=0)
+                    return dict(values=r_mean, low=r_mean - bounds*r_std, high=r_mean + bounds*r_std)
+                return dict(values=np.quantile(raw, q=0.5, axis=0), low=np.quantile(raw, q=quantiles['low'], axis=0), high=np.quantile(raw, q=quantiles['high'], axis=0))
+            return load
+
+        self._results = self.archive._results('sims', make_load=reducer)
+        self.which = 'reduced'
+        return
+
+    def close(self):
+        self.archive.close()
+        return
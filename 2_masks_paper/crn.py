@@ -0,0 +1,213 @@
+'''
+Common random numbers for paired scenario comparisons.
+
+Covasim draws all its random numbers from the global NumPy and Numba generators, so as
+soon as one scenario makes a different number of draws (e.g. more people are tested),
+every later draw differs from the other scenario's, and the difference between the
+scenarios carries the full noise of two independent runs.
+
+With use_crn(), each day's random numbers are split into streams: one for the start of
+the day (rescaling, contacts, imported infections and variants), one for each
+intervention (testing, tracing, vaccination, ...), and one for transmission (including
+the prognoses of the newly infected). Before each stream starts, the generators are
+reset to a seed that depends only on the sim's rand_seed, the day, and the stream, so
+a change to one intervention only changes that intervention's draws on the days it
+makes them, rather than everything that follows.
+
+Reseeding alone is not enough for transmission, since Covasim draws one number per
+contact with an infectious person, so as soon as one person's infection differs, every
+later contact gets another contact's number. While a CRN sim is transmitting, each
+contact instead gets a number hashed from the seed, the day, the variant, the layer and
+the two people, so the same contact has the same chance of transmission in both scenarios.
+Draws over the whole population (e.g. test_prob) are then matched per person too, but
+draws over whoever is eligible (e.g. the prognoses of the newly infected, or contact
+tracing) are still only matched by stream, so the coupling is partial.
+
+Interventions are matched between scenarios by their label (with a counter for
+repeated labels), so interventions that differ between scenarios should be given
+distinct labels, and shared ones the same labels.
+
+**Example**::
+
+    sim_cur = use_crn(make_sim(seed=seed, scenario=scen, future_symp_test=None))
+    sim_opt = use_crn(make_sim(seed=seed, scenario=scen, future_symp_test=0.15))
+'''
+
+import hashlib
+import numpy as np
+import numba as nb
+import sciris as sc
+import covasim as cv
+
+
+@nb.njit
+def set_numba_seed(seed):
+    np.random.seed(seed)
+
+
+@nb.njit
+def splitmix(x):
+    ''' Mix a 64-bit integer (SplitMix64) '''
+    x = (x + np.uint64(0x9E3779B97F4A7C15))
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@nb.njit
+def contact_uniforms(seed, sources, targets):
+    ''' A uniform random number for each (source, target) pair, depending only on the seed and the pair '''
+    out = np.empty(len(sources))
+    for i in range(len(sources)):
+        h = splitmix(np.uint64(seed) ^ splitmix(np.uint64(sources[i])))
+        h = splitmix(h ^ np.uint64(targets[i]))
+        out[i] = (h >> np.uint64(11)) * (1.0/9007199254740992.0) # Top 53 bits
+    return out
+
+
+@nb.njit
+def crn_compute_infections(seed, beta, p1, p2, layer_betas, rel_trans, rel_sus, legacy):
+    ''' As cv.utils.compute_infections(), but with the random numbers from contact_uniforms() '''
+    slist = np.empty(0, dtype=p1.dtype)
+    tlist = np.empty(0, dtype=p1.dtype)
+    pairs = [[p1,p2], [p2,p1]] if not legacy else [[p1,p2]]
+    for sources,targets in pairs:
+        source_trans     = rel_trans[sources]
+        inf_inds         = source_trans.nonzero()[0]
+        betas            = beta * layer_betas[inf_inds] * source_trans[inf_inds] * rel_sus[targets[inf_inds]]
+        nonzero_inds     = betas.nonzero()[0]
+        nonzero_inf_inds = inf_inds[nonzero_inds]
+        nonzero_betas    = betas[nonzero_inds]
+        nonzero_sources  = sources[nonzero_inf_inds]
+        nonzero_targets  = targets[nonzero_inf_inds]
+        transmissions    = (contact_uniforms(seed, nonzero_sources, nonzero_targets) < nonzero_betas).nonzero()[0]
+        slist = np.concatenate((slist, nonzero_sources[transmissions]), axis=0)
+        tlist = np.concatenate((tlist, nonzero_targets[transmissions]), axis=0)
+    return slist, tlist
+
+
+# The seed, day and people of the CRN sim that is currently transmitting, if any, and its contact layers
+_transmitting = sc.objdict(seed=None, t=None, people=None, layers={})
+_compute_infections = cv.utils.compute_infections
+
+
+def install():
+    '''
+    Make Covasim call compute_infections() below rather than its own. Covasim looks this up
+    on each step, so CRN sims can swap in their own random numbers; other sims are unaffected.
+    Only done once a CRN sim is set up or run, so importing this module changes nothing.
+    '''
+    if cv.utils.compute_infections is not compute_infections:
+        cv.utils.compute_infections = compute_infections
+    return
+
+
+def start_transmission(sim):
+    ''' Record the sim that is about to transmit, and which layer each contact array belongs to '''
+    install() # In case the sim was set up in another process
+    layers = {}
+    for lkey,layer in sim.people.contacts.items():
+        layers[id(layer['p1'])] = (lkey, 'forward')
+        layers[id(layer['p2'])] = (lkey, 'reverse') # Legacy transmission also passes the layer the other way round
+    _transmitting.update(seed=sim['rand_seed'], t=sim.t, people=sim.people, layers=layers)
+    return
+
+
+def stop_transmission():
+    _transmitting.update(seed=None, t=None, people=None, layers={})
+    return
+
+
+def contact_stream(p1, rel_trans):
+    '''
+    The name of the stream for a call to compute_infections(): the variant and the layer.
+    Covasim skips variants with no one infectious, so the order of the calls can differ
+    between scenarios; the variant is that of the infectious people in the call.
+    '''
+    lkey, direction = _transmitting.layers.get(id(p1), ('unknown', 'forward'))
+    sources = rel_trans.nonzero()[0]
+    variant = int(_transmitting.people.infectious_variant[sources[0]]) if len(sources) else -1 # With no sources, nothing can be transmitted anyway
+    return f'contacts {variant} {lkey} {direction}'
+
+
+def compute_infections(beta, p1, p2, layer_betas, rel_trans, rel_sus, legacy=False):
+    ''' Use the per-contact random numbers while a CRN sim is transmitting, and Covasim's own otherwise '''
+    if _transmitting.seed is None:
+        return _compute_infections(beta, p1, p2, layer_betas, rel_trans, rel_sus, legacy)
+    seed = stream_seed(_transmitting.seed, _transmitting.t, contact_stream(p1, rel_trans))
+    return crn_compute_infections(seed, beta, p1, p2, layer_betas, rel_trans, rel_sus, legacy)
+
+
+def stream_seed(seed, t, stream):
+    ''' A 32-bit seed that depends only on the sim's seed, the day, and the name of the stream '''
+    return int(hashlib.md5(f'{seed}|{t}|{stream}'.encode()).hexdigest()[:8], 16)
+
+
+def set_stream(seed, t, stream):
+    ''' Reset the NumPy and Numba generators for a stream '''
+    s = stream_seed(seed, t, stream)
+    np.random.seed(s)
+    set_numba_seed(s)
+    return
+
+
+class reseed(cv.Intervention):
+    ''' Start a random number stream for the draws that follow, until the next reseed '''
+
+    def __init__(self, stream, **kwargs):
+        super().__init__(label=f'reseed {stream}', do_plot=False, **kwargs) # Initialize the Intervention object
+        self.stream = stream
+        return
+
+    def apply(self, sim):
+        set_stream(sim['rand_seed'], sim.t, self.stream)
+        if self.stream == 'transmission':
+            start_transmission(sim)
+        return
+
+
+class reseed_next_day(cv.Analyzer):
+    ''' Start the stream for the beginning of the next day (analyzers are applied at the end of each day) '''
+
+    def __init__(self, **kwargs):
+        super().__init__(label='reseed next day', **kwargs) # Initialize the Analyzer object
+        return
+
+    def apply(self, sim):
+        stop_transmission()
+        set_stream(sim['rand_seed'], sim.t+1, 'day')
+        return
+
+
+def stream_names(interventions):
+    ''' A stream name for each intervention: its label, with a counter if the label is repeated '''
+    counts = {}
+    names = []
+    for intervention in interventions:
+        label = getattr(intervention, 'label', None) or getattr(intervention, '__name__', intervention.__class__.__name__)
+        counts[label] = counts.get(label, 0) + 1
+        names.append(label if counts[label] == 1 else f'{label} {counts[label]}')
+    return names
+
+
+def use_crn(sim):
+    '''
+    Give each process in the sim its own stream of random numbers each day. Must be
+    called before the sim is initialized.
+
+    Returns:
+        The sim, modified in place
+    '''
+    if sim.initialized:
+        errormsg = 'Common random numbers must be set up before the sim is initialized'
+        raise RuntimeError(errormsg)
+    install()
+    if any(isinstance(intervention, reseed) for intervention in sim['interventions']):
+        return sim # Already set up
+    interventions = []
+    for intervention,stream in zip(sim['interventions'], stream_names(sim['interventions'])):
+        interventions += [reseed(stream), intervention]
+    interventions += [reseed('transmission')] # After all the interventions, transmission is next
+    sim['interventions'] = interventions
+    sim['analyzers'] = sc.tolist(sim['analyzers']) + [reseed_next_day()]
+    return sim
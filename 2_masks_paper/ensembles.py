@@ -0,0 +1,227 @@
+'''
+Run seed ensembles of a single base sim without copying the whole sim once per seed.
+
+The base sim is handed to each worker process once (inherited directly when processes
+are forked); each worker then copies and reseeds it locally, and only the requested
+result arrays (or a summary of each run, e.g. its mismatch) are sent back to the parent.
+
+Rather than a fixed number of seeds, run_until_precise() keeps running batches of seeds
+until the confidence intervals of the means of chosen outputs (e.g. the peak of
+new_severe after data_end) are narrow enough, or a maximum number of seeds is reached,
+so low-variance scenarios stop early.
+'''
+
+import multiprocessing as mp
+import numpy as np
+import scipy.stats as sps
+import sciris as sc
+import covasim as cv
+import population as pop
+
+
+_base_sim = None # The frozen base sim held by each worker process
+_base_func = None # What each worker returns from a run sim, if not its results
+
+
+def init_worker(sim, func=None):
+    ''' Store the base sim, and the function applied to each run, in the worker process '''
+    global _base_sim, _base_func
+    _base_sim = sim
+    _base_func = func
+    return
+
+
+def get_results(sim, keys=None):
+    ''' Pull the values of the requested results out of a run sim, as an objdict of arrays '''
+    if keys is None:
+        keys = [k for k,res in sim.results.items() if isinstance(res, cv.Result)]
+    return sc.objdict({k:np.array(sim.results[k].values) for k in keys})
+
+
+def fit_mismatch(sim):
+    ''' A function for run_ensemble(): the mismatch of a run sim with its data '''
+    return sim.compute_fit().mismatch
+
+
+def shrink_sim(sim):
+    ''' A function for run_ensemble(): the run sim without its people, as MultiSim.run() keeps it '''
+    sim.shrink()
+    return sim
+
+
+def run_seed(seed, keys=None, sim=None, func=None):
+    ''' Copy the base sim, reseed it, run it, and return the seed and its results (or func(sim)) '''
+    if sim is None:
+        sim, func = _base_sim, _base_func
+    sim = pop.copy_sim(sim) # Any shared population arrays are referenced rather than copied
+    sim['rand_seed'] = seed
+    sim.set_seed()
+    sim.label = f'Sim {seed}'
+    sim.run()
+    if func is not None:
+        return seed, func(sim)
+    return seed, get_results(sim, keys=keys)
+
+
+def run_ensemble(sim, seeds, keys=None, n_cpus=None, ordered=False, func=None):
+    '''
+    Run the sim once per seed, yielding (seed, results), or (seed, func(sim)), as each run finishes.
+
+    Since only the results are returned, the parent never holds more than one set of
+    result arrays per seed, however many seeds are run.
+
+    Args:
+        sim     (Sim):  the base sim, e.g. from make_sim(); not modified
+        seeds   (list): the random seeds to run
+        keys    (list): the result keys to return (default: all)
+        n_cpus  (int):  number of worker processes (default: all available)
+        ordered (bool): yield the results in the order of the seeds rather than as they finish
+        func    (func): if given, applied to each run sim in its worker, and its output yielded instead of the results;
+                        e.g. fit_mismatch, or shrink_sim for the shrunken sims that MultiSim.run() would keep
+                        (must be picklable if processes are not forked)
+
+    **Example**::
+
+        s0 = make_sim(seed=1, beta=0.0079)
+        for seed, res in run_ensemble(s0, range(20), keys=['new_diagnoses', 'cum_deaths']):
+            print(seed, res.cum_deaths[-1])
+
+        msim = cv.MultiSim([sim for seed,sim in run_ensemble(s0, range(20), ordered=True, func=shrink_sim)])
+        msim.reduce()
+    '''
+    seeds = sc.promotetolist(seeds)
+    if n_cpus is None:
+        n_cpus = sc.cpu_count()
+    n_cpus = min(n_cpus, len(seeds))
+    if n_cpus <= 1: # Run in serial, no need for a pool
+        for seed in seeds:
+            yield run_seed(seed, keys=keys, sim=sim, func=func)
+        return
+
+    if 'fork' in mp.get_all_start_methods(): # Workers inherit the base sim without it being pickled
+        ctx = mp.get_context('fork')
+    else:
+        ctx = mp.get_context()
+    with ctx.Pool(processes=n_cpus, initializer=init_worker, initargs=(sim, func)) as pool:
+        tasks = [(seed, keys) for seed in seeds]
+        imap = pool.imap if ordered else pool.imap_unordered
+        for output in imap(_run_task, tasks):
+            yield output
+    return
+
+
+def _run_task(task):
+    ''' Unpack a task for the pool '''
+    seed, keys = task
+    return run_seed(seed, keys=keys)
+
+
+def result_values(results, key):
+    ''' The values of a result, from either a sim's results or the objdicts of arrays returned by run_seed() '''
+    res = results[key]
+    return np.asarray(getattr(res, 'values', res))
+
+
+def peak_after(key, day):
+    ''' An output function: the peak of a result after a day, e.g. peak_after('new_severe', sim.day(data_end)) '''
+    return lambda results: float(result_values(results, key)[day:].max())
+
+
+def change_after(key, day):
+    ''' An output function: the change in a cumulative result after a day, e.g. change_after('cum_deaths', sim.day(data_end)) '''
+    return lambda results: float(result_values(results, key)[-1] - result_values(results, key)[day])
+
+
+def half_width(values, conf=0.95):
+    ''' The half-width of the t confidence interval of the mean of the values '''
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n < 2:
+        return np.inf
+    return float(sps.t.ppf((1 + conf)/2, n - 1)*values.std(ddof=1)/np.sqrt(n))
+
+
+def check_precision(values, tol, relative=False, conf=0.95):
+    '''
+    Check whether the means of the outputs are known precisely enough.
+
+    Args:
+        values   (dict):  the values of each output over the seeds run so far
+        tol      (float/dict): the largest allowed half-width, for all outputs or for each
+        relative (bool):  whether tol is a fraction of the absolute value of each mean
+        conf     (float): the confidence level
+
+    Returns:
+        Whether every output is within its tolerance, and an objdict of the half-widths
+    '''
+    widths = sc.objdict()
+    precise = True
+    for name,vals in values.items():
+        widths[name] = half_width(vals, conf=conf)
+        limit = tol[name] if isinstance(tol, dict) else tol
+        if relative:
+            limit = limit*abs(np.mean(vals))
+        precise = precise and widths[name] <= limit
+    return precise, widths
+
+
+def run_until_precise(run_batch, outputs, tol, relative=False, conf=0.95, batch_size=None, min_seeds=5, max_seeds=50, start_seed=0, keep_runs=True, verbose=True):
+    '''
+    Run batches of seeds until the confidence interval half-width of the mean of every
+    output is within tol, or max_seeds have been run.
+
+    Args:
+        run_batch  (func):  takes a list of seeds, and returns a list of run sims, or of results (e.g. from run_seed())
+        outputs    (dict):  functions that take a sim's results and return a number, e.g. dict(deaths=change_after('cum_deaths', day))
+        tol        (float/dict): the largest allowed half-width, for all outputs or for each
+        relative   (bool):  whether tol is a fraction of the absolute value of each mean
+        conf       (float): the confidence level
+        batch_size (int):   the number of seeds per batch after the first min_seeds (default: min_seeds)
+        min_seeds  (int):   the number of seeds to run before checking
+        max_seeds  (int):   the most seeds to run; at least min_seeds
+        start_seed (int):   the first seed
+        keep_runs  (bool):  whether to keep every run, or only the values of the outputs
+        verbose    (bool):  whether to print progress
+
+    Returns:
+        An objdict of the seeds, the runs (if kept), the values of each output, their means and half-widths, and whether they converged
+
+    **Example**::
+
+        s0 = make_sim(seed=1, beta=0.0079)
+        day = s0.day(data_end)
+        outputs = dict(peak_severe=peak_after('new_severe', day), deaths=change_after('cum_deaths', day))
+        run_batch = lambda seeds: [res for seed,res in run_ensemble(s0, seeds, keys=['new_severe', 'cum_deaths'], ordered=True)]
+        ensemble = run_until_precise(run_batch, outputs, tol=0.05, relative=True)
+    '''
+    if batch_size is None: # Small and fixed, so the number of seeds run does not depend on the machine
+        batch_size = min_seeds
+    if not 1 <= min_seeds <= max_seeds or batch_size < 1:
+        errormsg = f'Need 1 <= min_seeds <= max_seeds and batch_size >= 1, not min_seeds={min_seeds}, max_seeds={max_seeds}, batch_size={batch_size}'
+        raise ValueError(errormsg)
+    seeds = []
+    runs = []
+    values = sc.objdict({name:[] for name in outputs.keys()})
+    precise = False
+    widths = sc.objdict()
+    while len(seeds) < max_seeds:
+        n_next = max(batch_size, min_seeds - len(seeds))
+        batch = list(range(start_seed + len(seeds), start_seed + min(len(seeds) + n_next, max_seeds)))
+        for run in run_batch(batch):
+            results = run.results if isinstance(run, cv.BaseSim) else run
+            for name,output in outputs.items():
+                values[name].append(output(results))
+            if keep_runs:
+                runs.append(run)
+        seeds += batch
+        precise, widths = check_precision(values, tol, relative=relative, conf=conf)
+        if verbose:
+            print(f'Ran {len(seeds)} seeds; half-widths: ' + ', '.join(f'{name}={width:0.4g}' for name,width in widths.items()))
+        if len(seeds) >= min_seeds and precise:
+            break
+    if not precise:
+        print(f'Warning: outputs not within tolerance after the maximum of {max_seeds} seeds')
+
+    means = sc.objdict({name:float(np.mean(vals)) for name,vals in values.items()})
+    values = sc.objdict({name:np.array(vals) for name,vals in values.items()})
+    return sc.objdict(seeds=seeds, runs=runs, outputs=values, means=means, half_widths=widths, converged=precise)
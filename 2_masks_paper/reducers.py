@@ -0,0 +1,260 @@
+'''
+Reduce the results of many sims to a median (or mean) and bounds one sim at a time, as
+MultiSim.reduce() does, but without keeping every sim in memory.
+
+For each result, the reducer keeps a running mean and variance (exact, using Welford's
+method) and a quantile sketch. The sketch keeps every value until it has k of them, so
+for up to k sims the quantiles are exactly those of MultiSim.reduce(). Beyond that, it
+works like a KLL sketch: whenever a level holds more than k values, they are sorted and
+every other one is promoted to the next level with double the weight, so the memory
+used grows only with log(n_sims), and the rank error is roughly log2(n_sims/k)/k.
+
+Since every sim contributes one value per day, the sketch for a result is the same for
+every day, so each level is stored as a single (n_values, npts) array and sorted along
+the first axis.
+
+Reducers built in different processes (e.g. over different sims of a sweep) can be
+merged, and give the same result as one reducer over all the sims (exactly for the mean
+and variance, and up to the sketch error for the quantiles).
+
+**Example**::
+
+    reducer = result_reducer(quantiles=[0.25, 0.75])
+    for filename in sim_files:
+        reducer.add(cv.load(filename))
+    results = reducer.results() # Same structure as msim.results after msim.reduce()
+    results['new_infections'].low
+'''
+
+import numpy as np
+import sciris as sc
+import covasim as cv
+
+
+class stream_stats(sc.prettyobj):
+    ''' Running count, mean, and sum of squared deviations of arrays of the same shape '''
+
+    def __init__(self):
+        self.n    = 0
+        self.mean = None
+        self.m2   = None
+        return
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if self.mean is None:
+            self.mean = np.zeros(values.shape)
+            self.m2   = np.zeros(values.shape)
+        self.n += 1
+        delta = values - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(values - self.mean)
+        return
+
+    def merge(self, other):
+        ''' Combine with another set of stats (Chan et al.'s parallel algorithm) '''
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.n/n
+        self.m2 = self.m2 + other.m2 + delta**2*self.n*other.n/n
+        self.n = n
+        return self
+
+    @property
+    def std(self):
+        ''' The population standard deviation, as np.std() '''
+        return np.sqrt(self.m2/self.n)
+
+
+class quantile_sketch(sc.prettyobj):
+    '''
+    Mergeable quantile sketch for arrays of the same shape, one quantile estimate per element.
+
+    Args:
+        k (int): the number of values each level can hold before it is compacted; quantiles are exact for up to k values
+    '''
+
+    def __init__(self, k=200):
+        self.k       = k
+        self.levels  = [] # For each level, a list of arrays, each with a leading axis of values
+        self.parity  = [] # Alternates which half of each level is kept, so the compactions are unbiased
+        self.n       = 0
+        return
+
+    def _level(self, h):
+        while len(self.levels) <= h:
+            self.levels.append([])
+            self.parity.append(0)
+        return self.levels[h]
+
+    def add(self, values):
+        self._level(0).append(np.asarray(values, dtype=float)[None])
+        self.n += 1
+        self._compact()
+        return
+
+    def merge(self, other):
+        ''' Add the values of another sketch to this one '''
+        for h,level in enumerate(other.levels):
+            self._level(h).extend(level)
+        self.n += other.n
+        self._compact()
+        return self
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            n_level = sum(len(arr) for arr in self.levels[h])
+            if n_level > self.k:
+                values = np.sort(np.concatenate(self.levels[h]), axis=0)
+                if len(values) % 2: # Keep one value back if odd, so the total weight is unchanged
+                    self.levels[h] = [values[-1:]]
+                    values = values[:-1]
+                else:
+                    self.levels[h] = []
+                self._level(h+1).append(values[self.parity[h]::2])
+                self.parity[h] = 1 - self.parity[h]
+            h += 1
+        return
+
+    @property
+    def exact(self):
+        ''' Whether no values have been compacted yet, so the quantiles are exact '''
+        return len(self.levels) <= 1 or not any(len(level) for level in self.levels[1:])
+
+    def quantile(self, q):
+        ''' Estimate the q-th quantile of each element, interpolating like np.quantile() '''
+        values = np.concatenate([arr for level in self.levels for arr in level])
+        if self.exact:
+            return np.quantile(values, q=q, axis=0)
+        weights = np.concatenate([np.full(len(arr), 2.0**h) for h,level in enumerate(self.levels) for arr in level])
+        order = np.argsort(values, axis=0)
+        values = np.take_along_axis(values, order, axis=0)
+        weights = weights[order]
+        cum = np.cumsum(weights, axis=0)
+        # Each value stands for the ranks it covers; use the middle one, on the same 0..n-1 scale as np.quantile()
+        ranks = (cum - weights/2 - 0.5)/(cum[-1] - 1)
+        ranks = np.maximum.accumulate(ranks, axis=0) # Guard against rounding
+        upper = np.clip((ranks < q).sum(axis=0, keepdims=True), 1, len(values)-1) # Index of the first value at or above q
+        r0, r1 = np.take_along_axis(ranks, upper-1, axis=0)[0], np.take_along_axis(ranks, upper, axis=0)[0]
+        v0, v1 = np.take_along_axis(values, upper-1, axis=0)[0], np.take_along_axis(values, upper, axis=0)[0]
+        frac = np.clip(np.divide(q - r0, r1 - r0, out=np.zeros_like(r0), where=r1 > r0), 0, 1)
+        return v0 + frac*(v1 - v0)
+
+
+class result_reducer(sc.prettyobj):
+    '''
+    Reduce sims one at a time to the same values/low/high results as MultiSim.reduce().
+
+    Args:
+        keys      (list):      the results to reduce (default: all, including the variant results)
+        quantiles (list/dict): the low and high quantiles, e.g. [0.1, 0.9] (default: as in MultiSim.reduce())
+        use_mean  (bool):      use the mean and bounds*standard deviation rather than the median and quantiles
+        bounds    (float):     the multiplier on the standard deviation if use_mean=True
+        k         (int):       the size of each level of the quantile sketches; quantiles are exact for up to k sims
+    '''
+
+    def __init__(self, keys=None, quantiles=None, use_mean=False, bounds=None, k=200):
+        if quantiles is None:
+            quantiles = cv.make_metapars()['quantiles']
+        if not isinstance(quantiles, dict):
+            quantiles = {'low':float(quantiles[0]), 'high':float(quantiles[1])}
+        self.keys      = keys
+        self.quantiles = quantiles
+        self.use_mean  = use_mean
+        self.bounds    = 2 if bounds is None else bounds
+        self.k         = k
+        self.n_sims    = 0
+        self.names     = {}
+        self.stats     = {}
+        self.sketches  = {}
+        return
+
+    def _wanted(self, key):
+        return self.keys is None or key in self.keys
+
+    def add_values(self, key, values, name=None):
+        ''' Add one sim's values of one result, e.g. from a result_sink record '''
+        if key not in self.stats:
+            self.stats[key]    = stream_stats()
+            self.sketches[key] = quantile_sketch(k=self.k)
+            self.names[key]    = name if name is not None else key
+        if self.use_mean:
+            self.stats[key].add(values)
+        else:
+            self.sketches[key].add(values)
+        return
+
+    def add(self, sim):
+        ''' Add a sim (or a lazy_sim from an archive) '''
+        for key in sim.results.keys():
+            res = sim.results[key]
+            if key == 'variant':
+                for vkey in res.keys():
+                    if self._wanted(vkey):
+                        self.add_values(('variant', vkey), res[vkey].values, name=res[vkey].name)
+            elif hasattr(res, 'values') and hasattr(res, 'name') and self._wanted(key):
+                self.add_values(key, res.values, name=res.name)
+        self.n_sims += 1
+        return
+
+    def merge(self, other):
+        ''' Merge another reducer, e.g. from another worker, into this one '''
+        for key in other.stats:
+            if key not in self.stats:
+                self.stats[key]    = stream_stats()
+                self.sketches[key] = quantile_sketch(k=self.k)
+                self.names[key]    = other.names[key]
+            self.stats[key].merge(other.stats[key])
+            self.sketches[key].merge(other.sketches[key])
+        self.n_sims += other.n_sims
+        return self
+
+    def reduce_values(self, key):
+        ''' Return the values, low, and high for one result '''
+        if self.use_mean:
+            stats = self.stats[key]
+            return dict(values=stats.mean, low=stats.mean - self.bounds*stats.std, high=stats.mean + self.bounds*stats.std)
+        sketch = self.sketches[key]
+        return dict(values=sketch.quantile(0.5), low=sketch.quantile(self.quantiles['low']), high=sketch.quantile(self.quantiles['high']))
+
+    def results(self):
+        '''
+        Return the reduced results as cv.Result objects, with the variant results under
+        'variant', i.e. the same structure as msim.results after msim.reduce()
+        '''
+        results = sc.objdict()
+        variant = sc.objdict()
+        for key in self.stats:
+            reduced = self.reduce_values(key)
+            target, rkey = (variant, key[1]) if isinstance(key, tuple) else (results, key)
+            res = cv.Result(name=self.names[key], npts=reduced['values'].shape[-1])
+            res.values = reduced['values']
+            res.low    = reduced['low']
+            res.high   = reduced['high']
+            target[rkey] = res
+        if len(variant):
+            results['variant'] = variant
+        return results
+
+
+def reduce_sims(sims, **kwargs):
+    ''' Reduce a list of sims (or a MultiSim), e.g. as one worker's share of a parallel reduction '''
+    reducer = result_reducer(**kwargs)
+    for sim in (sims.sims if isinstance(sims, cv.MultiSim) else sims):
+        reducer.add(sim)
+    return reducer
+
+
+def merge_reducers(reducers):
+    ''' Merge reducers from several workers into one '''
+    reducers = list(reducers)
+    out = reducers[0]
+    for reducer in reducers[1:]:
+        out.merge(reducer)
+    return out
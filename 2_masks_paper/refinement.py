@@ -0,0 +1,152 @@
+'''
+Fill a heatmap grid adaptively: start with a coarse lattice of cells, and only run the
+cells in between where the outcomes change most or cross a threshold.
+
+The grid is divided into rectangles with corners on the coarse lattice. In each round,
+a rectangle is split into four (at the midpoints of its sides) if, for any output, the
+values at its corners straddle a threshold (e.g. R=1 for epidemic control), or if
+bilinear interpolation is not yet good enough there. For the coarse rectangles, that
+means the values at their corners differ by more than tol times the output's range over
+the cells run so far; after a rectangle is split, its children are only split again if
+the new cells differed from the interpolation between its corners by more than tol
+times the range (as for the hierarchical surpluses of an adaptive sparse grid).
+
+All the new cells from a round are run as one batch. Rectangles that are never split are
+filled in by bilinear interpolation from their corners. This puts the runs along
+contours and curved regions, and leaves the flat regions far from them coarse.
+
+**Example**::
+
+    refined = refine_grid(run_cells, shape=(41, 41), step=8, thresholds=dict(r_eff=1), tol=0.05)
+    sweep_summary = {key:grid.tolist() for key,grid in refined.grids.items()}
+'''
+
+import numpy as np
+import sciris as sc
+import designs as ds
+
+
+def lattice(n, step):
+    ''' The coarse indices along an axis of n points, including both ends '''
+    inds = list(range(0, n, step))
+    if inds[-1] != n - 1:
+        inds.append(n - 1)
+    return inds
+
+
+def corners(rect):
+    i0, i1, j0, j1 = rect
+    return [(i0, j0), (i0, j1), (i1, j0), (i1, j1)]
+
+
+def split(rect):
+    ''' Split a rectangle at the midpoints of its sides (only along sides longer than one cell) '''
+    i0, i1, j0, j1 = rect
+    isplit = [(i0, (i0+i1)//2), ((i0+i1)//2, i1)] if i1 - i0 > 1 else [(i0, i1)]
+    jsplit = [(j0, (j0+j1)//2), ((j0+j1)//2, j1)] if j1 - j0 > 1 else [(j0, j1)]
+    return [(a, b, c, d) for a,b in isplit for c,d in jsplit]
+
+
+def bilinear(rect, values, key, i, j):
+    ''' Interpolate an output at (i, j) from the corners of a rectangle '''
+    i0, i1, j0, j1 = rect
+    u = (np.asarray(i) - i0)/max(i1 - i0, 1)
+    w = (np.asarray(j) - j0)/max(j1 - j0, 1)
+    v00, v01, v10, v11 = [values[cell][key] for cell in corners(rect)]
+    return (1-u)*(1-w)*v00 + (1-u)*w*v01 + u*(1-w)*v10 + u*w*v11
+
+
+def surplus(rect, values, keys, ranges):
+    ''' The largest difference, relative to the range, between the new cells in a split rectangle and the interpolation between its corners '''
+    cells = {cell for child in split(rect) for cell in corners(child)} - set(corners(rect))
+    errs = [abs(values[cell][key] - bilinear(rect, values, key, *cell))/ranges[key] for cell in cells for key in keys if ranges[key] > 0]
+    return max(errs, default=0)
+
+
+def needs_refining(rect, values, keys, thresholds, ranges, tol, parent_surplus=None):
+    '''
+    Whether the outputs at the corners of a rectangle straddle a threshold, or it is not
+    yet well interpolated: its parent's surplus is more than tol, or, for the coarse
+    rectangles, its corners differ by more than tol of the range
+    '''
+    if rect[1] - rect[0] <= 1 and rect[3] - rect[2] <= 1: # Nothing in between to run
+        return False
+    for key in keys:
+        vals = np.array([values[cell][key] for cell in corners(rect)], dtype=float)
+        if key in thresholds and vals.min() < thresholds[key] <= vals.max():
+            return True
+        if parent_surplus is None and ranges[key] > 0 and (vals.max() - vals.min()) > tol*ranges[key]:
+            return True
+    return parent_surplus is not None and parent_surplus > tol
+
+
+def refine_grid(evaluate, shape, step=8, thresholds=None, tol=0.05, keys=None, max_rounds=None):
+    '''
+    Run the cells of a 2D grid adaptively, and interpolate the rest.
+
+    Args:
+        evaluate   (func):  takes a list of cells (tuples of indices) and returns a dict of {cell: {output: value}}
+        shape      (tuple): the number of points along each axis of the grid, e.g. (41, 41)
+        step       (int):   the spacing of the initial coarse lattice
+        thresholds (dict):  refine wherever an output crosses its threshold, e.g. dict(r_eff=1)
+        tol        (float): refine wherever interpolation is off by more than this fraction of an output's range
+        keys       (list):  the outputs to check (default: all those returned by evaluate)
+        max_rounds (int):   the maximum number of rounds of refinement (default: until nothing more needs refining)
+
+    Returns:
+        An objdict of the grids of each output, the cells that were run, and the fraction of the grid that was run
+    '''
+    thresholds = sc.mergedicts(thresholds)
+    ni, nj = shape
+    rects = [(i0, i1, j0, j1) for i0,i1 in zip(lattice(ni, step)[:-1], lattice(ni, step)[1:])
+                              for j0,j1 in zip(lattice(nj, step)[:-1], lattice(nj, step)[1:])]
+    surpluses = [None]*len(rects)
+    values = {}
+    leaves = []
+
+    def run(cells):
+        cells = sorted(set(cells) - set(values))
+        if cells:
+            values.update(evaluate(cells))
+        return len(cells)
+
+    def output_ranges():
+        return {key:np.ptp([v[key] for v in values.values()]) for key in keys}
+
+    run([cell for rect in rects for cell in corners(rect)])
+    if keys is None:
+        keys = list(next(iter(values.values())).keys())
+    ranges = output_ranges()
+    n_round = 0
+    while rects and (max_rounds is None or n_round < max_rounds):
+        refine = []
+        for rect,parent_surplus in zip(rects, surpluses):
+            (refine if needs_refining(rect, values, keys, thresholds, ranges, tol, parent_surplus) else leaves).append(rect)
+        rects, surpluses = [], []
+        if not refine:
+            break
+        n_round += 1
+        n_new = run([cell for rect in refine for child in split(rect) for cell in corners(child)])
+        ranges = output_ranges()
+        for rect in refine:
+            children = split(rect)
+            rects += children
+            surpluses += [surplus(rect, values, keys, ranges)]*len(children)
+        print(f'Refinement round {n_round}: split {len(refine)} rectangles and ran {n_new} new cells ({len(values)} of {ni*nj} so far)')
+    leaves += rects
+
+    # Fill in the grids: the cells that were run, then bilinear interpolation within each unsplit rectangle
+    grids = {key:np.full(shape, np.nan) for key in keys}
+    for cell,vals in values.items():
+        for key in keys:
+            grids[key][cell] = vals[key]
+    for rect in leaves:
+        i0, i1, j0, j1 = rect
+        ii, jj = np.meshgrid(np.arange(i0, i1+1), np.arange(j0, j1+1), indexing='ij')
+        for key,grid in grids.items():
+            block = grid[i0:i1+1, j0:j1+1]
+            missing = np.isnan(block)
+            block[missing] = bilinear(rect, values, key, ii[missing], jj[missing])
+    grids = {key:ds.fill_grid(grid) for key,grid in grids.items()} # Should already be full, but just in case
+
+    return sc.objdict(grids=grids, cells=sorted(values), frac_run=len(values)/(ni*nj))
@@ -0,0 +1,203 @@
+'''
+Store the reduced results of each sim in a sweep as it finishes, rather than keeping
+every sim in memory until the end.
+
+Each worker writes one small record per sim, keyed by its sweep indices (e.g. draw and
+seed). The records can be compacted into a single columnar file, and summaries are
+computed by streaming over the records, so the whole ensemble is never held in memory.
+
+**Example**::
+
+    sink = result_sink('results/sweep', index_names=['draw', 'seed'])
+    sink.write([draw, seed], cum_deaths=sim.results['cum_deaths'][-1], new_infections=sim.results['new_infections'].values)
+    ...
+    means = sink.group_mean(by=['draw'])
+    bands = sink.group_reduce(by=['draw'], keys=['new_infections'], quantiles=[0.1, 0.9]) # bands.new_infections.low, etc
+'''
+
+import os
+import glob
+import numpy as np
+import sciris as sc
+import reducers as rd
+
+
+columns_file = 'columns.npz'
+index_prefix = 'index_'
+
+
+class result_sink(sc.prettyobj):
+    '''
+    Folder of per-sim results keyed by sweep indices.
+
+    Args:
+        folder      (str):  where to store the records
+        index_names (list): names of the sweep indices, e.g. ['draw', 'seed']
+    '''
+
+    def __init__(self, folder, index_names):
+        self.folder = folder
+        self.index_names = sc.promotetolist(index_names)
+        os.makedirs(folder, exist_ok=True)
+        return
+
+    def filename(self, inds):
+        inds = self._check_inds(inds)
+        return os.path.join(self.folder, 'record_' + '_'.join(str(i) for i in inds) + '.npz')
+
+    def _check_inds(self, inds):
+        inds = [int(i) for i in sc.promotetolist(inds)]
+        if len(inds) != len(self.index_names):
+            errormsg = f'Expecting {len(self.index_names)} indices ({self.index_names}), not {inds}'
+            raise ValueError(errormsg)
+        return inds
+
+    def write(self, inds, **values):
+        ''' Write the results of one sim; values can be scalars or arrays, but must have the same shapes for every sim '''
+        filename = self.filename(inds)
+        tmpfile = f'{filename}.{os.getpid()}.tmp.npz'
+        np.savez(tmpfile, **{k:np.asarray(v) for k,v in values.items()})
+        os.replace(tmpfile, filename) # Atomic, so a record is either complete or missing
+        return filename
+
+    def _record_files(self):
+        return sorted(glob.glob(os.path.join(self.folder, 'record_*.npz')))
+
+    def _parse_inds(self, filename):
+        name = os.path.basename(filename)[len('record_'):-len('.npz')]
+        return tuple(int(i) for i in name.split('_'))
+
+    def records(self, filenames=None, use_columns=True):
+        '''
+        Iterate over (inds, values) for every sim, whether compacted or not, loading one at a time.
+        Only the given record files (and the compacted records if use_columns) are read, if specified.
+        '''
+        columns_path = os.path.join(self.folder, columns_file)
+        if use_columns and os.path.isfile(columns_path):
+            with np.load(columns_path) as columns:
+                index = np.stack([columns[index_prefix+name] for name in self.index_names], axis=1)
+                keys = [k for k in columns.files if not k.startswith(index_prefix)]
+                data = {k:columns[k] for k in keys}
+                for r,inds in enumerate(index):
+                    yield tuple(inds.tolist()), {k:data[k][r] for k in keys}
+        for filename in (self._record_files() if filenames is None else filenames):
+            with np.load(filename) as values:
+                yield self._parse_inds(filename), {k:values[k] for k in values.files}
+
+    def written(self):
+        ''' Return the set of indices that have been written '''
+        return {inds for inds,_ in self.records()}
+
+    def columns(self, keys=None, filenames=None):
+        ''' Load every record (or the compacted records and the given record files) into an objdict of columns: one per index name, then one per value key '''
+        index = []
+        data = sc.objdict()
+        for inds,values in self.records(filenames=filenames):
+            index.append(inds)
+            for k in (keys if keys is not None else values.keys()):
+                data.setdefault(k, []).append(values[k])
+        out = sc.objdict()
+        index = np.array(index, dtype=int).reshape(-1, len(self.index_names))
+        for i,name in enumerate(self.index_names):
+            out[name] = index[:,i]
+        for k,vals in data.items():
+            out[k] = np.array(vals)
+        return out
+
+    def compact(self):
+        ''' Merge all the records into a single columnar file, then remove the individual records '''
+        filenames = self._record_files() # Only these are merged and removed, so records written meanwhile are kept
+        if not filenames:
+            return
+        columns = self.columns(filenames=filenames)
+        columns_path = os.path.join(self.folder, columns_file)
+        tmpfile = columns_path + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmpfile, **{(index_prefix+k if k in self.index_names else k):v for k,v in columns.items()})
+        os.replace(tmpfile, columns_path)
+        for filename in filenames:
+            os.remove(filename)
+        return columns_path
+
+    def group_mean(self, by, keys=None):
+        '''
+        Stream over the records, averaging each value over every index not in "by"
+        (e.g. over seeds). Only one running sum per group is kept in memory.
+
+        Returns:
+            An objdict with one column per index name in "by" and one per value key, sorted by group
+        '''
+        by = sc.promotetolist(by)
+        cols = [self.index_names.index(name) for name in by]
+        sums = {}
+        counts = {}
+        for inds,values in self.records():
+            group = tuple(inds[c] for c in cols)
+            if group not in sums:
+                sums[group] = {}
+                counts[group] = 0
+            for k in (keys if keys is not None else values.keys()):
+                sums[group][k] = sums[group].get(k, 0) + values[k].astype(float)
+            counts[group] += 1
+
+        groups = sorted(sums.keys())
+        out = sc.objdict()
+        for i,name in enumerate(by):
+            out[name] = np.array([g[i] for g in groups], dtype=int)
+        for k in (sums[groups[0]].keys() if groups else []):
+            out[k] = np.array([sums[g][k]/counts[g] for g in groups])
+        return out
+
+    def group_reduce(self, by, keys=None, n_cpus=1, **kwargs):
+        '''
+        Stream over the records, reducing each value over every index not in "by" (e.g. over
+        seeds) to a median and quantiles (or mean and standard deviation), as MultiSim.reduce()
+        does. Each group only keeps a reducers.result_reducer in memory. With n_cpus > 1, the
+        records are split between processes, and their reducers are merged.
+
+        Args:
+            by     (list): the index names to group by
+            keys   (list): the values to reduce (default: all)
+            n_cpus (int):  the number of processes
+            kwargs (dict): passed to reducers.result_reducer(), e.g. quantiles or use_mean
+
+        Returns:
+            An objdict with one column per index name in "by", and for each value key an objdict of values, low, and high, each with one row per group
+        '''
+        by = sc.promotetolist(by)
+        filenames = self._record_files()
+        n_parts = max(1, min(n_cpus, len(filenames)))
+        parts = [dict(filenames=filenames[i::n_parts], use_columns=(i == 0)) for i in range(n_parts)]
+        if n_parts > 1:
+            partials = sc.parallelize(_reduce_records, iterkwargs=parts, kwargs=dict(sink=self, by=by, keys=keys, kwargs=kwargs))
+        else:
+            partials = [_reduce_records(sink=self, by=by, keys=keys, kwargs=kwargs, **parts[0])]
+        reducers = {}
+        for partial in partials:
+            for group,reducer in partial.items():
+                if group in reducers:
+                    reducers[group].merge(reducer)
+                else:
+                    reducers[group] = reducer
+
+        groups = sorted(reducers.keys())
+        out = sc.objdict()
+        for i,name in enumerate(by):
+            out[name] = np.array([g[i] for g in groups], dtype=int)
+        for k in (reducers[groups[0]].stats.keys() if groups else []):
+            reduced = [reducers[g].reduce_values(k) for g in groups]
+            out[k] = sc.objdict({attr:np.array([r[attr] for r in reduced]) for attr in ['values', 'low', 'high']})
+        return out
+
+
+def _reduce_records(sink, by, keys, filenames, use_columns, kwargs):
+    ''' Reduce some of the records of a sink, with one reducer per group '''
+    cols = [sink.index_names.index(name) for name in by]
+    reducers = {}
+    for inds,values in sink.records(filenames=filenames, use_columns=use_columns):
+        group = tuple(inds[c] for c in cols)
+        if group not in reducers:
+            reducers[group] = rd.result_reducer(**kwargs)
+        for k in (keys if keys is not None else values.keys()):
+            reducers[group].add_values(k, values[k])
+        reducers[group].n_sims += 1
+    return reducers
@@ -3,6 +3,8 @@ import covasim as cv
 import covasim.parameters as cvp
 import pylab as pl
 import numpy as np
+import crn
+import datacache as dc
 
 
 ########################################################################
@@ -21,6 +23,7 @@ do_show = 0
 verbose = 1
 seed    = 1
 keep_people = 1 # Whether to keep people
+use_crn = 0 # Whether the scenarios share common random numbers, so their differences are less noisy
 to_plot = sc.objdict({
     'Daily infections': ['new_diagnoses'],
     'Daily hospitalisations': ['new_severe'],
@@ -112,7 +115,7 @@ for vx_scen in vx_scens:
 # Create the baseline simulation
 ########################################################################
 
-def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None, vx_scenario=None, end_day='2021-08-31', verbose=0):
+def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None, vx_scenario=None, end_day='2021-08-31', verbose=0, use_crn=False):
 
     # Set the parameters
     #total_pop    = 67.86e6 # UK population size
@@ -143,7 +146,7 @@ def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None,
         verbose      = verbose,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     #sim['prognoses']['sus_ORs'][0] = 0.5 # ages 0-10
     #sim['prognoses']['sus_ORs'][1] = 1.0 # ages 11-20
 
@@ -440,6 +443,9 @@ def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None,
     for intervention in sim['interventions']:
         intervention.do_plot = False
 
+    if use_crn: # Must be set up before the sim is initialized
+        crn.use_crn(sim)
+
     sim.initialize()
 
     return sim
@@ -494,7 +500,7 @@ if __name__ == '__main__':
                 print(f'Beginning scenario: {scenkey}')
                 print('---------------\n')
                 sc.blank()
-                s0 = make_sim(seed=1, beta=0.0078, end_day='2021-12-31', calibration=False, scenario=scenarios[0], vx_scenario=vx_scenario, verbose=0.1)
+                s0 = make_sim(seed=1, beta=0.0078, end_day='2021-12-31', calibration=False, scenario=scenarios[0], vx_scenario=vx_scenario, verbose=0.1, use_crn=use_crn) # Each copy uses the streams for its own seed
                 #s0.run(until='2021-12-31')
                 sims = []
 
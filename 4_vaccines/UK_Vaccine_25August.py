@@ -6,6 +6,7 @@ import sciris as sc
 import covasim as cv
 import pylab as pl
 import numpy as np
+import datacache as dc
 pl.switch_backend('agg')
 
 # Check version
@@ -60,7 +61,7 @@ pars = sc.objdict(
 
 # Create the baseline simulation
 #change this to change kids susceptibility; currently same as adults
-sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
 sim['prognoses']['sus_ORs'][0] = 1.0 # ages 0-10
 sim['prognoses']['sus_ORs'][1] = 1.0 # ages 10-20
 
@@ -6,6 +6,8 @@ import pylab as pl
 import numpy as np
 import matplotlib as mplt
 import utils_vac
+import datacache as dc
+import ensembles as ens
 
 ########################################################################
 # Settings and initialisation
@@ -91,7 +93,7 @@ def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None,
         #rel_death_prob=1.15,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     sim['prognoses']['sus_ORs'][0] = 1.0 # ages 20-30
     sim['prognoses']['sus_ORs'][1] = 1.0 # ages 20-30
 
@@ -468,15 +470,8 @@ if __name__ == '__main__':
     # Quick calibration
     if whattorun=='quickfit':
         s0 = make_sim(seed=1, beta=0.008, end_day='2021-06-20', verbose=0.1)
-        sims = []
-        for seed in range(4):
-            sim = s0.copy()
-            sim['rand_seed'] = seed
-            sim.set_seed()
-            sim.label = f"Sim {seed}"
-            sims.append(sim)
-        msim = cv.MultiSim(sims)
-        msim.run()
+        sims = [sim for seed,sim in ens.run_ensemble(s0, range(4), ordered=True, func=ens.shrink_sim)]
+        msim = cv.MultiSim(sims) # Already run
         #msim.reduce()
         msim.reduce(quantiles = [0.25,0.75]) 
         #sim.to_excel('my-sim.xlsx')
@@ -0,0 +1,118 @@
+'''
+Build a population once and share it, copy-on-write, between sims and worker processes.
+
+The static parts of the people -- uid, age, sex and the contact layers -- are saved as
+.npy files in a folder and memory-mapped by every sim that uses them, so all processes
+share the same physical pages. The maps are copy-on-write rather than read-only, since
+Covasim's compiled functions only accept writeable arrays, but these arrays are never
+written during a run. Only the per-run state (infection states, dates, immunity, etc.)
+is allocated separately for each sim.
+
+A saved population is the one the sim would have made itself with its seed. To keep the
+variation in the population between seeds, save one per seed with seed_folder(); sims
+given the same folder share the same population, as copies of one initialized sim do.
+
+**Example**::
+
+    for seed in seeds: # Once, in the parent
+        save_population(make_sim(seed=seed, beta=0.0079), seed_folder('population', seed))
+    ...
+    sim = make_sim(seed=seed, beta=0.0079)
+    initialize(sim, seed_folder('population', seed)) # Instead of sim.initialize(), in each worker
+'''
+
+import os
+import copy
+import shutil
+import numpy as np
+import sciris as sc
+import covasim as cv
+
+
+person_keys = ['uid', 'age', 'sex'] # Per-person arrays that do not change during a run
+layer_cols  = ['p1', 'p2', 'beta'] # Columns of each contact layer
+check_pars  = ['pop_size', 'pop_type', 'location'] # Parameters that must match between the population and the sim
+meta_file   = 'population.json'
+
+
+def seed_folder(folder, seed):
+    ''' The subfolder for the population of one seed '''
+    return os.path.join(folder, f'seed{seed}')
+
+
+def save_population(sim, folder):
+    ''' Create the people for the sim (if needed) and save their static arrays to the folder '''
+    if not sim.people: # Make the people on a copy, so the sim itself is left uninitialized
+        sim = sim.copy()
+        sim.set_seed() # As sim.initialize() does, so the people are the same as the sim would make itself
+        sim.init_people(verbose=0)
+    people = sim.people
+
+    # Write to a temporary folder first, so a partially written population is never loaded
+    tmp_folder = folder.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for key in person_keys:
+        np.save(os.path.join(tmp_folder, f'{key}.npy'), people[key])
+    for lkey,layer in people.contacts.items():
+        for col in layer_cols:
+            np.save(os.path.join(tmp_folder, f'contacts_{lkey}_{col}.npy'), layer[col])
+    meta = {k:sim[k] for k in check_pars}
+    meta['layer_keys'] = list(people.contacts.keys())
+    meta['rand_seed'] = sim['rand_seed']
+    sc.savejson(os.path.join(tmp_folder, meta_file), meta)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+    return folder
+
+
+def load_popdict(folder, sim=None):
+    ''' Memory-map a saved population (copy-on-write) as a popdict, checking it matches the sim if supplied '''
+    meta = sc.loadjson(os.path.join(folder, meta_file))
+    if sim is not None:
+        mismatches = {k:(sim[k], meta[k]) for k in check_pars if sim[k] != meta[k]}
+        if mismatches:
+            errormsg = f'Population in "{folder}" does not match the sim (sim, population): {mismatches}'
+            raise ValueError(errormsg)
+
+    popdict = {key:np.load(os.path.join(folder, f'{key}.npy'), mmap_mode='c') for key in person_keys}
+    popdict['contacts'] = {}
+    for lkey in meta['layer_keys']:
+        popdict['contacts'][lkey] = {col:np.load(os.path.join(folder, f'contacts_{lkey}_{col}.npy'), mmap_mode='c') for col in layer_cols}
+    return popdict
+
+
+def initialize(sim, folder, **kwargs):
+    '''
+    Initialize the sim with the saved population, then point its static arrays at the
+    shared memory maps so the private copies made by cv.People() can be freed.
+    '''
+    popdict = load_popdict(folder, sim=sim)
+    sim.initialize(popdict=popdict, **kwargs)
+    people = sim.people
+    for key in person_keys:
+        people[key] = popdict[key]
+    for lkey,layer in people.contacts.items():
+        for col in layer_cols:
+            layer[col] = popdict['contacts'][lkey][col]
+    return sim
+
+
+def shared_arrays(sim):
+    ''' Return the shared memory-mapped arrays used by the sim's people '''
+    arrays = []
+    if sim.people:
+        candidates = [sim.people[key] for key in person_keys]
+        for layer in sim.people.contacts.values():
+            candidates += [layer[col] for col in layer_cols]
+        arrays = [arr for arr in candidates if isinstance(arr, np.memmap)]
+    return arrays
+
+
+def copy_sim(sim):
+    ''' Deep copy the sim, but keep referring to (rather than copying) any shared population arrays '''
+    memo = {id(arr):arr for arr in shared_arrays(sim)}
+    return copy.deepcopy(sim, memo)
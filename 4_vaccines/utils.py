@@ -8,6 +8,19 @@ from covasim import utils as cvu
 from covasim.interventions import process_days, find_day, get_subtargets, process_daily_data
 
 
+def count_doses(sim, vacc_class):
+    ''' Count the doses given on each day by interventions of the given class; returns an (npts, n_doses) array '''
+    npts = sim['n_days'] + 1
+    counts = np.zeros((npts, 2), dtype=cvd.default_int)
+    for intv in sim['interventions']:
+        if isinstance(intv, vacc_class):
+            for dose in range(intv.dose_dates.shape[1]):
+                days = intv.dose_dates[:, dose]
+                days = days[np.isfinite(days)].astype(cvd.default_int)
+                counts[:, dose] += np.bincount(days, minlength=npts)[:npts]
+    return counts
+
+
 class record_doses(cv.Analyzer):
     def __init__(self, vacc_class=None, **kwargs):
         super().__init__(**kwargs)
@@ -23,13 +36,8 @@ class record_doses(cv.Analyzer):
 
         # apply on last day
         if sim.t == sim['n_days']:
-            for intv in sim['interventions']:
-                if isinstance(intv, self.vacc_class):
-                    for entry in intv.vaccination_dates:
-                        if len(entry) > 0:
-                            for day in entry:
-                                if day <= sim['n_days']:
-                                    sim.results['new_doses'].values[day] += 1
+            dose_counts = count_doses(sim, self.vacc_class)
+            sim.results['new_doses'].values[:] += dose_counts.sum(axis=1)
 
         return
 
@@ -52,78 +60,88 @@ class record_dose_flows(cv.Analyzer):
     def apply(self, sim):
         # apply on last day
         if sim.t == sim['n_days']:
-            for intv in sim['interventions']:
-                if isinstance(intv, self.vacc_class):
-                    dose_counter = np.zeros((sim['n_days'] + 1, 3), dtype=cv.default_int)
-                    dose_counter[0, 0] = sim.n
-                    for intv in sim['interventions']:
-                        if isinstance(intv, self.vacc_class):
-                            for person in intv.vaccination_dates:
-                                for ix, entry in enumerate(person):
-                                    dose_counter[entry, ix] += -1
-                                    dose_counter[entry, ix + 1] += 1
-                    dose_counter = np.cumsum(dose_counter, axis=0)
-
-                    sim.results['n_dose_0'].values[:] += dose_counter[:, 0]
-                    sim.results['n_dose_1'].values[:] += dose_counter[:, 1]
-                    sim.results['n_dose_2'].values[:] += dose_counter[:, 2]
+            dose_counts = count_doses(sim, self.vacc_class)
+            dose_counter = np.zeros((sim['n_days'] + 1, 3), dtype=cv.default_int)
+            dose_counter[0, 0] = sim.n
+            dose_counter[:, :-1] -= dose_counts # People leave the previous dose state...
+            dose_counter[:, 1:] += dose_counts # ...and enter the next one
+            dose_counter = np.cumsum(dose_counter, axis=0)
+
+            sim.results['n_dose_0'].values[:] = dose_counter[:, 0]
+            sim.results['n_dose_1'].values[:] = dose_counter[:, 1]
+            sim.results['n_dose_2'].values[:] = dose_counter[:, 2]
 
         return
 
-class dose_scheduler(cv.Intervention):
+class day_scheduler(cv.Intervention):
     '''
-    Scheduler for doses
+    Day-indexed queue of changes to people attributes, e.g. rel_trans or symp_prob
 
-    To use update scheduler dictionary with key for each day and value list of {'inds', and 'rel_sys', etc}
+    To use call add(day, inds, rel_trans=vals, ...). Changes registered for the same day and attribute,
+    including by different interventions, are merged so that each day is applied with one write per attribute.
     '''
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)  # Initialize the Intervention object
         self._store_args()  # Store the input arguments so the intervention can be recreated
-        self.scheduler = dict()
+        self.queue = None
 
     def initialize(self, sim):
+        self.queue = [None]*sim.npts # One slot per day, holding {attr: (inds, vals)}
         self.initialized = True
         return
 
+    def add(self, day, inds, **kwargs):
+        ''' Schedule the supplied attribute values for people inds on the given day '''
+        if day >= len(self.queue): # Beyond the end of the sim, so would never be applied
+            return
+        if self.queue[day] is None:
+            self.queue[day] = dict()
+        events = self.queue[day]
+        for k, v in kwargs.items():
+            v = np.broadcast_to(v, len(inds))
+            if k in events:
+                old_inds, old_vals = events[k]
+                events[k] = (np.concatenate([old_inds, inds]), np.concatenate([old_vals, v]))
+            else:
+                events[k] = (np.array(inds, dtype=cvd.default_int), np.array(v, dtype=cvd.default_float))
+        return
+
+    def update(self, arr, inds, vals):
+        ''' How scheduled values are applied to a people attribute; set by subclasses '''
+        raise NotImplementedError
+
     def apply(self, sim):
-        if sim.t in self.scheduler.keys():
-            for schedule in self.scheduler[sim.t]:
-                # pop out inds
-                vacc_inds = schedule.pop('inds', np.array([], cvd.default_int))
-                # look through rel factors
-                for k, v in schedule.items():
-                    sim.people[k][vacc_inds] = v
+        events = self.queue[sim.t]
+        if events is not None:
+            for k, (inds, vals) in events.items():
+                self.update(sim.people[k], inds, vals)
             # clean up
-            self.scheduler.pop(sim.t)
+            self.queue[sim.t] = None
         return
 
-class schedule_vaccine_effect(cv.Intervention):
-    '''
-    Scheduler for vaccine effect
 
-    To use update scheduler dictionary with key for each day and value list of {'inds', and 'rel_sys', etc}
+class dose_scheduler(day_scheduler):
     '''
+    Scheduler for doses
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)  # Initialize the Intervention object
-        self._store_args()  # Store the input arguments so the intervention can be recreated
-        self.scheduler = dict()
+    Scheduled values replace the current attribute values, e.g. add(day, inds, rel_trans=vals, symp_prob=vals)
+    '''
 
-    def initialize(self, sim):
-        self.initialized = True
+    def update(self, arr, inds, vals):
+        arr[inds] = vals
         return
 
-    def apply(self, sim):
-        if sim.t in self.scheduler.keys():
-            for schedule in self.scheduler[sim.t]:
-                # pop out inds
-                vacc_inds = schedule.pop('inds', np.array([], cvd.default_int))
-                # look through rel factors
-                for k, v in schedule.items():
-                    sim.people[k][vacc_inds] *= v
-            # clean up
-            self.scheduler.pop(sim.t)
+
+class schedule_vaccine_effect(day_scheduler):
+    '''
+    Scheduler for vaccine effect
+
+    Scheduled values multiply the current attribute values, e.g. add(day, inds, rel_sus=factors)
+    '''
+
+    def update(self, arr, inds, vals):
+        np.multiply.at(arr, inds, vals) # Unbuffered, so people scheduled more than once get every factor
         return
 
 class two_dose_daily_delayed(cv.Intervention):
@@ -184,7 +202,7 @@ class two_dose_daily_delayed(cv.Intervention):
         # Initialize vaccine info
         self.vaccinations = np.zeros(sim.n, dtype=cvd.default_int)
         self.vaccine_take = np.zeros(sim.n, dtype=np.bool)
-        self.vaccination_dates = [[] for p in range(sim.n)]  # Store the dates when people are vaccinated
+        self.dose_dates   = np.full((sim.n, 2), np.nan) # Store the dates when people receive their first and second doses
         sim.results['new_doses'] = cvb.Result(name='New Doses', npts=sim['n_days']+1, color='#ff00ff')
         self.initialized = True
 
@@ -223,10 +241,11 @@ class two_dose_daily_delayed(cv.Intervention):
         # first dose:
         vacc_probs[self.vaccinations == 0] *= self.dose_priority[0]
         # time between first and second dose:
-        no_dose = [sim.t < (d[0] + self.delay) if len(d) > 0 else False for d in self.vaccination_dates]
+        next_dose_day = self.dose_dates[:, 0] + self.delay # NaN for people with no doses, so both comparisons are False
+        no_dose = sim.t < next_dose_day
         vacc_probs[no_dose] *= 0
         # time available for second dose:
-        second_dose = [sim.t >= (d[0] + self.delay) if len(d) > 0 else False for d in self.vaccination_dates]
+        second_dose = sim.t >= next_dose_day
         vacc_probs[second_dose] *= self.dose_priority[1]
 
         # Don't give dose 2 people who have had more than 1
@@ -254,22 +273,24 @@ class two_dose_daily_delayed(cv.Intervention):
         # schedule dose effect
         for intv in sim['interventions']:
             if isinstance(intv, dose_scheduler):
-                schedule = {'inds': vacc_take_inds, 'rel_trans':self.orig_rel_trans[vacc_take_inds]*rel_trans_eff,
-                                                         'symp_prob':self.orig_symp_prob[vacc_take_inds]*rel_symp_eff}
-                schedule_day = sim.t + self.dose_delay
-                if schedule_day not in intv.scheduler:
-                    intv.scheduler.update({schedule_day: [schedule]})
-                else:
-                    intv.scheduler[schedule_day].append(schedule)
+                intv.add(sim.t + self.dose_delay, vacc_take_inds,
+                         rel_trans=self.orig_rel_trans[vacc_take_inds]*rel_trans_eff,
+                         symp_prob=self.orig_symp_prob[vacc_take_inds]*rel_symp_eff)
 
+        self.dose_dates[all_vacc_inds, self.vaccinations[all_vacc_inds]] = sim.t
         self.vaccinations[all_vacc_inds] += 1
-        for v_ind in all_vacc_inds:
-            self.vaccination_dates[v_ind].append(sim.t)
 
         return
 
+    @property
+    def vaccination_dates(self):
+        ''' List of vaccination dates per person, as stored before the dose ledger was introduced '''
+        if self.dose_dates is None:
+            return None
+        return [row[:n].astype(int).tolist() for row, n in zip(self.dose_dates, self.vaccinations)]
+
     def shrink(self):
-        self.vaccination_dates = None
+        self.dose_dates = None
         self.vaccinations = None
         self.orig_rel_trans = None
         self.orig_symp_prob = None
@@ -7,6 +7,7 @@ import covasim as cv
 import pylab as pl
 import numpy as np
 import matplotlib as mplt
+import datacache as dc
 
 ########################################################################
 # Settings and initialisation
@@ -85,7 +86,7 @@ def make_sim(seed, beta, calibration=True, scenario=None, delta_beta=0.6, future
 #        rel_death_prob=1.5,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     sim['prognoses']['sus_ORs'][0] = 1.0 # ages 20-30
     sim['prognoses']['sus_ORs'][1] = 1.0 # ages 20-30
 
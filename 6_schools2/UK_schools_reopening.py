@@ -7,6 +7,9 @@ import covasim as cv
 import pylab as pl
 import numpy as np
 import matplotlib as mplt
+import screening as sr
+import datacache as dc
+import ensembles as ens
 
 ########################################################################
 # Settings and initialisation
@@ -23,6 +26,8 @@ do_show = 0
 verbose = 1
 seed    = 1
 n_runs = 200
+use_screening = 0 # Whether the full fit stops runs once their mismatch can no longer be below max_mismatch
+max_mismatch = 351.5 # Stopped runs are saved with the mismatch they had reached, a lower bound above this, so it must be above the threshold used by finialisefit
 to_plot = sc.objdict({
     'Cumulative diagnoses': ['cum_diagnoses'],
     'Cumulative infections': ['cum_infections'],
@@ -85,7 +90,7 @@ def make_sim(seed, beta, calibration=True, scenario=None, future_symp_test=None,
 #        rel_death_prob=1.5,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     sim['prognoses']['sus_ORs'][0] = 1.0 # ages 20-30
     sim['prognoses']['sus_ORs'][1] = 1.0 # ages 20-30
 
@@ -221,15 +226,8 @@ if __name__ == '__main__':
     # Quick calibration
     if whattorun=='quickfit':
         s0 = make_sim(seed=1, beta=0.0077, end_day=data_end, verbose=0.1)
-        sims = []
-        for seed in range(6):
-            sim = s0.copy()
-            sim['rand_seed'] = seed
-            sim.set_seed()
-            sim.label = f"Sim {seed}"
-            sims.append(sim)
-        msim = cv.MultiSim(sims)
-        msim.run()
+        sims = [sim for seed,sim in ens.run_ensemble(s0, range(6), ordered=True, func=ens.shrink_sim)]
+        msim = cv.MultiSim(sims) # Already run
         msim.reduce()
         if do_plot:
             msim.plot(to_plot=to_plot, do_save=True, do_show=False, fig_path=f'uk.png',
@@ -243,17 +241,12 @@ if __name__ == '__main__':
             print('---------------\n')
             print(f'Beta: {beta}... ')
             print('---------------\n')
+            if use_screening: # Mismatches above max_mismatch are only lower bounds
+                screen = sr.screen_seeds(sr.reseeded(make_sim, beta=beta, end_day=data_end), seeds=range(n_runs), max_mismatch=max_mismatch) # Every seed shares the population of seed 1, as in finialisefit
+                fitsummary.append(list(screen.mismatches))
+                continue
             s0 = make_sim(seed=1, beta=beta, end_day=data_end)
-            sims = []
-            for seed in range(n_runs):
-                sim = s0.copy()
-                sim['rand_seed'] = seed
-                sim.set_seed()
-                sim.label = f"Sim {seed}"
-                sims.append(sim)
-            msim = cv.MultiSim(sims)
-            msim.run()
-            fitsummary.append([sim.compute_fit().mismatch for sim in msim.sims])
+            fitsummary.append([mismatch for seed,mismatch in ens.run_ensemble(s0, range(n_runs), ordered=True, func=ens.fit_mismatch)])
 
         sc.saveobj(f'{resfolder}/fitsummary.obj',fitsummary)
 
@@ -1,6 +1,7 @@
 import covasim as cv
 import pandas as pd
 import sciris as sc
+import archive as ar
 import pylab as pl
 import numpy as np
 from matplotlib import ticker
@@ -107,7 +108,7 @@ msims = sc.odict()
 
 for scen in scenarios:
     filepath = f'{resfolder}/uk_sim_{scen}.obj'
-    msims[scen] = sc.loadobj(filepath)
+    msims[scen] = ar.lazy_msim(filepath) # Converted to an archive the first time, then only the results that are plotted are read
     sims[scen] = msims[scen].sims
     msims[scen].reduce()
 
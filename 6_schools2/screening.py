@@ -0,0 +1,281 @@
+'''
+Screen many seeds for the ones that fit the data best, stopping each run as soon as it
+can no longer be one of them.
+
+The default mismatch of sim.compute_fit() is a sum of non-negative terms, one for each
+day with data, each normalised by the largest data value, which is known before the run.
+It can therefore be accumulated as the sim runs (by running_fit), and the mismatch so far
+is a lower bound on the final mismatch. A run is stopped once its mismatch so far is
+worse than the cutoff:
+
+    - with keep (e.g. 0.01 for the best 1%), the cutoff is the worst mismatch among the
+      best runs completed so far that are needed to compute the keep quantile, so it only
+      falls as more runs complete;
+    - with max_mismatch, the cutoff is fixed.
+
+As in successive halving, most poor runs are stopped a fraction of the way through, but
+since the cutoff is only ever compared against lower bounds, the seeds selected are
+exactly those that running every seed to the end would select. Stopped runs report the
+mismatch they had reached, which is already worse than the cutoff.
+
+**Example**::
+
+    screen = screen_seeds(make_sim, seeds=range(3000), keep=0.01, kwargs=dict(end_day='2020-08-25'))
+    goodseeds = screen.goodseeds
+'''
+
+import numpy as np
+import sciris as sc
+import covasim as cv
+import multiprocessing as mp
+import concurrent.futures as cf
+from covasim import defaults as cvd
+
+
+class running_fit(cv.Analyzer):
+    '''
+    Accumulate the mismatch of sim.compute_fit() (with its default goodness-of-fit) day by
+    day as the sim runs, so that it can be checked, or followed, before the run finishes.
+
+    After the run, the mismatch is the same as sim.compute_fit(keys=keys, weights=weights)
+    gives for a sim that ends at end_day. The history holds the running mismatch at the end
+    of each day that has been run (NaN for the rest).
+
+    Args:
+        keys      (list): the results to fit, e.g. ['cum_deaths', 'new_diagnoses'] (default: as compute_fit(), the cumulative results that are in the data)
+        weights   (dict): the weight of each result (default: as compute_fit(), 10 for cum_deaths and 5 for cum_diagnoses)
+        start_day (str/int): the first day of data to fit (default: the start of the sim)
+        end_day   (str/int): the last day of data to fit, e.g. data_end (default: the end of the sim)
+        kwargs    (dict): passed to cv.Analyzer()
+
+    **Example**::
+
+        sim = cv.Sim(pars, datafile=data_path, analyzers=running_fit(keys=['cum_deaths', 'new_diagnoses'], end_day=data_end))
+        sim.run(until='2020-06-01')
+        print(sim.get_analyzer().mismatch)
+    '''
+
+    def __init__(self, keys=None, weights=None, start_day=None, end_day=None, **kwargs):
+        super().__init__(**kwargs) # Initialize the Analyzer object
+        self.keys       = keys
+        self.weights    = sc.mergedicts({'cum_deaths':10, 'cum_diagnoses':5}, weights)
+        self.start_day  = start_day
+        self.end_day    = end_day
+        self.mismatch   = 0.0
+        self.mismatches = {}
+        self.n_fitted   = 0 # The number of data points fitted so far
+        self.history    = None
+        return
+
+    def initialize(self, sim):
+        super().initialize()
+        if sim.data is None:
+            errormsg = 'The mismatch cannot be calculated without data'
+            raise RuntimeError(errormsg)
+        flows = [f'cum_{key}' for key in cvd.result_flows.keys()]
+        if self.keys is None:
+            self.keys = [key for key in flows if key in sim.data.columns]
+        unsupported = [key for key in self.keys if key not in flows and (key.startswith('cum_') or key not in sim.results or key == 'variant')]
+        if unsupported:
+            errormsg = f'Only the results updated each day, and the cumulative flows, can be fitted as the sim runs, not {unsupported}'
+            raise ValueError(errormsg)
+        missing = [key for key in self.keys if key not in sim.data.columns]
+        if missing:
+            errormsg = f'There is no data for {missing}'
+            raise ValueError(errormsg)
+        start = 0 if self.start_day is None else sim.day(self.start_day)
+        end = sim.npts - 1 if self.end_day is None else min(sim.day(self.end_day), sim.npts - 1)
+
+        # For each result, the data on each day of the window (NaN if none), and the normalisation used by cv.compute_gof()
+        self.data  = {}
+        self.norms = {}
+        self.cum   = {}
+        sim_days = {d:i for i,d in enumerate(sim.datevec.tolist())}
+        for key in self.keys:
+            series = sim.data[key]
+            self.data[key] = np.full(sim.npts, np.nan)
+            for date,datum in series.items():
+                if np.isfinite(datum) and date in sim_days and start <= sim_days[date] <= end:
+                    self.data[key][sim_days[date]] = datum
+            matched = self.data[key][np.isfinite(self.data[key])]
+            norm = np.abs(matched).max() if len(matched) else 0
+            self.norms[key] = norm if norm > 0 else 1.0
+            self.cum[key] = 0.0
+            self.mismatches[key] = 0.0
+        self.mismatch = 0.0
+        self.n_fitted = 0
+        self.history = np.full(sim.npts, np.nan)
+        return
+
+    def apply(self, sim):
+        t = sim.t
+        for key in self.keys:
+            if key.startswith('cum_'): # Cumulative results are only summed (and all results scaled) when the sim is finalized
+                new = sim.results[key.replace('cum_', 'new_')].values[t]*sim.rescale_vec[t]
+                if t == 0 and key == 'cum_infections':
+                    new += sim['pop_infected']*sim.rescale_vec[0]
+                self.cum[key] += new
+                simval = self.cum[key]
+            else:
+                res = sim.results[key]
+                simval = res.values[t]*sim.rescale_vec[t] if res.scale else res.values[t]
+            datum = self.data[key][t]
+            if not np.isnan(datum):
+                loss = self.weights.get(key, 1.0)*abs(datum - simval)/self.norms[key]
+                self.mismatches[key] += loss
+                self.mismatch += loss
+                self.n_fitted += 1
+        self.history[t] = self.mismatch
+        return
+
+
+class stop_if_worse(sc.prettyobj):
+    '''
+    Stopping function for sim['stopping_func']: stop once the running mismatch is worse than
+    the cutoff. The sim runs on a copy of its analyzers, so the fit is found by its label;
+    if no cutoff is given, the one shared with the worker processes is used.
+    '''
+
+    def __init__(self, label='running_fit', cutoff=None):
+        self.label  = label
+        self.cutoff = cutoff
+        return
+
+    def __call__(self, sim):
+        cutoff = _cutoff.value if self.cutoff is None else self.cutoff
+        return sim.get_analyzer(self.label).mismatch > cutoff
+
+
+_cutoff = None # The cutoff shared with the worker processes; not stored in the sim, since its pars are deep copied
+
+
+def _set_cutoff(cutoff):
+    global _cutoff
+    _cutoff = cutoff
+    return
+
+
+_base_sims = {} # The base sim of the current reseeded factory, built in the parent process and inherited by forked workers
+
+
+class reseeded(sc.prettyobj):
+    '''
+    A make_sim for screen_seeds() that copies one base sim and reseeds it, as the fits do,
+    so that every seed shares the base sim's population rather than making its own.
+
+    Args:
+        make_sim (func): makes the base sim; must be importable by the worker processes
+        seed     (int):  the seed of the base sim (and so of its population)
+        kwargs   (dict): passed to make_sim()
+
+    **Example**::
+
+        screen = screen_seeds(reseeded(make_sim, beta=beta, end_day=data_end), seeds=range(n_runs), max_mismatch=max_mismatch)
+    '''
+
+    def __init__(self, make_sim, seed=1, **kwargs):
+        self.make_sim = make_sim
+        self.kwargs = sc.mergedicts(kwargs, dict(seed=seed))
+        self.key = f'{make_sim.__module__}.{make_sim.__name__}({sorted(self.kwargs.items())})'
+        self.base_sim() # Make it now, so that forked workers inherit it rather than each making their own
+        return
+
+    def base_sim(self):
+        if self.key not in _base_sims:
+            _base_sims.clear() # Only keep one, since each has a whole population
+            _base_sims[self.key] = self.make_sim(**self.kwargs)
+        return _base_sims[self.key]
+
+    def __call__(self, seed):
+        sim = self.base_sim().copy()
+        sim['rand_seed'] = seed
+        sim.set_seed()
+        sim.label = f'Sim {seed}'
+        return sim
+
+
+def run_screened(make_sim, seed, kwargs=None, fit_kwargs=None, cutoff=None):
+    '''
+    Make and run one sim, stopping early if its mismatch becomes worse than the cutoff
+    (default: the shared cutoff, if there is one).
+
+    Returns:
+        The mismatch (so far, if stopped early), whether the sim ran to the end, and the number of days it ran
+    '''
+    sim = make_sim(seed=seed, **sc.mergedicts(kwargs))
+    fit = running_fit(**sc.mergedicts(fit_kwargs))
+    sim['analyzers'] += [fit]
+    if sim.initialized: # Otherwise it's initialized along with the sim
+        fit.initialize(sim)
+    if cutoff is not None or _cutoff is not None:
+        sim['stopping_func'] = stop_if_worse(label=fit.label, cutoff=cutoff)
+    sim.run()
+    complete = bool(sim.results_ready)
+    return sim.get_analyzer(fit.label).mismatch, complete, (sim.t + 1 if complete else sim.t)
+
+
+def screen_seeds(make_sim, seeds, keep=None, max_mismatch=None, kwargs=None, fit_kwargs=None, n_cpus=None):
+    '''
+    Run make_sim(seed=seed, **kwargs) for each seed, stopping runs that can no longer be
+    among the best-fitting ones.
+
+    Args:
+        make_sim     (func):  makes the sim for a seed; must be importable by the worker processes
+        seeds        (list):  the seeds to screen
+        keep         (float): keep the seeds whose mismatch is below this quantile, e.g. 0.01 for the best 1%
+        max_mismatch (float): keep the seeds whose mismatch is below this value (instead of, or as well as, keep)
+        kwargs       (dict):  passed to make_sim()
+        fit_kwargs   (dict):  passed to running_fit(), e.g. weights or end_day
+        n_cpus       (int):   number of worker processes (default: all available; 1 to run in this process)
+
+    Returns:
+        An objdict of the seeds, their mismatches (so far, for runs that were stopped), whether each
+        run completed, the threshold, the good seeds, and the fraction of sim-days that were run
+    '''
+    seeds = list(seeds)
+    n = len(seeds)
+    if keep is None and max_mismatch is None:
+        errormsg = 'Either keep or max_mismatch must be given, otherwise no run can be stopped early'
+        raise ValueError(errormsg)
+    n_needed = min(n, int(np.floor(keep*(n-1))) + 2) if keep is not None else None # Runs needed to compute the keep quantile exactly
+    if n_cpus is None:
+        n_cpus = sc.cpu_count()
+
+    mismatches = np.full(n, np.nan)
+    complete   = np.zeros(n, dtype=bool)
+    days       = np.zeros(n, dtype=int)
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    cutoff = ctx.Value('d', np.inf if max_mismatch is None else max_mismatch, lock=False)
+
+    def update(i, result):
+        mismatches[i], complete[i], days[i] = result
+        if n_needed is not None and complete.sum() >= n_needed:
+            best = np.sort(mismatches[complete])[n_needed-1]
+            cutoff.value = min(cutoff.value, best)
+        return
+
+    T = sc.timer()
+    if n_cpus <= 1:
+        _set_cutoff(cutoff)
+        try:
+            for i,seed in enumerate(seeds):
+                update(i, run_screened(make_sim, seed, kwargs=kwargs, fit_kwargs=fit_kwargs))
+        finally:
+            _set_cutoff(None)
+    else:
+        with cf.ProcessPoolExecutor(max_workers=n_cpus, mp_context=ctx, initializer=_set_cutoff, initargs=(cutoff,)) as pool:
+            futures = {pool.submit(run_screened, make_sim, seed, kwargs=kwargs, fit_kwargs=fit_kwargs):i for i,seed in enumerate(seeds)}
+            for future in cf.as_completed(futures):
+                update(futures[future], future.result())
+
+    # Select the good seeds as if every run had completed; the stopped runs are all worse than the cutoff
+    threshold = np.inf
+    if keep is not None:
+        threshold = np.quantile(mismatches, keep)
+    if max_mismatch is not None:
+        threshold = min(threshold, max_mismatch)
+    goodseeds = [seed for i,seed in enumerate(seeds) if mismatches[i] < threshold]
+    npts = days[complete].max() if complete.any() else days.max()
+    frac_run = days.sum()/(n*npts) if npts else 1.0
+    print(f'Screened {n} seeds in {T.tt(output=True):0.1f} s: {complete.sum()} ran to the end, {(~complete).sum()} stopped early, {frac_run:0.1%} of sim-days run; {len(goodseeds)} good seeds')
+    return sc.objdict(seeds=seeds, mismatches=mismatches, complete=complete, threshold=threshold, goodseeds=goodseeds, frac_run=frac_run)
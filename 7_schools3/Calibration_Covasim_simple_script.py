@@ -4,9 +4,10 @@ import pylab as pl
 import sciris as sc
 import covasim as cv
 import optuna as op
+import datacache as dc
 #pl.switch_backend('agg')
 
-def create_sim(x):
+def create_sim(x, pop_size=100e3, end_day='2020-06-20', seed=1):
 
     beta = x[0]
     pop_infected = x[1]
@@ -14,12 +15,11 @@ def create_sim(x):
     s_prob_june = x[3]
 
     start_day = '2020-01-21'
-    end_day   = '2020-06-20'
     data_path = 'UK_Covid_cases_August18.xlsx'
 
     # Set the parameters
     total_pop    = 67.86e6 # UK population size
-    pop_size     = 100e3 # Actual simulated population
+    pop_size     = pop_size # Actual simulated population
     pop_scale    = int(total_pop/pop_size)
     pop_type     = 'hybrid'
     asymp_factor = 2
@@ -36,11 +36,12 @@ def create_sim(x):
         asymp_factor = asymp_factor,
         contacts     = contacts,
         rescale      = True,
+        rand_seed    = seed,
         verbose      = 0.1,
     )
 
     # Create the baseline simulation
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     sim['prognoses']['sus_ORs'][0] = 1 # ages 0-10
     sim['prognoses']['sus_ORs'][1] = 1 # ages 10-20
 
@@ -105,15 +106,18 @@ def create_sim(x):
 
 
 
-def objective(x):
-    ''' Define the objective function we are trying to minimize '''
+def objective(x, pop_size=100e3, end_day='2020-06-20', n_seeds=1):
+    ''' Define the objective function we are trying to minimize: the mean mismatch over seeds '''
 
-    # Create and run the sim
-    sim = create_sim(x)
-    sim.run()
-    fit = sim.compute_fit()
+    # Create and run the sims
+    mismatches = []
+    for seed in range(1, n_seeds+1):
+        sim = create_sim(x, pop_size=pop_size, end_day=end_day, seed=seed)
+        sim.run()
+        fit = sim.compute_fit()
+        mismatches.append(fit.mismatch)
 
-    return fit.mismatch
+    return np.mean(mismatches)
 
 
 def get_bounds():
@@ -139,6 +143,15 @@ name      = 'covasim_uk_calibration'
 storage   = f'sqlite:///{name}.db'
 n_trials  = 10
 n_workers = 4
+use_pruning = True # Whether to evaluate trials at increasing fidelity, stopping the poor ones early
+
+# The fidelities at which each trial is evaluated, cheapest first; only trials that are
+# among the best at one fidelity are promoted to the next, and the last is the full calibration
+fidelities = [
+    sc.objdict(pop_size=10e3,  end_day='2020-04-30', n_seeds=1),
+    sc.objdict(pop_size=30e3,  end_day='2020-05-31', n_seeds=2),
+    sc.objdict(pop_size=100e3, end_day='2020-06-20', n_seeds=3),
+]
 
 pars, pkeys = get_bounds() # Get parameter guesses
 
@@ -150,11 +163,29 @@ def op_objective(trial):
     for k,key in enumerate(pkeys):
         x[k] = trial.suggest_uniform(key, pars.lb[k], pars.ub[k])
 
-    return objective(x)
+    if not use_pruning:
+        return objective(x)
+
+    # Report the mismatch at each fidelity before the last, so the pruner can stop poor trials
+    for step,fidelity in enumerate(fidelities):
+        mismatch = objective(x, **fidelity)
+        if step < len(fidelities) - 1:
+            trial.report(mismatch, step+1)
+            if trial.should_prune():
+                raise op.TrialPruned()
+
+    return mismatch
+
+
+def make_pruner():
+    ''' Keep the best half of the trials at each fidelity (steps 1, 2, 4, ...); the pruner is not saved with the study '''
+    if use_pruning:
+        return op.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=2)
+    return op.pruners.NopPruner()
 
 
 def worker():
-    study = op.load_study(storage=storage, study_name=name)
+    study = op.load_study(storage=storage, study_name=name, pruner=make_pruner())
     return study.optimize(op_objective, n_trials=n_trials)
 
 
@@ -165,7 +196,7 @@ def run_workers():
 def make_study():
     try: op.delete_study(storage=storage, study_name=name)
     except: pass
-    return op.create_study(storage=storage, study_name=name)
+    return op.create_study(storage=storage, study_name=name, pruner=make_pruner())
 
 
 def calibrate():
@@ -183,15 +214,18 @@ def savejson(study):
     sc.heading('Making results structure...')
     results = []
     failed_trials = []
+    pruned_trials = []
     for trial in study.trials:
         data = {'index':trial.number, 'mismatch': trial.value}
         for key,val in trial.params.items():
             data[key] = val
-        if data['mismatch'] is None:
+        if trial.state == op.trial.TrialState.PRUNED:
+            pruned_trials.append(data['index'])
+        elif data['mismatch'] is None:
             failed_trials.append(data['index'])
         else:
             results.append(data)
-    print(f'Processed {len(study.trials)} trials; {len(failed_trials)} failed')
+    print(f'Processed {len(study.trials)} trials; {len(pruned_trials)} pruned; {len(failed_trials)} failed')
 
     sc.heading('Making data structure...')
     keys = ['index', 'mismatch'] + pkeys
@@ -7,6 +7,7 @@ import numpy as np
 import matplotlib as mplt
 import utils_vac
 import pandas as pd
+import datacache as dc
 
 ########################################################################
 # Settings and initialisation
@@ -95,7 +96,7 @@ def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None,
         #rel_death_prob=1.1,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     #sim['prognoses']['sus_ORs'][0] = 0.5 # ages 20-30
     #sim['prognoses']['sus_ORs'][1] = 1.0 # ages 20-30
 
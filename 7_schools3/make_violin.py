@@ -1,6 +1,7 @@
 import os
 import sciris as sc
 import covasim as cv
+import archive as ar
 import pandas as pd
 
 import matplotlib.pyplot as plt
@@ -12,7 +13,7 @@ plt.rcParams['font.size'] = font_size
 plt.rcParams['figure.dpi'] = 400
 
 result_dir = 'results_delay'
-files = os.listdir(result_dir)
+files = [f for f in os.listdir(result_dir) if not f.endswith('.cvar')] # The archives are made from the other files by lazy_msim()
 print(files)
 
 # load data
@@ -26,7 +27,7 @@ for file in files:
         df.update({'index': []})
 
     scenario = file.split('.')[0]
-    msim = cv.load(os.path.join(result_dir, file))
+    msim = ar.lazy_msim(os.path.join(result_dir, file))
     mar08 = msim.sims[0].day('2021-03-08')
     apr30 = msim.sims[0].day('2021-04-19')
     for ix, sim in enumerate(msim.sims):
@@ -3,6 +3,7 @@ import covasim as cv
 import covasim.parameters as cvp
 import pylab as pl
 import numpy as np
+import datacache as dc
 
 
 ########################################################################
@@ -163,7 +164,7 @@ def make_sim(seed, beta, calibration=True, future_symp_test=None, scenario=None,
         #rel_death_prob=1.2,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
     #sim['prognoses']['sus_ORs'][0] = 0.5 # ages 20-30
     #sim['prognoses']['sus_ORs'][1] = 1.0 # ages 20-30
 
@@ -3,6 +3,10 @@ import covasim as cv
 import covasim.parameters as cvp
 import pylab as pl
 import numpy as np
+import utils as ut
+import datacache as dc
+import archive as ar
+import ensembles as ens
  
 
 ########################################################################
@@ -16,10 +20,14 @@ cv.git_info('covasim_version.json')
 do_plot = 1
 do_save = 1
 save_sim = 1
+save_pickle = 0 # Whether to also pickle the whole multisim, with the people (large); otherwise only the results are archived
 plot_hist = 0 # Whether to plot an age histogram
 do_show = 0
 verbose = 1
 seed    = 1
+n_seeds = 10
+seed_tol = None # If set, e.g. to 0.05, run seeds in batches until the 95% CI half-width of each of the outputs below (after data_end) is within this fraction of its mean, rather than n_seeds
+max_seeds = 50
 to_plot = sc.objdict({
     'Daily infections': ['new_diagnoses'],
     'Daily hospitalisations': ['new_severe'],
@@ -71,15 +79,9 @@ vx_rollout = {
 }
 # For simplicity, we assume linear scale-up for each age group, from 0% vax coverage to the final
 # uptake value over the duration of the vaccination campaign
-def set_subtargets(vx_phase):
-  return lambda sim: cv.true((sim.people.age >= vx_phase['start_age']) * (sim.people.age < vx_phase['end_age']))
-
-subtarget_dict = {}
 for age, vx_phase in vx_rollout.items():
     vx_phase['daily_prob'] = 0.025
     #vx_phase['final_uptake'] / vx_phase['days_to_reach']
-    subtarget_dict[age] = {'inds': set_subtargets(vx_phase),
-                           'vals': vx_phase['daily_prob']}
 
 ########################################################################
 # Create the baseline simulation
@@ -120,7 +122,7 @@ def make_sim(seed, beta, end_day='2022-03-31', verbose=0.1):
         #rel_death_prob=1.2,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, end_day='2022-03-31', location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), end_day='2022-03-31', location='uk')
 
    # ADD BETA INTERVENTIONS
     #sbv is transmission in schools and assumed to be 63%=0.7*90% assuming that masks are used and redyce it by 30%
@@ -253,12 +255,7 @@ def make_sim(seed, beta, end_day='2022-03-31', verbose=0.1):
                            '2022-03-29': [1.05, sbv_new, 0.50, 0.70],
                            })
 
-    beta_days = list(beta_dict.keys())
-    h_beta = cv.change_beta(days=beta_days, changes=[c[0] for c in beta_dict.values()], layers='h')
-    s_beta = cv.change_beta(days=beta_days, changes=[c[1] for c in beta_dict.values()], layers='s')
-    w_beta = cv.change_beta(days=beta_days, changes=[c[2] for c in beta_dict.values()], layers='w')
-    c_beta = cv.change_beta(days=beta_days, changes=[c[3] for c in beta_dict.values()], layers='c')
-    interventions = [h_beta, w_beta, s_beta, c_beta]
+    interventions = [ut.policy_timeline(beta_dict, layers=['h', 's', 'w', 'c'])]
 
     # adding different variants: B.1.177 in September 2020, Alpha slightly later and Delta from April 2021
     # Add B.1.177 strain from September 2020 and assume it's like b1351 (no vaccine at this time in England)
@@ -471,13 +468,14 @@ def make_sim(seed, beta, end_day='2022-03-31', verbose=0.1):
     pfizer_vaccine = sc.mergedicts({'label':'pfizer_uk'}, sc.mergedicts(dose_pars, variant_pars))
 
     # Loop over vaccination in different ages
+    subtargets = ut.age_subtargets() # Age bands are computed once per population and shared by all phases
     for age,vx_phase in vx_rollout.items():
         vaccine = az_vaccine if (age > 40 and age < 65) else pfizer_vaccine
         vx_start_day = sim.day(vx_phase['start_day'])
         vx_end_day = vx_start_day + vx_phase['days_to_reach']
         days = np.arange(vx_start_day, vx_end_day)
-
-        vx = cv.vaccinate_prob(vaccine=vaccine, days=days, subtarget=subtarget_dict[age], label=f'Vaccinate {age}')
+        subtarget = subtargets.band(vx_phase['start_age'], vx_phase['end_age'], prob=vx_phase['daily_prob'])
+        vx = cv.vaccinate_prob(vaccine=vaccine, days=days, subtarget=subtarget, label=f'Vaccinate {age}')
         interventions += [vx]
         
     # Define booster as a custom vaccination but with parameters like pfizer and moderna as these are used in England as boostes
@@ -524,13 +522,17 @@ if __name__ == '__main__':
 # Make sim
     ####multi run sims
     s0 = make_sim(seed=1, beta=0.0079, end_day='2022-03-31', verbose=0.1)
-    sims = []
-    for seed in range(10):
-        sim = s0.copy()
-        sim['rand_seed'] = seed
-        sim.set_seed()
-        sim.label = f"Sim {seed}"
-        sims.append(sim)
+
+    def run_sims(seeds): # Each worker copies and reseeds s0 itself, and sends back the run sim without its people
+        return [sim for seed,sim in ens.run_ensemble(s0, seeds, ordered=True, func=ens.shrink_sim)]
+
+    if seed_tol: # Stop once the outputs are precise enough
+        day = s0.day(data_end)
+        outputs = dict(peak_severe=ens.peak_after('new_severe', day), deaths=ens.change_after('cum_deaths', day))
+        ensemble = ens.run_until_precise(run_sims, outputs, tol=seed_tol, relative=True, max_seeds=max_seeds)
+        sims = ensemble.runs
+    else:
+        sims = run_sims(range(n_seeds))
     # Add analyzers
     
     ####individual run
@@ -546,14 +548,15 @@ if __name__ == '__main__':
     #sim = cv.MultiSim(sims)
     #sim.run()
     ###multisim running
-    msim = cv.MultiSim(sims)
-    msim.run()
+    msim = cv.MultiSim(sims) # Already run
     
     # Do saving of sims
     if save_sim:
                     #sim.reduce()
                     msim.reduce(quantiles=[0.10, 0.90])
-                    msim.save(f'{resfolder}/uk_sim_test_01Dec_omic.obj',keep_people=True)
+                    ar.save_archive(f'{resfolder}/uk_sim_test_01Dec_omic.cvar', msim)
+                    if save_pickle:
+                        msim.save(f'{resfolder}/uk_sim_test_01Dec_omic.obj',keep_people=True)
     # Do plotting
     if do_plot:
         msim.plot(to_plot=to_plot, do_save=True, do_show=False, fig_path=figfolder+'/England_test_01Dec_omic.png',
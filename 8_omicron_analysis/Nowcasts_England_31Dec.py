@@ -3,6 +3,8 @@ import covasim as cv
 import covasim.parameters as cvp
 import pylab as pl
 import numpy as np
+import utils as ut
+import datacache as dc
  
 
 ########################################################################
@@ -71,15 +73,9 @@ vx_rollout = {
 }
 # For simplicity, we assume linear scale-up for each age group, from 0% vax coverage to the final
 # uptake value over the duration of the vaccination campaign
-def set_subtargets(vx_phase):
-  return lambda sim: cv.true((sim.people.age >= vx_phase['start_age']) * (sim.people.age < vx_phase['end_age']))
-
-subtarget_dict = {}
 for age, vx_phase in vx_rollout.items():
     vx_phase['daily_prob'] = 0.02
     #vx_phase['final_uptake'] / vx_phase['days_to_reach']
-    subtarget_dict[age] = {'inds': set_subtargets(vx_phase),
-                           'vals': vx_phase['daily_prob']}
 
 ########################################################################
 # Create the baseline simulation
@@ -116,7 +112,7 @@ def make_sim(seed, beta, end_day='2022-03-10', verbose=0.1):
         verbose      = verbose,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, end_day='2022-03-10', location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), end_day='2022-03-10', location='uk')
 
    # ADD BETA INTERVENTIONS
     #sbv is transmission in schools and assumed to be 63%=0.7*90% assuming that masks are used and redyce it by 30%
@@ -456,13 +452,14 @@ def make_sim(seed, beta, end_day='2022-03-10', verbose=0.1):
     pfizer_vaccine = sc.mergedicts({'label':'pfizer_uk'}, sc.mergedicts(dose_pars, variant_pars))
 
     # Loop over vaccination in different ages
+    subtargets = ut.age_subtargets() # Age bands are computed once per population and shared by all phases
     for age,vx_phase in vx_rollout.items():
         vaccine = az_vaccine if (age > 40 and age < 65) else pfizer_vaccine
         vx_start_day = sim.day(vx_phase['start_day'])
         vx_end_day = vx_start_day + vx_phase['days_to_reach']
         days = np.arange(vx_start_day, vx_end_day)
-
-        vx = cv.vaccinate_prob(vaccine=vaccine, days=days, subtarget=subtarget_dict[age], label=f'Vaccinate {age}')
+        subtarget = subtargets.band(vx_phase['start_age'], vx_phase['end_age'], prob=vx_phase['daily_prob'])
+        vx = cv.vaccinate_prob(vaccine=vaccine, days=days, subtarget=subtarget, label=f'Vaccinate {age}')
         interventions += [vx]
         
     # Define booster as a custom vaccination but with parameters like pfizer and moderna as these are used in England as boostes
@@ -0,0 +1,138 @@
+'''
+Branch a sim that has been run part of the way into several scenario continuations.
+
+Each branch is an in-memory copy of the paused sim, so the history is neither rerun
+nor pickled. The arrays that do not change once the sim is initialized (the data,
+people's ages and sexes, and the static contact layers) are shared by reference
+between all the branches; everything a run writes to -- the people's states, the
+results, the interventions -- is copied. The results are copied too, since each
+branch keeps writing into the same arrays as it runs on.
+
+**Example**::
+
+    sim = add_scens(seed=0, **p)
+    run_until(sim, day_before_scens)
+    for rel_beta in [1, 2, 3]:
+        future = branch(sim, interventions=cv.change_beta('2021-12-15', 0.8), func=lambda s: set_omicron(s, rel_beta=rel_beta, ...))
+        future.run()
+'''
+
+import copy
+import sciris as sc
+import covasim as cv
+import population as pop
+
+
+# Parameters that interventions and variants register themselves in, so they are never restored
+registry_pars = ['interventions', 'analyzers', 'variants', 'variant_pars', 'variant_map', 'vaccine_pars', 'vaccine_map']
+
+
+def run_until(sim, day):
+    '''
+    Run the sim until the given day, first recording its original parameters so that
+    interventions added to its branches see the same parameters as they would have if
+    they had been there from the start (e.g. change_beta stores the original betas).
+    '''
+    if not sim.initialized:
+        sim.initialize()
+    if getattr(sim, 'branch_pars', None) is None:
+        sim.branch_pars = {k:sc.dcp(v) for k,v in sim.pars.items() if k not in registry_pars}
+    sim.run(until=day)
+    return sim
+
+
+def shared_arrays(sim):
+    ''' Return the objects that do not change once the sim is initialized, which branches can share '''
+    objs = pop.shared_arrays(sim)
+    if sim.data is not None:
+        objs.append(sim.data)
+    if sim.people:
+        objs += [sim.people[key] for key in pop.person_keys]
+        for lkey,layer in sim.people.contacts.items():
+            if not sim['dynam_layer'].get(lkey, 0): # Dynamic layers are regenerated during the run
+                objs += [layer[col] for col in pop.layer_cols]
+    return objs
+
+
+def copy_sim(sim):
+    ''' Deep copy the sim, but keep referring to (rather than copying) the arrays that do not change '''
+    memo = {id(obj):obj for obj in shared_arrays(sim)}
+    return copy.deepcopy(sim, memo)
+
+
+def branch(sim, interventions=None, variants=None, func=None, seed=None, label=None):
+    '''
+    Copy a paused sim and add scenario-specific interventions and variants to the copy.
+
+    Variants cannot be added once the people have been created, since their arrays are
+    sized by the number of variants; instead, a variant with the same label must already
+    be in the sim, and is replaced by the new definition (e.g. with new import days or
+    parameters).
+
+    Args:
+        sim           (Sim):  the paused sim, e.g. from run_until(); not modified
+        interventions (list): interventions to add to the branch
+        variants      (list): variants to replace in the branch, matched by label
+        func          (func): called with the branch to make any other changes, e.g. to the immunity matrix
+        seed          (int):  reseed the branch with this seed (default: the sim's seed plus the current day, so all branches share random numbers)
+        label         (str):  label for the branch
+
+    Returns:
+        The branched sim, ready to be run on
+    '''
+    interventions = sc.promotetolist(interventions)
+    variants      = sc.promotetolist(variants)
+    if not sim.initialized:
+        errormsg = 'Only sims that have been initialized (and usually run part of the way) can be branched'
+        raise ValueError(errormsg)
+
+    sim = copy_sim(sim)
+    if label is not None:
+        sim.label = label
+
+    # Replace the variants, keeping their position so that the variant indices are unchanged
+    for variant in variants:
+        labels = [v.label for v in sim['variants']]
+        if variant.label not in labels:
+            errormsg = f'Variant "{variant.label}" is not in the sim (variants: {labels}); variants must be defined before the sim is branched'
+            raise ValueError(errormsg)
+        sim['variants'][labels.index(variant.label)] = variant
+        variant.initialize(sim)
+
+    # Add the interventions, initializing them against the parameters the sim started with
+    if interventions:
+        orig_pars = getattr(sim, 'branch_pars', None)
+        if orig_pars is None:
+            errormsg = 'Interventions can only be added to a sim that was paused with run_until(), since its original parameters are needed'
+            raise ValueError(errormsg)
+        current = {k:sim.pars[k] for k in orig_pars}
+        try:
+            sim.pars.update(sc.dcp(orig_pars))
+            for intervention in interventions:
+                intervention.initialize(sim)
+        finally:
+            sim.pars.update(current)
+        sim['interventions'] += interventions
+
+    if func is not None:
+        func(sim)
+
+    if seed is None:
+        seed = sim['rand_seed'] + sim.t
+    sim.set_seed(seed)
+    return sim
+
+
+def make_branches(sim, scenarios, **kwargs):
+    '''
+    Make one branch per scenario.
+
+    Args:
+        sim       (Sim):  the paused sim
+        scenarios (dict): for each label, a dict of arguments to branch()
+        kwargs    (dict): passed to branch() for every scenario
+
+    Returns:
+        An objdict of branched sims
+    '''
+    return sc.objdict({label:branch(sim, label=label, **sc.mergedicts(kwargs, scen)) for label,scen in scenarios.items()})
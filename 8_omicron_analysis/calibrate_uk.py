@@ -3,6 +3,8 @@ import covasim as cv
 import covasim.parameters as cvpar
 import pylab as pl
 import numpy as np
+import utils as ut
+import datacache as dc
  
 
 ########################################################################
@@ -63,14 +65,8 @@ vx_rollout = {
 }
 # For simplicity, we assume linear scale-up for each age group, from 0% vax coverage to the final
 # uptake value over the duration of the vaccination campaign
-def set_subtargets(vx_phase):
-  return lambda sim: cv.true((sim.people.age >= vx_phase['start_age']) * (sim.people.age < vx_phase['end_age']))
-
-subtarget_dict = {}
 for age, vx_phase in vx_rollout.items():
     vx_phase['daily_prob'] = vx_phase['final_uptake'] / vx_phase['days_to_reach']
-    subtarget_dict[age] = {'inds': set_subtargets(vx_phase),
-                           'vals': vx_phase['daily_prob']}
 
 ########################################################################
 # Create the baseline simulation
@@ -107,7 +103,7 @@ def make_sim(seed, beta, verbose=0.1):
         verbose      = verbose,
     )
 
-    sim = cv.Sim(pars=pars, datafile=data_path, location='uk')
+    sim = cv.Sim(pars=pars, datafile=dc.load_data(data_path), location='uk')
 
    # ADD BETA INTERVENTIONS
     #sbv is transmission in schools and assumed to be 63%=0.7*90% assuming that masks are used and redyce it by 30%
@@ -204,12 +200,7 @@ def make_sim(seed, beta, verbose=0.1):
                            '2021-11-01': [1.05, sbv_new, 0.50, 0.80],
                            })
 
-    beta_days = list(beta_dict.keys())
-    h_beta = cv.change_beta(days=beta_days, changes=[c[0] for c in beta_dict.values()], layers='h')
-    s_beta = cv.change_beta(days=beta_days, changes=[c[1] for c in beta_dict.values()], layers='s')
-    w_beta = cv.change_beta(days=beta_days, changes=[c[2] for c in beta_dict.values()], layers='w')
-    c_beta = cv.change_beta(days=beta_days, changes=[c[3] for c in beta_dict.values()], layers='c')
-    interventions = [h_beta, w_beta, s_beta, c_beta]
+    interventions = [ut.policy_timeline(beta_dict, layers=['h', 's', 'w', 'c'])]
 
     # adding different variants: B.1.177 in September 2020, Alpha slightly later and Delta from April 2021
     # Add B.1.177 strain from September 2020 and assume it's like b1351 (no vaccine at this time in England)
@@ -275,68 +266,39 @@ def make_sim(seed, beta, verbose=0.1):
 
     t_delay       = 1.0
 
-    #isolation may-june
-    iso_vals = [{k:0.2 for k in 'hswc'}]
-    #isolation july
-    iso_vals1 = [{k:0.4 for k in 'hswc'}]
-    #isolation september
-    iso_vals2 = [{k:0.6 for k in 'hswc'}]
-    #isolation october
-    iso_vals3 = [{k:0.6 for k in 'hswc'}]
-    #isolation november
-    iso_vals4 = [{k:0.2 for k in 'hswc'}]
-     #isolation december
-    iso_vals5 = [{k:0.5 for k in 'hswc'}]
-    #isolation March 2021
-    ####chnaged to 0.2 for fitting
-    iso_vals6 = [{k:0.5 for k in 'hswc'}]
-    #isolation from 20 June 2021 reduced
-    iso_vals7 = [{k:0.7 for k in 'hswc'}]
-    #isolation from 16 July 2021 increased
-    ####chnaged to 0.2 for fitting
-    iso_vals8 = [{k:0.3 for k in 'hswc'}]
-    #isolation from August 2021
-    iso_vals9 = [{k:0.5 for k in 'hswc'}]
-    #isolation from Sep 2021
-    iso_vals10 = [{k:0.5 for k in 'hswc'}]
+    #isolation values, set from the start of each testing period below: may-june 0.2, july 0.4,
+    #september and october 0.6, november 0.2, december and March 2021 0.5, 0.7 from 20 June 2021
+    #(reduced), 0.3 from 16 July 2021 (increased), and 0.5 from August 2021
+    testing = {
+        tc_day:           dict(symp_prob=0.009,           asymp_prob=0.0),
+        te_day:           dict(symp_prob=s_prob_april,    asymp_prob=0.0,     iso_factor=0.2),
+        tt_day:           dict(symp_prob=s_prob_may,      asymp_prob=0.00076),
+        tti_day:          dict(symp_prob=s_prob_june,     asymp_prob=0.00076),
+        tti_day_july:     dict(symp_prob=s_prob_july,     asymp_prob=0.00076, iso_factor=0.4),
+        tti_day_august:   dict(symp_prob=s_prob_august,   asymp_prob=0.0028),
+        tti_day_sep:      dict(symp_prob=s_prob_sep,      asymp_prob=0.0028,  iso_factor=0.6),
+        tti_day_oct:      dict(symp_prob=s_prob_oct,      asymp_prob=0.0028,  iso_factor=0.6),
+        tti_day_nov:      dict(symp_prob=s_prob_nov,      asymp_prob=0.0063,  iso_factor=0.2),
+        tti_day_dec:      dict(symp_prob=s_prob_dec,      asymp_prob=0.0063,  iso_factor=0.5),
+        tti_day_jan:      dict(symp_prob=s_prob_jan,      asymp_prob=0.0063),
+        tti_day_feb:      dict(symp_prob=s_prob_jan,      asymp_prob=0.008),
+        tti_day_march:    dict(symp_prob=s_prob_march,    asymp_prob=0.008,   iso_factor=0.5),
+        tti_day_june21:   dict(symp_prob=s_prob_june21,   asymp_prob=0.008,   iso_factor=0.7),
+        tti_day_july21:   dict(symp_prob=s_prob_july21,   asymp_prob=0.004,   iso_factor=0.3),
+        tti_day_august21: dict(symp_prob=s_prob_august21, asymp_prob=0.008,   iso_factor=0.5),
+        tti_day_sep21:    dict(symp_prob=s_prob_sep21,    asymp_prob=0.008,   iso_factor=0.5),
+        tti_day_oct21:    dict(symp_prob=s_prob_oct21,    asymp_prob=0.004),
+        tti_day_nov21:    dict(symp_prob=s_prob_nov21,    asymp_prob=0.008),
+        tti_day_dec21:    dict(symp_prob=s_prob_dec21,    asymp_prob=0.008),
+    }
 
     #testing and isolation intervention
     interventions += [
-        cv.test_prob(symp_prob=0.009, asymp_prob=0.0, symp_quar_prob=0.0, start_day=tc_day, end_day=te_day-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_april, asymp_prob=0.0, symp_quar_prob=0.0, start_day=te_day, end_day=tt_day-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_may, asymp_prob=0.00076, symp_quar_prob=0.0, start_day=tt_day, end_day=tti_day-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_june, asymp_prob=0.00076, symp_quar_prob=0.0, start_day=tti_day, end_day=tti_day_july-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_july, asymp_prob=0.00076, symp_quar_prob=0.0, start_day=tti_day_july, end_day=tti_day_august-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_august, asymp_prob=0.0028, symp_quar_prob=0.0, start_day=tti_day_august, end_day=tti_day_sep-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_sep, asymp_prob=0.0028, symp_quar_prob=0.0, start_day=tti_day_sep, end_day=tti_day_oct-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_oct, asymp_prob=0.0028, symp_quar_prob=0.0, start_day=tti_day_oct, end_day=tti_day_nov-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_nov, asymp_prob=0.0063, symp_quar_prob=0.0, start_day=tti_day_nov, end_day=tti_day_dec-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_dec, asymp_prob=0.0063, symp_quar_prob=0.0, start_day=tti_day_dec, end_day=tti_day_jan-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_jan, asymp_prob=0.0063, symp_quar_prob=0.0, start_day=tti_day_jan, end_day=tti_day_feb-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_jan, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_feb, end_day=tti_day_march-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_march, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_march, end_day=tti_day_june21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_june21, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_june21, end_day=tti_day_july21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_july21, asymp_prob=0.004, symp_quar_prob=0.0, start_day=tti_day_july21, end_day=tti_day_august21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_august21, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_august21, end_day=tti_day_sep21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_sep21, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_sep21, end_day=tti_day_oct21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_oct21, asymp_prob=0.004, symp_quar_prob=0.0, start_day=tti_day_oct21, end_day=tti_day_nov21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_nov21, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_nov21, end_day=tti_day_dec21-1, test_delay=t_delay),
-        cv.test_prob(symp_prob=s_prob_dec21, asymp_prob=0.008, symp_quar_prob=0.0, start_day=tti_day_dec21, test_delay=t_delay),
+        ut.test_schedule(testing, symp_quar_prob=0.0, test_delay=t_delay),
         cv.contact_tracing(trace_probs={'h': 1, 's': 0.8, 'w': 0.8, 'c': 0.1},
                            trace_time={'h': 0, 's': 1, 'w': 1, 'c': 2},
                            start_day='2020-06-01', end_day='2023-07-12',
-                           quar_period=10),
-        cv.dynamic_pars({'iso_factor': {'days': te_day, 'vals': iso_vals}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_july, 'vals': iso_vals1}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_sep, 'vals': iso_vals2}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_oct, 'vals': iso_vals3}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_nov, 'vals': iso_vals4}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_dec, 'vals': iso_vals5}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_march, 'vals': iso_vals6}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_june21, 'vals': iso_vals7}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_july21, 'vals': iso_vals8}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_august21, 'vals': iso_vals9}}),
-        cv.dynamic_pars({'iso_factor': {'days': tti_day_sep21, 'vals': iso_vals10}})]
+                           quar_period=10)]
     
     def change_hosp(sim):
         if sim.t == tti_day_dec21:
@@ -357,12 +319,14 @@ def make_sim(seed, beta, verbose=0.1):
     pfizer_vaccine = sc.mergedicts({'label':'pfizer_uk'}, sc.mergedicts(dose_pars, variant_pars))
 
     # Loop over vaccination in different ages
+    subtargets = ut.age_subtargets() # Age bands are computed once per population and shared by all phases
     for age,vx_phase in vx_rollout.items():
         vaccine = az_vaccine if (age > 40 and age < 65) else pfizer_vaccine
         vx_start_day = sim.day(vx_phase['start_day'])
         vx_end_day = vx_start_day + vx_phase['days_to_reach']
         days = np.arange(vx_start_day, vx_end_day)
-        vx = cv.vaccinate_prob(vaccine=vaccine, days=days, subtarget=subtarget_dict[age], label=f'Vaccinate {age}')
+        subtarget = subtargets.band(vx_phase['start_age'], vx_phase['end_age'], prob=vx_phase['daily_prob'])
+        vx = cv.vaccinate_prob(vaccine=vaccine, days=days, subtarget=subtarget, label=f'Vaccinate {age}')
         interventions += [vx]
 
     # Finally, update the parameters
@@ -0,0 +1,106 @@
+'''
+Store of partially run sims, so that scenarios sharing the same history only run it once.
+
+Each checkpoint is keyed by a hash of the base configuration, the seed and the day the
+sim was run until. Checkpoints are written atomically and checked when they are
+loaded; anything that fails to load or does not match its key is discarded and rerun.
+'''
+
+import os
+import json
+import hashlib
+import sciris as sc
+import covasim as cv
+
+
+def hash_config(config):
+    ''' Hash a JSON-compatible configuration, e.g. a dict of base parameters and file names '''
+    config = sc.mergedicts(config, {'covasim_version': cv.__version__})
+    string = json.dumps(sc.jsonify(config), sort_keys=True)
+    return hashlib.md5(string.encode()).hexdigest()
+
+
+def hash_file(filename):
+    ''' Hash the contents of a file, e.g. the script that defines the base sim '''
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class checkpoint_store(sc.prettyobj):
+    '''
+    Folder of sims that have been run up to a given day.
+
+    Args:
+        folder (str): where to store the checkpoints
+        config (dict): everything that defines the history being run, other than the seed
+
+    **Example**::
+
+        store = checkpoint_store('cache', config=dict(beta=0.0079, data_end='2021-10-31'))
+        sim, loaded = store.run_until(lambda: make_sim(seed), seed=seed, day=day_before_scens)
+        sim.run()
+    '''
+
+    def __init__(self, folder, config):
+        self.folder = folder
+        self.config_hash = hash_config(config)
+        os.makedirs(folder, exist_ok=True)
+        return
+
+    def key(self, seed, day):
+        return dict(config_hash=self.config_hash, seed=int(seed), day=int(day))
+
+    def filename(self, seed, day):
+        return os.path.join(self.folder, f'checkpoint_{self.config_hash[:12]}_seed{int(seed)}_day{int(day)}.sim')
+
+    def save(self, sim, seed, day):
+        ''' Save a sim that has been run until the given day; safe to call from several processes at once '''
+        if sim.t != day:
+            errormsg = f'Cannot save checkpoint for day {day}: sim has been run until day {sim.t}'
+            raise ValueError(errormsg)
+        filename = self.filename(seed, day)
+        tmpfile = f'{filename}.{os.getpid()}.tmp'
+        sim.checkpoint = self.key(seed, day)
+        cv.save(tmpfile, sim)
+        os.replace(tmpfile, filename) # Atomic, so readers see either nothing or a complete file
+        return filename
+
+    def load(self, seed, day):
+        ''' Load a checkpoint, or return None if there is no valid one '''
+        filename = self.filename(seed, day)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            sim = cv.load(filename)
+            key = getattr(sim, 'checkpoint', None)
+            if key != self.key(seed, day) or sim.t != day:
+                errormsg = f'checkpoint key {key} at day {sim.t} does not match {self.key(seed, day)}'
+                raise ValueError(errormsg)
+        except Exception as E:
+            print(f'WARNING, discarding checkpoint {filename}: {str(E)}')
+            try:
+                os.remove(filename)
+            except FileNotFoundError: # Another process got there first
+                pass
+            return None
+        return sim
+
+    def run_until(self, make_sim, seed, day):
+        '''
+        Return a sim run until the given day, loading it if possible and otherwise
+        making it with make_sim(), running it and saving it.
+
+        Either way the sim is then reseeded from the seed and day, so that what
+        happens afterwards does not depend on whether the checkpoint was loaded.
+
+        Returns:
+            sim, loaded (bool)
+        '''
+        sim = self.load(seed, day)
+        loaded = sim is not None
+        if not loaded:
+            sim = make_sim()
+            sim.run(until=day)
+            self.save(sim, seed, day)
+        sim.set_seed(int(seed) + int(day))
+        return sim, loaded
@@ -0,0 +1,96 @@
+'''
+Load the case data workbooks once, rather than reparsing the Excel file for every sim.
+
+The first time a workbook is loaded, its columns are saved to a compressed .npz file in a
+.datacache folder next to it, named by the hash of the workbook's contents, so an edited
+workbook is converted again automatically. Within a process, the parsed data is also kept
+in memory (keyed by the file's path, size and modification time), so each sim just gets a
+copy of it. The result can be passed straight to cv.Sim(), which accepts a dataframe as
+well as a filename.
+
+**Example**::
+
+    sim = cv.Sim(pars=pars, datafile=load_data('England_Covid_cases_Nov272021.xlsx'), location='uk')
+'''
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+cache_folder = '.datacache'
+_cache = {}
+
+
+def clear_cache():
+    ''' Forget the data loaded in this process; the .npz files are kept '''
+    _cache.clear()
+    return
+
+
+def hash_file(filename):
+    ''' Hash the contents of a file '''
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def cache_filename(datafile, filehash):
+    folder, name = os.path.split(os.path.abspath(datafile))
+    return os.path.join(folder, cache_folder, f'{os.path.splitext(name)[0]}_{filehash[:12]}.npz')
+
+
+def can_cache(data):
+    ''' Only numeric and date columns are stored, so that the .npz files never need pickling '''
+    return all(dtype.kind in 'biufM' for dtype in data.dtypes)
+
+
+def save_columns(filename, data):
+    ''' Save each column of the dataframe as an array, keeping the column order '''
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    arrays = {f'col_{i}':data[col].values for i,col in enumerate(data.columns)}
+    tmpfile = f'{filename}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmpfile, columns=np.array(data.columns, dtype=str), **arrays)
+    os.replace(tmpfile, filename) # Atomic, so other processes never see a partial file
+    return filename
+
+
+def load_columns(filename):
+    ''' Load a dataframe saved by save_columns() '''
+    with np.load(filename) as npz:
+        columns = npz['columns'].tolist()
+        return pd.DataFrame({col:npz[f'col_{i}'] for i,col in enumerate(columns)})
+
+
+def read_data(datafile):
+    ''' Read the workbook from the .npz cache, converting it if this version has not been converted yet '''
+    filehash = hash_file(datafile)
+    filename = cache_filename(datafile, filehash)
+    if os.path.isfile(filename):
+        try:
+            return load_columns(filename)
+        except Exception as E: # E.g. a file from an incompatible version of NumPy
+            print(f'WARNING, could not load cached data {filename} ({E}); rereading {datafile}')
+    if datafile.lower().endswith('csv'):
+        data = pd.read_csv(datafile)
+    else:
+        data = pd.read_excel(datafile)
+    if can_cache(data):
+        save_columns(filename, data)
+    return data
+
+
+def load_data(datafile):
+    '''
+    Return the raw data from a case data file, as a dataframe to pass to cv.Sim(datafile=...).
+
+    Each call returns a new copy, since Covasim adds columns to the dataframe it is given.
+    Anything other than an .xlsx, .xls or .csv filename is returned unchanged.
+    '''
+    if not isinstance(datafile, str) or not datafile.lower().endswith(('xlsx', 'xls', 'csv')):
+        return datafile
+    stat = os.stat(datafile)
+    key = (os.path.abspath(datafile), stat.st_size, stat.st_mtime)
+    if key not in _cache:
+        _cache[key] = read_data(datafile)
+    return _cache[key].copy()
@@ -0,0 +1,227 @@
+'''
+Space-filling designs for parameter sweeps, reproducible from a seed.
+
+Random draws leave gaps and clusters, and full grids spend most of their runs far from
+anywhere interesting. These designs cover the same box with fewer runs:
+
+    sobol           scrambled Sobol points; best balanced when n is a power of 2
+    lhs             Latin hypercube, optimised for uniformity (centered discrepancy)
+    sparse          Smolyak sparse grid of nested, equally spaced points; a subset of a full grid of 2**(level-1) + 1 points per side
+    grid            full grid, for comparison
+
+All designs are generated on the unit cube and then scaled to the parameter bounds;
+parameters with a few allowed values (e.g. rel_sev of 1, 2 or 3) get each value for an
+equal share of the box. The coverage of a design is the fraction of the box that is
+within a given distance (in units of each parameter's range) of a design point, and
+runs_needed() finds the smallest design of each kind that reaches a target coverage.
+
+For heatmaps on a fixed grid, grid_cells() picks the cells of the grid to run, and
+fill_grid() interpolates the rest.
+
+**Example**::
+
+    draws = make_design('sobol', bounds=dict(rel_beta=(1, 6), rel_imm=(0.1, 0.4)), n=256, seed=1)
+    n = runs_needed('sobol', d=2, radius=0.05, target=0.95)
+'''
+
+import itertools
+import numpy as np
+import sciris as sc
+import scipy.stats.qmc as qmc
+import scipy.spatial as spsp
+import scipy.interpolate as spi
+
+
+methods = ['sobol', 'lhs', 'sparse', 'grid']
+
+
+def sobol(n, d, seed=None):
+    ''' The first n points of a scrambled Sobol sequence in the unit cube '''
+    m = int(np.ceil(np.log2(max(n, 1))))
+    return qmc.Sobol(d, scramble=True, seed=seed).random_base2(m)[:n]
+
+
+def latin_hypercube(n, d, seed=None):
+    ''' A Latin hypercube of n points in the unit cube, optimised for uniformity '''
+    return qmc.LatinHypercube(d, optimization='random-cd', seed=seed).random(n)
+
+
+def full_grid(npts, d):
+    ''' A full grid of npts points per side '''
+    axis = np.linspace(0, 1, npts)
+    return np.array(list(itertools.product(axis, repeat=d)))
+
+
+def sparse_levels(level):
+    ''' The nested equally spaced points of a 1D level: 0.5 at level 1, then 2**(level-1) + 1 points '''
+    return np.array([0.5]) if level == 1 else np.linspace(0, 1, 2**(level-1) + 1)
+
+
+def sparse_grid(level, d):
+    '''
+    Smolyak sparse grid: the union of the full grids of the 1D levels (i_1, ..., i_d)
+    with i_1 + ... + i_d <= level + d - 1, so the finest level along each axis is level.
+    '''
+    points = set()
+    for index in itertools.product(range(1, level+1), repeat=d):
+        if sum(index) <= level + d - 1:
+            for point in itertools.product(*[sparse_levels(i) for i in index]):
+                points.add(tuple(np.round(point, 12)))
+    return np.array(sorted(points))
+
+
+def unit_design(method, d, n=None, level=None, seed=None):
+    ''' A design in the unit cube; n is the number of points (sobol, lhs) or per side (grid), level is for sparse '''
+    if method == 'sobol':
+        return sobol(n, d, seed=seed)
+    elif method == 'lhs':
+        return latin_hypercube(n, d, seed=seed)
+    elif method == 'sparse':
+        return sparse_grid(level, d)
+    elif method == 'grid':
+        return full_grid(n, d)
+    else:
+        errormsg = f'Design "{method}" not recognized; choices are {methods}'
+        raise ValueError(errormsg)
+
+
+def scale(U, bounds, levels=None):
+    ''' Scale points in the unit cube to the bounds, giving each allowed value of a discrete parameter an equal share '''
+    levels = sc.mergedicts(levels)
+    X = np.zeros(U.shape)
+    for i,(par,(lower,upper)) in enumerate(bounds.items()):
+        if par in levels:
+            values = np.asarray(levels[par])
+            X[:, i] = values[np.minimum((U[:, i]*len(values)).astype(int), len(values)-1)]
+        else:
+            X[:, i] = lower + U[:, i]*(upper - lower)
+    return X
+
+
+def make_design(method, bounds, n=None, level=None, seed=None, levels=None):
+    '''
+    Make a design over the parameter bounds.
+
+    Args:
+        method (str):  'sobol', 'lhs', 'sparse' or 'grid'
+        bounds (dict): the lower and upper bound of each parameter
+        n      (int):  the number of points (sobol, lhs), or points per side (grid)
+        level  (int):  the level of a sparse grid
+        seed   (int):  the random seed (sobol, lhs)
+        levels (dict): the allowed values of any discrete parameters, e.g. dict(rel_sev=[1, 2, 3])
+
+    Returns:
+        A list of draws, each an objdict of parameter values
+    '''
+    U = unit_design(method, len(bounds), n=n, level=level, seed=seed)
+    X = scale(U, bounds, levels=levels)
+    return [sc.objdict({par:float(x[i]) for i,par in enumerate(bounds.keys())}) for x in X]
+
+
+def test_points(d, n_test=2**14, seed=0):
+    return sobol(n_test, d, seed=seed)
+
+
+def nearest_distances(U, n_test=2**14, seed=0):
+    ''' The distance from each of a set of test points in the unit cube to the nearest design point '''
+    tree = spsp.cKDTree(np.asarray(U, dtype=float))
+    return tree.query(test_points(U.shape[1], n_test=n_test, seed=seed))[0]
+
+
+def coverage(U, radius, n_test=2**14, seed=0):
+    ''' The fraction of the unit cube within radius of a point of the design '''
+    return float(np.mean(nearest_distances(U, n_test=n_test, seed=seed) <= radius))
+
+
+def fill_distance(U, n_test=2**14, seed=0):
+    ''' The largest distance from anywhere in the unit cube to the nearest point of the design (estimated) '''
+    return float(nearest_distances(U, n_test=n_test, seed=seed).max())
+
+
+def runs_needed(method, d, radius, target=0.95, seed=None, max_n=2**16):
+    '''
+    The smallest design of a kind that covers the target fraction of the unit cube to
+    within radius. Sobol designs are searched in powers of 2, grids by points per side,
+    sparse grids by level, and Latin hypercubes by doubling then bisection.
+
+    Returns:
+        An objdict of the number of runs, the n or level to pass to make_design(), and the coverage
+    '''
+    def check(n=None, level=None):
+        U = unit_design(method, d, n=n, level=level, seed=seed)
+        return len(U), coverage(U, radius)
+
+    found = None
+    if method == 'sobol':
+        for m in range(int(np.log2(max_n)) + 1):
+            n_runs, cov = check(n=2**m)
+            if cov >= target:
+                found = sc.objdict(n_runs=n_runs, n=2**m, level=None, coverage=cov)
+                break
+    elif method == 'grid':
+        for npts in itertools.count(2):
+            if npts**d > max_n: break
+            n_runs, cov = check(n=npts)
+            if cov >= target:
+                found = sc.objdict(n_runs=n_runs, n=npts, level=None, coverage=cov)
+                break
+    elif method == 'sparse':
+        for level in itertools.count(1):
+            n_runs, cov = check(level=level)
+            if n_runs > max_n: break
+            if cov >= target:
+                found = sc.objdict(n_runs=n_runs, n=None, level=level, coverage=cov)
+                break
+    elif method == 'lhs':
+        lower, upper = 0, 1
+        while upper <= max_n and check(n=upper)[1] < target:
+            lower, upper = upper, 2*upper
+        if upper <= max_n:
+            while upper - lower > 1:
+                mid = (lower + upper)//2
+                lower, upper = (lower, mid) if check(n=mid)[1] >= target else (mid, upper)
+            n_runs, cov = check(n=upper)
+            found = sc.objdict(n_runs=n_runs, n=upper, level=None, coverage=cov)
+    else:
+        errormsg = f'Design "{method}" not recognized; choices are {methods}'
+        raise ValueError(errormsg)
+
+    if found is None:
+        errormsg = f'No {method} design of up to {max_n} runs covers {target:0.0%} of the space to within {radius}'
+        raise ValueError(errormsg)
+    return found
+
+
+def grid_cells(method, shape, n=None, level=None, seed=None):
+    '''
+    Choose which cells of a grid to run: all of them for 'grid', otherwise the cells
+    nearest the points of the design, plus the corners so the rest can be interpolated.
+    A sparse grid of level L is exact for grids of 2**(L-1) + 1 points per side.
+
+    Returns:
+        A sorted list of tuples of indices
+    '''
+    shape = np.array(shape)
+    if method == 'grid':
+        return [tuple(int(i) for i in ind) for ind in np.ndindex(*shape)]
+    U = unit_design(method, len(shape), n=n, level=level, seed=seed)
+    U = np.vstack([U, full_grid(2, len(shape))])
+    inds = np.round(U*(shape - 1)).astype(int)
+    return sorted({tuple(int(i) for i in ind) for ind in inds})
+
+
+def fill_grid(grid):
+    ''' Fill the NaN cells of a 2D grid by linear interpolation between the others (nearest outside them) '''
+    grid = np.array(grid, dtype=float)
+    known = np.isfinite(grid)
+    if known.all() or not known.any():
+        return grid
+    points = np.argwhere(known)
+    missing = np.argwhere(~known)
+    values = grid[known]
+    filled = spi.griddata(points, values, missing, method='linear') if len(points) >= 3 else np.full(len(missing), np.nan)
+    outside = np.isnan(filled)
+    if outside.any():
+        filled[outside] = spi.griddata(points, values, missing[outside], method='nearest')
+    grid[tuple(missing.T)] = filled
+    return grid
@@ -0,0 +1,303 @@
+'''
+Emulate the outcomes of a parameter sweep with a Gaussian process, so that heatmaps and
+sensitivity indices can be computed from a few hundred sims rather than thousands.
+
+The emulator is fitted to a space-filling (maximin Latin hypercube) design of draws,
+each averaged over seeds, with one Gaussian process per output. Each has a Matern 5/2
+kernel with a length scale per parameter and a noise term for the variation between
+seeds, with its hyperparameters fitted by maximum likelihood. Outputs such as cumulative
+infections are fitted on a log scale. New draws are then added in batches where the
+emulator is least certain: each point in a batch is the candidate with the highest
+predictive variance, given the points already chosen (which does not depend on their
+results), so a batch spreads out rather than piling up in one place.
+
+Parameters with a few allowed values (e.g. rel_sev of 1, 2 or 3) are emulated as
+continuous, but design points are only placed on the allowed values, each of which gets
+an equal share of the design.
+
+**Example**::
+
+    emu = emulator(bounds=dict(rel_beta=(1, 6), rel_imm=(0.1, 0.4)), outputs=['cum_infections'])
+    emu = run_adaptive(emu, run_draws, n_initial=200, n_rounds=5, batch_size=20)
+    pred = emu.predict([dict(rel_beta=3, rel_imm=0.2)])
+    hm = emu.heatmap('cum_infections', x='rel_beta', y='rel_imm')
+    si = emu.sobol_indices('cum_infections')
+'''
+
+import numpy as np
+import sciris as sc
+import scipy.linalg as spla
+import scipy.optimize as spo
+import designs as ds
+
+
+def matern52(X1, X2, lengths, scale):
+    ''' Matern 5/2 covariance between the rows of X1 and X2, with a length scale per column '''
+    diff = (X1[:, None, :] - X2[None, :, :])/lengths
+    r = np.sqrt(5*(diff**2).sum(axis=2))
+    return scale*(1 + r + r**2/3)*np.exp(-r)
+
+
+class gaussian_process(sc.prettyobj):
+    '''
+    Gaussian process regression of one output on inputs scaled to the unit cube.
+
+    Args:
+        n_restarts (int): number of random starts for fitting the hyperparameters, in addition to the default start
+        seed       (int): random seed for the restarts
+    '''
+
+    # Bounds on the log hyperparameters: length scales, signal variance, noise variance (of the standardised output)
+    log_bounds = dict(length=(np.log(0.01), np.log(10)), scale=(np.log(1e-2), np.log(1e2)), noise=(np.log(1e-8), np.log(1)))
+
+    def __init__(self, n_restarts=3, seed=None):
+        self.n_restarts = n_restarts
+        self.seed       = seed
+        self.X          = None
+        return
+
+    def unpack(self, theta):
+        d = self.X.shape[1]
+        return np.exp(theta[:d]), np.exp(theta[d]), np.exp(theta[d+1])
+
+    def neg_log_likelihood(self, theta):
+        lengths, scale, noise = self.unpack(theta)
+        K = matern52(self.X, self.X, lengths, scale) + (noise + 1e-10)*np.eye(len(self.X))
+        try:
+            L = spla.cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e10
+        alpha = spla.cho_solve(L, self.z)
+        return 0.5*self.z @ alpha + np.log(np.diag(L[0])).sum() + 0.5*len(self.z)*np.log(2*np.pi)
+
+    def fit(self, X, y):
+        ''' Fit the hyperparameters and condition on the data '''
+        self.X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.y_mean = y.mean()
+        self.y_std  = y.std() if y.std() > 0 else 1.0
+        self.z = (y - self.y_mean)/self.y_std
+        d = self.X.shape[1]
+        bounds = [self.log_bounds['length']]*d + [self.log_bounds['scale'], self.log_bounds['noise']]
+        starts = [np.r_[np.full(d, np.log(0.3)), 0.0, np.log(1e-2)]]
+        rng = np.random.default_rng(self.seed)
+        starts += [np.array([rng.uniform(*b) for b in bounds]) for _ in range(self.n_restarts)]
+        best = None
+        for start in starts:
+            res = spo.minimize(self.neg_log_likelihood, start, method='L-BFGS-B', bounds=bounds)
+            if best is None or res.fun < best.fun:
+                best = res
+        self.theta = best.x
+        self.condition()
+        return self
+
+    def condition(self, X_extra=None):
+        ''' Compute the Cholesky factor of the training covariance, optionally with extra (pseudo) inputs '''
+        lengths, scale, noise = self.unpack(self.theta)
+        X = self.X if X_extra is None else np.vstack([self.X, X_extra])
+        K = matern52(X, X, lengths, scale) + (noise + 1e-10)*np.eye(len(X))
+        L = spla.cho_factor(K, lower=True)
+        if X_extra is None:
+            self.L = L
+            self.alpha = spla.cho_solve(L, self.z)
+        return L, X
+
+    def predict(self, X, X_extra=None):
+        '''
+        Return the mean and standard deviation of the latent function at X, on the
+        original scale of y. If X_extra is given, the standard deviation is the one that
+        would remain once those inputs had also been observed (the mean is unchanged).
+        '''
+        X = np.asarray(X, dtype=float)
+        lengths, scale, noise = self.unpack(self.theta)
+        Ks = matern52(X, self.X, lengths, scale)
+        mean = self.y_mean + self.y_std*(Ks @ self.alpha)
+        if X_extra is None:
+            L, Xc = self.L, self.X
+        else:
+            L, Xc = self.condition(X_extra)
+            Ks = matern52(X, Xc, lengths, scale)
+        v = spla.solve_triangular(L[0], Ks.T, lower=True)
+        var = np.maximum(scale - (v**2).sum(axis=0), 0)
+        return mean, self.y_std*np.sqrt(var)
+
+
+class emulator(sc.prettyobj):
+    '''
+    Emulate several outputs of a sweep over a box of parameters.
+
+    Args:
+        bounds     (dict): the lower and upper bound of each parameter
+        outputs    (list): the outputs to emulate
+        levels     (dict): the allowed values of any discrete parameters, e.g. dict(rel_sev=[1, 2, 3])
+        log        (bool): whether to emulate log(1 + output), for outputs that vary over orders of magnitude
+        n_restarts (int):  passed to gaussian_process()
+        seed       (int):  random seed for the design and the hyperparameter fits
+    '''
+
+    def __init__(self, bounds, outputs, levels=None, log=True, n_restarts=3, seed=None):
+        self.pars    = list(bounds.keys())
+        self.lower   = np.array([bounds[p][0] for p in self.pars], dtype=float)
+        self.upper   = np.array([bounds[p][1] for p in self.pars], dtype=float)
+        self.outputs = list(outputs)
+        self.levels  = sc.mergedicts(levels)
+        self.log     = log
+        self.seed    = seed
+        self.X       = np.zeros((0, len(self.pars)))
+        self.Y       = {key:np.zeros(0) for key in self.outputs}
+        self.gps     = {key:gaussian_process(n_restarts=n_restarts, seed=seed) for key in self.outputs}
+        return
+
+    def to_unit(self, X):
+        return (np.asarray(X, dtype=float) - self.lower)/(self.upper - self.lower)
+
+    def from_unit(self, U):
+        ''' Scale points in the unit cube to the bounds, with an equal share of it for each allowed value (as in designs.scale) '''
+        bounds = {p:(lo, hi) for p,lo,hi in zip(self.pars, self.lower, self.upper)}
+        return ds.scale(np.asarray(U, dtype=float), bounds, levels=self.levels).astype(float)
+
+    def to_array(self, draws):
+        ''' Convert a list of dicts of parameter values to an array, one row per draw '''
+        return np.array([[draw[p] for p in self.pars] for draw in draws], dtype=float)
+
+    def to_draws(self, X):
+        ''' Convert an array of parameter values to a list of dicts, one per row '''
+        return [sc.objdict({p:float(x[i]) for i,p in enumerate(self.pars)}) for x in X]
+
+    def design(self, n, seed=None, n_tries=100):
+        ''' A Latin hypercube of n draws, the best of n_tries by the smallest distance between points '''
+        rng = np.random.default_rng(self.seed if seed is None else seed)
+        d = len(self.pars)
+        best, best_dist = None, -1
+        for _ in range(n_tries):
+            U = (np.argsort(rng.random((n, d)), axis=0) + rng.random((n, d)))/n
+            X = self.from_unit(U)
+            dists = np.sqrt(((self.to_unit(X)[:, None, :] - self.to_unit(X)[None, :, :])**2).sum(axis=2))
+            dist = dists[np.triu_indices(n, k=1)].min() if n > 1 else 0
+            if dist > best_dist:
+                best, best_dist = X, dist
+        return self.to_draws(best)
+
+    def transform(self, y):
+        return np.log1p(np.maximum(y, 0)) if self.log else np.asarray(y, dtype=float)
+
+    def untransform(self, z):
+        return np.expm1(z) if self.log else z
+
+    def add(self, draws, results, refit=True):
+        ''' Add the results of some draws (a dict of output arrays, one value per draw), and refit '''
+        self.X = np.vstack([self.X, self.to_array(draws)])
+        for key in self.outputs:
+            self.Y[key] = np.concatenate([self.Y[key], np.asarray(results[key], dtype=float)])
+        if refit:
+            self.fit()
+        return self
+
+    def fit(self):
+        U = self.to_unit(self.X)
+        for key,gp in self.gps.items():
+            gp.fit(U, self.transform(self.Y[key]))
+        return self
+
+    def predict(self, draws, outputs=None):
+        '''
+        Predict the outputs for a list of draws (or an array with a column per parameter).
+
+        Returns:
+            A dict with, for each output, the mean (the median, if log=True), the 95% interval
+            (low and high), and the standard deviation (on the log scale, if log=True)
+        '''
+        X = draws if isinstance(draws, np.ndarray) else self.to_array(draws)
+        U = self.to_unit(X)
+        preds = sc.objdict()
+        for key in (self.outputs if outputs is None else outputs):
+            mean, std = self.gps[key].predict(U)
+            preds[key] = sc.objdict(mean=self.untransform(mean), low=self.untransform(mean - 1.96*std), high=self.untransform(mean + 1.96*std), std=std)
+        return preds
+
+    def uncertainty(self, U, U_extra=None):
+        ''' The predictive standard deviation at U, relative to each output's variation, averaged over outputs '''
+        return np.mean([gp.predict(U, X_extra=U_extra)[1]/gp.y_std for gp in self.gps.values()], axis=0)
+
+    def suggest(self, n, n_candidates=2000, seed=None):
+        '''
+        Choose n new draws where the emulator is least certain, one at a time, each
+        taking account of those already chosen.
+        '''
+        rng = np.random.default_rng(seed)
+        candidates = self.to_unit(self.from_unit(rng.random((n_candidates, len(self.pars)))))
+        chosen = []
+        for _ in range(n):
+            extra = np.array(chosen) if chosen else None
+            sd = self.uncertainty(candidates, U_extra=extra)
+            i = sd.argmax()
+            chosen.append(candidates[i])
+            candidates = np.delete(candidates, i, axis=0)
+        return self.to_draws(self.from_unit(np.array(chosen)))
+
+    def heatmap(self, output, x, y, fixed=None, n=50):
+        '''
+        Predict an output over a grid of two parameters, with the others fixed (by
+        default at the middle of their range, or their lowest allowed value).
+
+        Returns:
+            An objdict of the x and y values, and the mean, low, high, and std, each with a row per y value
+        '''
+        fixed = sc.mergedicts({p:(self.levels[p][0] if p in self.levels else (lo + hi)/2) for p,lo,hi in zip(self.pars, self.lower, self.upper)}, fixed)
+        xs = np.linspace(self.lower[self.pars.index(x)], self.upper[self.pars.index(x)], n)
+        ys = np.linspace(self.lower[self.pars.index(y)], self.upper[self.pars.index(y)], n)
+        xx, yy = np.meshgrid(xs, ys)
+        X = np.array([[fixed[p] for p in self.pars]]*xx.size, dtype=float)
+        X[:, self.pars.index(x)] = xx.ravel()
+        X[:, self.pars.index(y)] = yy.ravel()
+        pred = self.predict(X, outputs=[output])[output]
+        return sc.objdict({x:xs, y:ys, **{k:v.reshape(xx.shape) for k,v in pred.items()}})
+
+    def sobol_indices(self, output, n=4096, seed=None):
+        '''
+        First-order and total Sobol indices of an output, from the emulator's mean over
+        the box (sampling the allowed values of discrete parameters uniformly), using the
+        Saltelli and Jansen estimators.
+        '''
+        rng = np.random.default_rng(seed)
+        d = len(self.pars)
+        A = self.from_unit(rng.random((n, d)))
+        B = self.from_unit(rng.random((n, d)))
+        fA = self.predict(A, outputs=[output])[output].mean
+        fB = self.predict(B, outputs=[output])[output].mean
+        var = np.var(np.concatenate([fA, fB]))
+        first = sc.objdict()
+        total = sc.objdict()
+        for i,p in enumerate(self.pars):
+            ABi = A.copy()
+            ABi[:, i] = B[:, i]
+            fABi = self.predict(ABi, outputs=[output])[output].mean
+            first[p] = np.mean(fB*(fABi - fA))/var
+            total[p] = 0.5*np.mean((fA - fABi)**2)/var
+        return sc.objdict(first=first, total=total)
+
+
+def run_adaptive(emu, run_draws, n_initial=200, n_rounds=5, batch_size=20, seed=None):
+    '''
+    Fit an emulator to a space-filling design, then add batches of draws where it is least certain.
+
+    Args:
+        emu        (emulator): the emulator to fit
+        run_draws  (func):     takes a list of draws (dicts of parameter values) and returns a dict with an array of each output, one value per draw
+        n_initial  (int):      the number of draws in the initial design
+        n_rounds   (int):      the number of adaptive batches
+        batch_size (int):      the number of draws in each batch
+        seed       (int):      random seed for the design and the candidates
+
+    Returns:
+        The fitted emulator
+    '''
+    seed = emu.seed if seed is None else seed
+    draws = emu.design(n_initial, seed=seed)
+    emu.add(draws, run_draws(draws))
+    for r in range(n_rounds):
+        draws = emu.suggest(batch_size, seed=None if seed is None else seed + r + 1)
+        before = emu.uncertainty(emu.to_unit(emu.to_array(draws))).max()
+        emu.add(draws, run_draws(draws))
+        print(f'Emulator round {r+1} of {n_rounds}: added {batch_size} draws (now {len(emu.X)}), where the largest relative uncertainty was {before:0.3f}')
+    return emu
@@ -0,0 +1,240 @@
+'''
+Build sims from a structured config file rather than a hand-written make_sim().
+
+A config is a JSON (or YAML) file with a version number and the following sections,
+all optional except pars:
+
+    pars         Covasim parameters, e.g. pop_size, start_day, beta
+    datafile     the data file to calibrate against
+    location     the location, for age structure and contacts
+    policy       beta_dict of {date: [h, s, w, c] multipliers}, and optionally layers
+    variants     list of {variant, start_day, end_day, n_imports, label, pars}
+    testing      table of {date: {symp_prob, asymp_prob, iso_factor}}, plus other test_prob arguments
+    tracing      arguments to cv.contact_tracing()
+    par_changes  {date: {parameter: value}}, e.g. to change durations part of the way through
+    vaccines     {label: {base, pars}}, where base is a Covasim vaccine, e.g. 'pfizer'
+    rollout      list of {vaccine, start_age, end_age, start_day, days_to_reach, final_uptake}
+
+The expensive pieces are memoized within each process, so building many sims from the
+same config only does them once: the parsed data file (see datacache.py), the population
+(keyed by the parameters that define it and the seed), the age bands for the vaccine
+rollout, and the uninitialized interventions (keyed by their part of the config).
+
+**Example**::
+
+    config = load_config('configs/england.json')
+    sim = build(config, seed=1, pars=dict(end_day='2022-03-01'))
+'''
+
+import json
+import hashlib
+import numpy as np
+import sciris as sc
+import covasim as cv
+import covasim.parameters as cvpar
+import utils as ut
+import datacache as dc
+
+
+config_version = 1 # Increment when the config format changes incompatibly
+pop_keys = ['pop_size', 'pop_type', 'location', 'contacts', 'dynam_layer', 'rand_seed'] # Parameters that define the population
+max_cached_pops = 4 # Populations are large, so only keep a few
+
+
+_cache = sc.objdict(people=sc.odict(), subtargets={}, interventions={})
+
+
+def clear_cache():
+    ''' Clear everything memoized by build() '''
+    for cache in _cache.values():
+        cache.clear()
+    dc.clear_cache()
+    return
+
+
+def load_config(filename):
+    ''' Load and check a config from a JSON or YAML file '''
+    if filename.lower().endswith(('.yaml', '.yml')):
+        config = sc.loadyaml(filename)
+    else:
+        config = sc.loadjson(filename)
+    check_config(config)
+    return config
+
+
+def save_config(filename, config):
+    ''' Save a config as JSON '''
+    check_config(config)
+    sc.savejson(filename, config)
+    return filename
+
+
+def check_config(config):
+    ''' Check the config is the current version and has no unknown sections '''
+    version = config.get('version')
+    if version != config_version:
+        errormsg = f'Config version {version} is not supported; expecting version {config_version}'
+        raise ValueError(errormsg)
+    sections = ['version', 'pars', 'datafile', 'location', 'policy', 'variants', 'testing', 'tracing', 'par_changes', 'vaccines', 'rollout']
+    unknown = set(config.keys()) - set(sections)
+    if unknown:
+        errormsg = f'Unknown config sections {sorted(unknown)}; choices are {sections}'
+        raise ValueError(errormsg)
+    return
+
+
+def hash_config(config):
+    ''' Hash part of a config, for memoizing what is built from it '''
+    return hashlib.md5(json.dumps(sc.jsonify(config), sort_keys=True).encode()).hexdigest()
+
+
+def init_people(sim):
+    '''
+    Initialize the sim with a population built from its parameters and seed, reusing the
+    population if one has already been built from the same parameters and seed.
+
+    The population is always built by a separate call to init_people() and then passed to
+    sim.initialize(), so the sim is the same whether or not the population was cached.
+    '''
+    key = hash_config({k:sim[k] for k in pop_keys})
+    if key not in _cache.people:
+        popsim = sim.copy()
+        popsim.set_seed()
+        popsim.init_people(verbose=0)
+        people = popsim.people
+        popdict = {k:people[k] for k in ['uid', 'age', 'sex']}
+        popdict['contacts'] = {lkey:{col:layer[col] for col in ['p1', 'p2', 'beta']} for lkey,layer in people.contacts.items()}
+        _cache.people[key] = popdict
+        while len(_cache.people) > max_cached_pops:
+            _cache.people.pop(0)
+    sim.initialize(popdict=sc.dcp(_cache.people[key]))
+    return sim
+
+
+def memoize_interventions(name, config, make):
+    ''' Build interventions from their part of the config once, and return fresh copies thereafter '''
+    key = (name, hash_config(config))
+    if key not in _cache.interventions:
+        _cache.interventions[key] = make()
+    return sc.dcp(_cache.interventions[key])
+
+
+class set_pars(cv.Intervention):
+    ''' Change parameters on given dates; nested dicts are updated rather than replaced '''
+
+    def __init__(self, changes, **kwargs):
+        super().__init__(**kwargs) # Initialize the Intervention object
+        self.changes = changes
+        return
+
+    def initialize(self, sim):
+        super().initialize()
+        self.day_changes = {sim.day(date):pars for date,pars in self.changes.items()}
+        self.days = list(self.day_changes.keys())
+        return
+
+    def apply(self, sim):
+        if sim.t in self.day_changes:
+            for key,val in self.day_changes[sim.t].items():
+                if isinstance(val, dict):
+                    update_nested(sim[key], val)
+                else:
+                    sim[key] = val
+        return
+
+
+def update_nested(target, changes):
+    ''' Recursively update a nested dict in place '''
+    for key,val in changes.items():
+        if isinstance(val, dict) and isinstance(target.get(key), dict):
+            update_nested(target[key], val)
+        else:
+            target[key] = val
+    return target
+
+
+def make_variants(sim, config):
+    ''' Make the variants, which need the sim to convert their dates '''
+    variants = []
+    for entry in config:
+        days = np.arange(sim.day(entry['start_day']), sim.day(entry['end_day']))
+        variant = cv.variant(entry['variant'], days=days, n_imports=entry.get('n_imports', 1), label=entry.get('label'))
+        variant.p.update(entry.get('pars', {}))
+        variants.append(variant)
+    return variants
+
+
+def make_vaccines(config):
+    ''' Make the vaccine parameters from a Covasim vaccine and any changes to it '''
+    vaccines = {}
+    for label,entry in config.items():
+        dose_pars = cvpar.get_vaccine_dose_pars()[entry['base']]
+        variant_pars = cvpar.get_vaccine_variant_pars()[entry['base']]
+        vaccines[label] = sc.mergedicts({'label':label}, dose_pars, variant_pars, entry.get('pars'))
+    return vaccines
+
+
+def make_rollout(sim, config, vaccines):
+    ''' Vaccinate each age band over its campaign, with linear scale-up to its final uptake '''
+    pop_key = (sim['pop_size'], sim['rand_seed'])
+    subtargets = _cache.subtargets.setdefault(pop_key, ut.age_subtargets()) # Shared by every sim with this population
+    interventions = []
+    for phase in config:
+        start_day = sim.day(phase['start_day'])
+        days = np.arange(start_day, start_day + phase['days_to_reach'])
+        daily_prob = phase['final_uptake'] / phase['days_to_reach']
+        subtarget = subtargets.band(phase['start_age'], phase['end_age'], prob=daily_prob)
+        label = phase.get('label', f'Vaccinate {phase["start_age"]}')
+        interventions.append(cv.vaccinate_prob(vaccine=vaccines[phase['vaccine']], days=days, subtarget=subtarget, label=label))
+    return interventions
+
+
+def build(config, seed=None, pars=None, initialize=True, do_plot=False):
+    '''
+    Build a sim from a config.
+
+    Args:
+        config     (dict/str): the config, or the file to load it from
+        seed       (int):      the random seed (default: from the config's pars)
+        pars       (dict):     parameters overriding the config's, e.g. end_day
+        initialize (bool):     whether to initialize the sim (using the cached population if possible)
+        do_plot    (bool):     whether to plot the interventions
+
+    Returns:
+        The sim
+    '''
+    if isinstance(config, str):
+        config = load_config(config)
+    check_config(config)
+    pars = sc.mergedicts(config['pars'], pars)
+    if seed is not None:
+        pars['rand_seed'] = seed
+
+    datafile = dc.load_data(config['datafile']) if config.get('datafile') else None
+    sim = cv.Sim(pars=pars, datafile=datafile, location=config.get('location'))
+
+    interventions = []
+    if config.get('policy'):
+        policy = config['policy']
+        interventions += memoize_interventions('policy', policy, lambda: [ut.policy_timeline(policy['beta_dict'], layers=policy.get('layers'))])
+    if config.get('testing'):
+        testing = sc.dcp(config['testing'])
+        table = testing.pop('table')
+        interventions += memoize_interventions('testing', config['testing'], lambda: [ut.test_schedule(table, **testing)])
+    if config.get('tracing'):
+        interventions += memoize_interventions('tracing', config['tracing'], lambda: [cv.contact_tracing(**config['tracing'])])
+    if config.get('par_changes'):
+        interventions += [set_pars(config['par_changes'])]
+    if config.get('rollout'):
+        vaccines = make_vaccines(config.get('vaccines', {}))
+        interventions += make_rollout(sim, config['rollout'], vaccines)
+
+    variants = make_variants(sim, config.get('variants', []))
+    sim.update_pars(interventions=interventions, variants=variants)
+    for intervention in sim['interventions']:
+        intervention.do_plot = do_plot
+
+    if initialize:
+        init_people(sim)
+
+    return sim
@@ -6,12 +6,13 @@ import numpy as np
 import pylab as pl
 import covasim as cv
 import sciris as sc
+import archive as ar
 
 T = sc.tic()
 # Load files and extract data
 msim_details = {#'Nowcasting 01 Dec': 'results_Vac/uk_sim_test_20Nov.obj',
                 #'Opening Schools in January 2022 and partial lockdown': 'results/uk_sim_test_01Dec_omic.obj',
-                'Lockdown January-March 2022': 'results/uk_sim_test_01Dec_omic.obj'}
+                'Lockdown January-March 2022': 'results/uk_sim_test_01Dec_omic.obj'} # Or its .cvar archive, if only that was saved
                 #'Delta, June Step 4 opening and Vaccine extended to teenagers': 'results_Vac/uk_sim_test_vx1.obj'}
 
     #for the PTRSA paper
@@ -28,7 +29,7 @@ plotdict = {k: {} for k in plotkeys}
 plotdict_l = {k: {} for k in plotkeys}
 plotdict_h = {k: {} for k in plotkeys}
 for l,fp in msim_details.items():
-    msims[l] = sc.loadobj(fp)
+    msims[l] = ar.lazy_msim(fp) # Only reads the results that are plotted
     for pk in plotkeys:
         plotdict[pk][l] = msims[l].results[pk].values
         plotdict_l[pk][l] = msims[l].results[pk].low
@@ -1,9 +1,20 @@
+import os
 import sciris as sc
 import covasim as cv
 import covasim.parameters as cvpar
 import pylab as pl
 import numpy as np
 import calibrate_uk as ca
+import utils as ut
+import population as pop
+import checkpoints as ck
+import branches as br
+import sinks
+import sweeps as sw
+import factory as fa
+import emulator as em
+import designs as ds
+import ensembles as ens
 
 
 # Settings
@@ -12,6 +23,16 @@ day_before_scens  = cv.day(date_before_scens, start_date=ca.start_day)
 scen_end_date     = '2022-03-01'
 debug = 0
 heatmap_file = 'heatmap_data.obj'
+bands_file = 'infection_bands.obj' # Median and 10th/90th percentiles over seeds of daily infections after data_end, for each draw
+pop_folder = None # If set, e.g. to 'population', build the population of each seed once and share it between all the sims with that seed
+checkpoint_folder = None # If set, e.g. to 'checkpoints', run the history once per seed and restart each scenario from it
+branch_size = None # If set, e.g. to 20, run the history once per this many draws and branch the scenarios from it in memory
+sink_folder = None # If set, e.g. to 'results/omicron_sweep', run a restartable sweep that writes each sim's summary here as it finishes
+config_file = None # If set, e.g. to 'configs/england_omicron.json', build the historical sim from this config rather than calibrate_uk.make_sim()
+sweep_design = None # If set to 'sobol' or 'lhs', take the draws from a space-filling design seeded by seed, rather than from sweep_params()
+emulator_file = None # If set, e.g. to 'omicron_emulator.obj', fit an emulator to a space-filling design of draws, refined where it is least certain, rather than running random draws
+seed_tol = None # If set, e.g. to 0.05, the emulator keeps running batches of n_seeds seeds for each draw until the 95% CI half-width of each heatmap output is within this fraction of its mean
+max_seeds = 50
 verbose = -1
 seed = 1
 
@@ -23,27 +44,30 @@ def sweep_params():
     p['rel_imm'] = np.random.uniform(0.1, 0.4) # changes the relative immunity of omicron (using beta cross-immunity)
     return p
 
+# The same ranges, for the designs and the emulator
+sweep_bounds = sc.objdict(rel_beta=(1, 6), rel_imm=(0.1, 0.4), rel_sev=(1, 3))
+sweep_levels = dict(rel_sev=[1, 2, 3])
+heatmap_vars = ['cum_infections', 'cum_severe', 'cum_deaths']
+
 # Scenarios
 def add_scens(seed=None, rel_beta=None, rel_imm=None, rel_sev=None, meta=None):
     ''' Add future scenarios to the sim '''
 
     # Get the historical calibrated sim
-    sim = ca.make_sim(seed=seed, beta=ca.beta, verbose=verbose)
+    if config_file:
+        sim = fa.build(config_file, seed=seed, pars=dict(verbose=verbose), initialize=False)
+    else:
+        sim = ca.make_sim(seed=seed, beta=ca.beta, verbose=verbose)
     sim['end_day'] = scen_end_date
 
     interventions   = sc.dcp(sim['interventions'])
     variants        = sc.dcp(sim['variants'])
 
-    # Future lockdowns/NPIs
+    # Future lockdowns/NPIs, merged into the calibrated timeline
     beta_dict  = sc.odict({
         '2021-12-15': [1., 1., 1., 1.]
     })
-    beta_days = beta_dict.keys()
-    h_beta = cv.change_beta(days=beta_days, changes=[c[0] for c in beta_dict.values()], layers='h')
-    s_beta = cv.change_beta(days=beta_days, changes=[c[1] for c in beta_dict.values()], layers='s')
-    w_beta = cv.change_beta(days=beta_days, changes=[c[2] for c in beta_dict.values()], layers='w')
-    c_beta = cv.change_beta(days=beta_days, changes=[c[3] for c in beta_dict.values()], layers='c')
-    interventions += [h_beta, w_beta, s_beta, c_beta]
+    interventions = [interv.merge(beta_dict) if isinstance(interv, ut.policy_timeline) else interv for interv in interventions]
 
     # Define booster as a custom vaccination
     booster = dict(
@@ -79,7 +103,26 @@ def add_scens(seed=None, rel_beta=None, rel_imm=None, rel_sev=None, meta=None):
     sim.update_pars(variants=variants, interventions=interventions)
 
     # Initialize then add immunity escape parameters
-    sim.initialize()
+    if pop_folder:
+        pop.initialize(sim, pop.seed_folder(pop_folder, seed))
+    elif config_file:
+        fa.init_people(sim) # Reuses the population between sims with the same seed
+    else:
+        sim.initialize()
+
+    set_omicron(sim, rel_beta=rel_beta, rel_imm=rel_imm, rel_sev=rel_sev)
+    sim.meta = meta
+
+    return sim
+
+
+def set_omicron(sim, rel_beta=None, rel_imm=None, rel_sev=None):
+    '''
+    Set the parameters that vary between scenarios on an initialized sim. None of
+    these act before omicron is imported, so they can also be set on a sim restored
+    from a checkpoint of the history.
+    '''
+    sim['variant_pars']['omicron'].update({'rel_beta': rel_beta, 'rel_severe_prob': rel_sev}) # In place, since the variant and people refer to this dict
 
     immunity = sim['immunity']
     beta_imm = cvpar.get_cross_immunity()['beta'] # Assume that omicron is like beta
@@ -94,9 +137,83 @@ def add_scens(seed=None, rel_beta=None, rel_imm=None, rel_sev=None, meta=None):
     # immunity matrix
     sim['immunity'] = immunity
 
+    return sim
+
+
+def save_population(seed):
+    ''' Save the population of a seed, to be shared by all the sims with that seed '''
+    return pop.save_population(ca.make_sim(seed=seed, beta=ca.beta, verbose=verbose), pop.seed_folder(pop_folder, seed))
+
+
+def checkpoint_config():
+    ''' Everything that defines the history shared by all scenarios, other than the seed '''
+    config = dict(
+        calibration   = ck.hash_file(ca.__file__),
+        scenarios     = ck.hash_file(__file__),
+        data_file     = ck.hash_file(ca.data_path),
+        beta          = ca.beta,
+        start_day     = ca.start_day,
+        scen_end_date = scen_end_date,
+        pop_folder    = pop_folder,
+        config_file   = ck.hash_file(config_file) if config_file else None,
+    )
+    return config
+
+
+def run_history(seed=None, rel_beta=None, rel_imm=None, rel_sev=None, **kwargs):
+    '''
+    Return the sim for this seed run until the scenarios start, from its checkpoint
+    if there is one. The scenario values are only used if the history has to be run,
+    since they do not affect it.
+    '''
+    store = ck.checkpoint_store(checkpoint_folder, config=checkpoint_config())
+    make_sim = lambda: add_scens(seed=seed, rel_beta=rel_beta, rel_imm=rel_imm, rel_sev=rel_sev)
+    return store.run_until(make_sim, seed=seed, day=day_before_scens)
+
+
+def run_checkpointed(seed=None, rel_beta=None, rel_imm=None, rel_sev=None, meta=None, do_shrink=True):
+    ''' Run a scenario on from the checkpoint of the history for its seed '''
+    sim, loaded = run_history(seed=seed, rel_beta=rel_beta, rel_imm=rel_imm, rel_sev=rel_sev)
+    set_omicron(sim, rel_beta=rel_beta, rel_imm=rel_imm, rel_sev=rel_sev)
     sim.meta = meta
+    print(f'Running sim {meta.count:5g} of {meta.n_sims:5g} {str(meta.vals.values()):40s} (history {"loaded" if loaded else "run"})')
+    sim.run() # Run the rest of the sim
 
-    return sim
+    return finish_sim(sim, do_shrink=do_shrink)
+
+
+def run_branches(scens, do_shrink=True):
+    '''
+    Run the history once for a list of scenarios with the same seed (each a dict of
+    arguments to add_scens), then branch each scenario from it in memory.
+    '''
+    seeds = {scen['seed'] for scen in scens}
+    if len(seeds) != 1:
+        errormsg = f'All scenarios branched from the same history must have the same seed, not {seeds}'
+        raise ValueError(errormsg)
+
+    scen = scens[0]
+    if checkpoint_folder:
+        base, _ = run_history(**scen)
+    else:
+        base = add_scens(**scen)
+        br.run_until(base, day_before_scens)
+
+    sims = []
+    for scen in scens:
+        vals = dict(rel_beta=scen['rel_beta'], rel_imm=scen['rel_imm'], rel_sev=scen['rel_sev'])
+        sim = br.branch(base, func=lambda s: set_omicron(s, **vals))
+        sim.meta = scen['meta']
+        print(f'Running sim {sim.meta.count:5g} of {sim.meta.n_sims:5g} {str(sim.meta.vals.values()):40s} (branched)')
+        sim.run()
+        sims.append(finish_sim(sim, do_shrink=do_shrink))
+
+    return sims
+
+
+def run_scen(**kwargs):
+    ''' Make and run a single scenario '''
+    return run_sim(add_scens(**kwargs))
 
 
 def run_sim(sim, do_shrink=True):
@@ -105,11 +222,104 @@ def run_sim(sim, do_shrink=True):
     print(f'Running sim {sim.meta.count:5g} of {sim.meta.n_sims:5g} {str(sim.meta.vals.values()):40s}')
     sim.run(until=day_before_scens) # Run the partial sim
     sim.run() # Run the rest of the sim
-    if do_shrink: sim.shrink()
 
+    return finish_sim(sim, do_shrink=do_shrink)
+
+
+def summarise(sim):
+    ''' Reduce a finished sim to the values used for the heatmaps '''
+    summary = sc.objdict(sim.meta.vals)
+    for v in ['cum_infections', 'cum_severe', 'cum_deaths']:
+        summary[v] = sim.results[v].values[-1] - sim.results[v].values[day_before_scens]
+    summary.new_infections = sim.results['new_infections'].values[day_before_scens:]
+    return summary
+
+
+def finish_sim(sim, do_shrink=True):
+    ''' Either write the sim's summary to the sink and return its indices, or return the (shrunken) sim '''
+    if sink_folder:
+        sink = sinks.result_sink(sink_folder, index_names=['draw', 'seed'])
+        sink.write(sim.meta.inds, **summarise(sim))
+        return sim.meta.inds
+    if do_shrink: sim.shrink()
     return sim
 
 
+def save_heatmap():
+    ''' Average the summaries in the sink over seeds, and save them as the heatmap data '''
+    keys = ['rel_beta', 'rel_imm', 'rel_sev', 'cum_infections', 'cum_severe', 'cum_deaths']
+    means = sinks.result_sink(sink_folder, index_names=['draw', 'seed']).group_mean(by='draw', keys=keys)
+    if not len(means.draw): # Nothing has finished yet
+        return None
+    d = sc.objdict({k:means[k].tolist() for k in keys})
+    sc.saveobj(heatmap_file, d)
+    return d
+
+
+def save_bands():
+    ''' Reduce the daily infections in the sink over seeds, streaming the records rather than loading every sim '''
+    bands = sinks.result_sink(sink_folder, index_names=['draw', 'seed']).group_reduce(by='draw', keys=['new_infections'], quantiles=[0.1, 0.9])
+    if not len(bands.draw):
+        return None
+    sc.saveobj(bands_file, bands)
+    return bands
+
+
+def save_summaries():
+    ''' Save everything that is computed from the sink '''
+    save_heatmap()
+    save_bands()
+    return
+
+
+def run_summary(**kwargs):
+    ''' Make and run a single scenario, and return its summary '''
+    sim = add_scens(**kwargs)
+    sim.run()
+    return summarise(sim)
+
+
+def run_draws(draws, n_seeds):
+    '''
+    Run each draw for each seed, and return the heatmap values for each draw, averaged
+    over seeds. If seed_tol is set, draws whose outputs are still too uncertain get
+    another batch of n_seeds seeds, until max_seeds.
+    '''
+    values = [sc.objdict({v:[] for v in heatmap_vars}) for p in draws]
+    active = list(range(len(draws)))
+    n_run = 0
+    while active:
+        ikw = []
+        for draw in active:
+            for seed in range(n_run, n_run+n_seeds):
+                meta = sc.objdict(count=len(ikw)+1, n_sims=len(active)*n_seeds, inds=[draw, seed])
+                meta.vals = sc.objdict(sc.mergedicts(draws[draw], dict(seed=seed)))
+                ikw.append(sc.dcp(meta.vals))
+                ikw[-1].meta = meta
+        summaries = sc.parallelize(run_summary, iterkwargs=ikw)
+        for kw,summary in zip(ikw, summaries):
+            for v in heatmap_vars:
+                values[kw.meta.inds[0]][v].append(summary[v])
+        n_run += n_seeds
+        if not seed_tol or n_run >= max_seeds:
+            break
+        active = [draw for draw in active if not ens.check_precision(values[draw], seed_tol, relative=True)[0]]
+        print(f'Ran {n_run} seeds per draw; {len(active)} of {len(draws)} draws need more')
+    results = {v:np.array([np.mean(vals[v]) for vals in values]) for v in heatmap_vars}
+    return results
+
+
+def run_emulator(n_seeds, n_initial=200, n_rounds=5, batch_size=20):
+    ''' Fit the emulator, and save it along with the heatmap data of the draws that were run '''
+    emu = em.emulator(sweep_bounds, outputs=heatmap_vars, levels=sweep_levels, seed=seed)
+    emu = em.run_adaptive(emu, lambda draws: run_draws(draws, n_seeds), n_initial=n_initial, n_rounds=n_rounds, batch_size=batch_size)
+    sc.saveobj(emulator_file, emu)
+    d = sc.objdict({p:emu.X[:,i].tolist() for i,p in enumerate(emu.pars)})
+    d.update({v:emu.Y[v].tolist() for v in heatmap_vars})
+    sc.saveobj(heatmap_file, d)
+    return emu
+
+
 def make_msims(sims):
     ''' Take a slice of sims and turn it into a multisim '''
     msim = cv.MultiSim(sims)
@@ -143,55 +353,102 @@ if __name__ == '__main__':
     ikw = []
     T = sc.tic()
 
-    # Make sims
-    sc.heading('Making sims...')
-    for draw in range(n_draws):
-        p = sweep_params()
-        for seed in range(n_seeds):
-            print(f'Creating arguments for sim {count} of {n_sims}...')
-            count += 1
-            meta = sc.objdict()
-            meta.count = count
-            meta.n_sims = n_sims
-            meta.inds = [draw, seed]
-            meta.vals = sc.objdict(sc.mergedicts(p, dict(seed=seed)))
-            ikw.append(sc.dcp(meta.vals))
-            ikw[-1].meta = meta
-
-    sim_configs = sc.parallelize(add_scens, iterkwargs=ikw)
-
-    # Run sims
-    all_sims = sc.parallelize(run_sim, iterarg=sim_configs)
-    sims = np.empty((n_draws, n_seeds), dtype=object)
-    for sim in all_sims:  # Unflatten array
-        draw, seed = sim.meta.inds
-        sims[draw, seed] = sim
-
-    # Convert to msims
-    all_sims_semi_flat = []
-    for draw in range(n_draws):
-        sim_seeds = sims[draw, :].tolist()
-        all_sims_semi_flat.append(sim_seeds)
-    msims = np.empty(n_draws, dtype=object)
-    all_msims = sc.parallelize(make_msims, iterarg=all_sims_semi_flat)
-    for msim in all_msims:  # Unflatten array
-        draw = msim.meta.inds
-        msims[draw] = msim
-
-    # Do processing and store results
-    variables = ['cum_infections', 'cum_severe', 'cum_deaths']
-    d = sc.objdict()
-    d.rel_beta = []
-    d.rel_imm = []
-    d.rel_sev = []
-    for v in variables: d[v] = []
-    for msim in all_msims:
-        d.rel_beta.append(msim.meta.vals['rel_beta'])
-        d.rel_imm.append(msim.meta.vals['rel_imm'])
-        d.rel_sev.append(msim.meta.vals['rel_sev'])
-        for v in variables:
-            d[v].append(msim.results[v].values[-1]-msim.results[v].values[day_before_scens])
-        sc.saveobj(heatmap_file, d)
+    if sweep_design not in [None, 'sobol', 'lhs']: # 'sparse' and 'grid' are not sized by a number of draws
+        errormsg = f'sweep_design must be None, "sobol" or "lhs", not "{sweep_design}"'
+        raise ValueError(errormsg)
+
+    if pop_folder: # One per seed, the same as each sim would make itself
+        sc.heading('Making populations...')
+        pop_seeds = range(max_seeds if emulator_file and seed_tol else n_seeds)
+        sc.parallelize(save_population, iterarg=pop_seeds)
+
+    if emulator_file: # A few hundred draws, rather than n_draws
+        sc.heading('Fitting emulator...')
+        run_emulator(n_seeds=n_seeds, n_initial=[200, 4][debug], n_rounds=[5, 1][debug], batch_size=[20, 2][debug])
+
+    else:
+        # Make sims
+        sc.heading('Making sims...')
+        draws = ds.make_design(sweep_design, sweep_bounds, n=n_draws, seed=seed, levels=sweep_levels) if sweep_design else None
+        for draw in range(n_draws):
+            p = draws[draw] if draws else sweep_params()
+            for seed in range(n_seeds):
+                print(f'Creating arguments for sim {count} of {n_sims}...')
+                count += 1
+                meta = sc.objdict()
+                meta.count = count
+                meta.n_sims = n_sims
+                meta.inds = [draw, seed]
+                meta.vals = sc.objdict(sc.mergedicts(p, dict(seed=seed)))
+                ikw.append(sc.dcp(meta.vals))
+                ikw[-1].meta = meta
+
+        if sink_folder: # Keep the draws with the sweep, so that a restarted sweep runs the same ones
+            tasks_file = os.path.join(sink_folder, 'tasks.obj')
+            if os.path.isfile(tasks_file):
+                ikw = sc.loadobj(tasks_file)
+            else:
+                os.makedirs(sink_folder, exist_ok=True)
+                sc.saveobj(tasks_file, ikw)
+
+        if branch_size: # Group the scenarios by seed, to branch each group from a single run of the history
+            groups = []
+            for seed in range(n_seeds):
+                scens = [kw for kw in ikw if kw.seed == seed]
+                groups += [scens[i:i+branch_size] for i in range(0, len(scens), branch_size)]
+
+        if checkpoint_folder: # Run the history once per seed, so every scenario can run on from it
+            sc.heading('Running history...')
+            sc.parallelize(run_history, iterkwargs=ikw[:n_seeds]) # The first draw has one of each seed
+
+        if sink_folder:
+            # Run as a restartable sweep, saving the heatmap data as it goes
+            sc.heading('Running sweep...')
+            if branch_size:
+                func, tasks = run_branches, {f'group{g}':dict(scens=scens) for g,scens in enumerate(groups)}
+            else:
+                func = run_checkpointed if checkpoint_folder else run_scen
+                tasks = {'_'.join(str(i) for i in kw.meta.inds):kw for kw in ikw}
+            sw.run_sweep(func, tasks, folder=sink_folder, flush=save_summaries, flush_every=100)
+        elif branch_size:
+            all_sims = [sim for sims in sc.parallelize(run_branches, iterarg=groups) for sim in sims]
+        elif checkpoint_folder:
+            sc.heading('Running scenarios...')
+            all_sims = sc.parallelize(run_checkpointed, iterkwargs=ikw)
+        else: # Make and run each sim in the same worker, so its population is never pickled
+            all_sims = sc.parallelize(run_scen, iterkwargs=ikw)
+
+        if not sink_folder: # Otherwise the heatmap data has already been saved
+            variables = ['cum_infections', 'cum_severe', 'cum_deaths']
+            sims = np.empty((n_draws, n_seeds), dtype=object)
+            for sim in all_sims:  # Unflatten array
+                draw, seed = sim.meta.inds
+                sims[draw, seed] = sim
+
+            # Convert to msims
+            all_sims_semi_flat = []
+            for draw in range(n_draws):
+                sim_seeds = sims[draw, :].tolist()
+                all_sims_semi_flat.append(sim_seeds)
+            msims = np.empty(n_draws, dtype=object)
+            all_msims = sc.parallelize(make_msims, iterarg=all_sims_semi_flat)
+            for msim in all_msims:  # Unflatten array
+                draw = msim.meta.inds
+                msims[draw] = msim
+
+            # Do processing and store results
+            d = sc.objdict()
+            d.rel_beta = []
+            d.rel_imm = []
+            d.rel_sev = []
+            for v in variables: d[v] = []
+            for msim in all_msims:
+                d.rel_beta.append(msim.meta.vals['rel_beta'])
+                d.rel_imm.append(msim.meta.vals['rel_imm'])
+                d.rel_sev.append(msim.meta.vals['rel_sev'])
+                for v in variables:
+                    d[v].append(msim.results[v].values[-1]-msim.results[v].values[day_before_scens])
+            sc.saveobj(heatmap_file, d)
     sc.toc(T)
 
 
@@ -0,0 +1,156 @@
+'''
+Run the tasks of a sweep so that it can be stopped and restarted without losing work.
+
+Each task is identified by a string (e.g. '12_3' for draw 12, seed 3). Whenever a task
+finishes or fails, a line is appended to a manifest in the sweep folder; on restart,
+finished tasks are skipped, and failed ones are retried until they have used up their
+attempts. Tasks are expected to save their own output (e.g. to a result_sink), since
+their return values are discarded rather than sent back to the parent.
+
+**Example**::
+
+    tasks = {f'{draw}_{seed}':dict(seed=seed, **pars[draw]) for draw in range(n_draws) for seed in range(n_seeds)}
+    run_sweep(run_scen, tasks, folder='results/sweep', flush=save_heatmap, flush_every=100)
+'''
+
+import os
+import json
+import traceback
+import multiprocessing as mp
+import concurrent.futures as cf
+from concurrent.futures.process import BrokenProcessPool
+import sciris as sc
+
+
+manifest_file = 'manifest.jsonl'
+
+
+class manifest(sc.prettyobj):
+    ''' Append-only record of which tasks have finished, and how often each has failed '''
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.filename = os.path.join(folder, manifest_file)
+        self.done     = set()
+        self.attempts = {}
+        self.errors   = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        self._update(json.loads(line))
+                    except ValueError: # E.g. a line left half written by a crash
+                        continue
+        return
+
+    def _update(self, entry):
+        task = entry['task']
+        if entry['status'] == 'done':
+            self.done.add(task)
+        else:
+            self.attempts[task] = self.attempts.get(task, 0) + 1
+            self.errors[task] = entry.get('error')
+        return
+
+    def record(self, task, status, error=None):
+        ''' Append the outcome of a task, making sure it has reached the disk before continuing '''
+        entry = dict(task=task, status=status, time=str(sc.now()), error=error)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._update(entry)
+        return
+
+
+def _run_task(func, task_kwargs, kwargs):
+    ''' Run a single task in a worker, discarding its output '''
+    func(**task_kwargs, **kwargs)
+    return
+
+
+def run_sweep(func, tasks, folder, kwargs=None, max_attempts=3, n_cpus=None, flush=None, flush_every=100):
+    '''
+    Run func(**task_kwargs, **kwargs) for each task that has not already finished.
+
+    At most n_cpus tasks are in flight at once, so if a worker dies (e.g. out of memory),
+    only the tasks it could have been running are charged an attempt.
+
+    Args:
+        func         (func): the function to run; must be importable by the workers, and save its own output
+        tasks        (dict): keyword arguments for each task, keyed by task ID
+        folder       (str):  where to keep the manifest
+        kwargs       (dict): keyword arguments passed to every task
+        max_attempts (int):  how many times to try a task before giving up on it
+        n_cpus       (int):  number of worker processes (default: all available; 1 to run in this process)
+        flush        (func): called with no arguments every flush_every finished tasks, and at the end, e.g. to save partial aggregates
+        flush_every  (int):  how often to call flush
+
+    Returns:
+        The manifest, with the finished tasks in manifest.done and the last error for each failed task in manifest.errors
+    '''
+    tasks  = {str(k):v for k,v in tasks.items()}
+    kwargs = sc.mergedicts(kwargs)
+    man = manifest(folder)
+    if n_cpus is None:
+        n_cpus = sc.cpu_count()
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+
+    def remaining():
+        return [t for t in tasks if t not in man.done and man.attempts.get(t, 0) < max_attempts]
+
+    pending = remaining()
+    print(f'Running {len(pending)} of {len(tasks)} tasks ({len(man.done & set(tasks))} already finished)')
+    n_finished = 0
+
+    def finished(task, error=None):
+        nonlocal n_finished
+        if error is None:
+            man.record(task, 'done')
+        else:
+            print(f'WARNING, task {task} failed (attempt {man.attempts.get(task, 0)+1} of {max_attempts}): {error.splitlines()[-1]}')
+            man.record(task, 'failed', error=error)
+        n_finished += 1
+        if flush is not None and n_finished % flush_every == 0:
+            flush()
+        return
+
+    while pending:
+        if n_cpus <= 1:
+            for task in pending:
+                try:
+                    _run_task(func, tasks[task], kwargs)
+                    finished(task)
+                except Exception:
+                    finished(task, traceback.format_exc())
+        else:
+            queue = list(pending)
+            in_flight = {}
+            try:
+                with cf.ProcessPoolExecutor(max_workers=n_cpus, mp_context=ctx) as pool:
+                    while queue or in_flight:
+                        while queue and len(in_flight) < n_cpus:
+                            task = queue.pop(0)
+                            in_flight[pool.submit(_run_task, func, tasks[task], kwargs)] = task
+                        done, _ = cf.wait(in_flight, return_when=cf.FIRST_COMPLETED)
+                        broken = None
+                        for future in done: # Record every task that finished before raising for any that died
+                            error = future.exception()
+                            if isinstance(error, BrokenProcessPool):
+                                broken = error # Its task is handled below, with the other tasks that were running
+                                continue
+                            task = in_flight.pop(future)
+                            finished(task, None if error is None else ''.join(traceback.format_exception(error)))
+                        if broken is not None:
+                            raise broken
+            except BrokenProcessPool:
+                for task in in_flight.values():
+                    finished(task, 'Worker process died, e.g. from running out of memory')
+        pending = remaining()
+
+    if flush is not None:
+        flush()
+    failed = [t for t in tasks if t not in man.done]
+    if failed:
+        print(f'WARNING, {len(failed)} tasks failed {max_attempts} times and were given up on: {failed[:10]}{"..." if len(failed)>10 else ""}')
+    return man
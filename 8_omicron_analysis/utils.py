@@ -0,0 +1,227 @@
+import hashlib
+import covasim as cv
+import sciris as sc
+import numpy as np
+import pandas as pd
+from covasim import defaults as cvd
+from covasim import utils as cvu
+
+
+class age_subtargets(sc.prettyobj):
+    '''
+    Cached subtargets for vaccinating people by age band
+
+    Ages are sorted once per population so that each band is found with a binary search,
+    the people in each band who refuse vaccination are drawn once, and the resulting
+    {'inds', 'vals'} arrays are reused on every call until the population changes.
+
+    **Example**::
+
+        subtargets = age_subtargets()
+        vx = cv.vaccinate_prob(vaccine='pfizer', days=days, subtarget=subtargets.band(60, 75, prob=0.02, uptake=0.95))
+    '''
+
+    def __init__(self):
+        self.ages        = None # The age array of the population the cache was built for
+        self.pop_hash    = None # Hash of the ages, to recognise copies of the same population
+        self.seed        = None # The seed the refusers were drawn with
+        self.order       = None # Indices of people sorted by age
+        self.sorted_ages = None
+        self.cache       = {}
+        return
+
+    def band(self, start_age, end_age, prob, uptake=1.0):
+        ''' Create a subtarget for people aged start_age <= age < end_age, of whom only uptake will accept vaccination '''
+        return age_band(self, start_age, end_age, prob, uptake)
+
+    def check(self, sim):
+        '''
+        Rebuild the sorted ages if the population has changed, and clear the cached bands if
+        the population or the seed has changed (the refusers are drawn with the sim's random
+        numbers, so each seed has its own)
+        '''
+        ages = sim.people.age
+        if ages is not self.ages: # Only hash the ages when given a different array, e.g. from a copied sim
+            pop_hash = hashlib.md5(np.ascontiguousarray(ages).tobytes()).hexdigest()
+            if pop_hash != self.pop_hash:
+                self.order       = np.argsort(ages, kind='stable')
+                self.sorted_ages = ages[self.order]
+                self.cache       = {}
+                self.pop_hash    = pop_hash
+            self.ages = ages
+        if sim['rand_seed'] != self.seed:
+            self.cache = {}
+            self.seed  = sim['rand_seed']
+        return
+
+    def get(self, sim, start_age, end_age, prob, uptake=1.0):
+        ''' Return the cached subtarget for this band, computing it on first use '''
+        self.check(sim)
+        key = (start_age, end_age, prob, uptake)
+        if key not in self.cache:
+            start, end = np.searchsorted(self.sorted_ages, [start_age, end_age])
+            inds = np.sort(self.order[start:end])
+            if uptake < 1:
+                refusers = cvu.binomial_filter(1 - uptake, inds)
+                inds = np.setdiff1d(inds, refusers, assume_unique=True)
+            vals = np.full(len(inds), prob, dtype=cvd.default_float)
+            inds.flags.writeable = False # Shared across calls, so guard against accidental changes
+            vals.flags.writeable = False
+            self.cache[key] = {'inds': inds, 'vals': vals}
+        return self.cache[key]
+
+
+class policy_timeline(cv.Intervention):
+    '''
+    Change the beta of each layer on the dates in a beta_dict of [h, s, w, c] multipliers
+
+    Equivalent to one cv.change_beta per layer, but the whole timeline is compiled into an
+    (npts, n_layers) array of multipliers when the sim is initialized, so each step is a
+    single lookup. Later dicts override earlier ones on the same date, as with sc.mergedicts().
+    As with change_beta, the dates are sorted but the changes are applied in the order they
+    are listed, so list the dates of each dict in order.
+
+    Args:
+        beta_dicts (dict): one or more dicts of date: [multiplier for each layer]
+        layers     (list): the layers the multipliers apply to
+        kwargs     (dict): passed to Intervention()
+
+    **Example**::
+
+        timeline = policy_timeline(beta_past, layers=['h', 's', 'w', 'c'])
+        scen_timeline = timeline.merge(beta_scens) # Same as policy_timeline(sc.mergedicts(beta_past, beta_scens))
+    '''
+
+    def __init__(self, *beta_dicts, layers=None, **kwargs):
+        super().__init__(**kwargs) # Initialize the Intervention object
+        self.layers = sc.promotetolist(layers) if layers is not None else ['h', 's', 'w', 'c']
+        self.beta_dict = sc.odict()
+        for beta_dict in beta_dicts:
+            for date,changes in beta_dict.items():
+                if len(changes) != len(self.layers):
+                    errormsg = f'Beta changes on {date} have {len(changes)} values, but there are {len(self.layers)} layers ({self.layers})'
+                    raise ValueError(errormsg)
+                self.beta_dict[date] = list(changes)
+        self.multipliers = None # Multiplier for each day and layer; set on initialization
+        self.change_days = None # Whether the betas change on each day
+        return
+
+    def merge(self, *beta_dicts):
+        ''' Return a new timeline with these dicts overriding this one's '''
+        return policy_timeline(self.beta_dict, *beta_dicts, layers=self.layers, label=self.label)
+
+    def initialize(self, sim):
+        ''' Compile the timeline into an array of multipliers for each day, and store the original betas '''
+        super().initialize()
+        self.orig_betas = np.array([sim['beta_layer'][lkey] for lkey in self.layers])
+        days = np.array([sim.day(date) for date in self.beta_dict.keys()], dtype=int)
+        changes = np.array(self.beta_dict.values(), dtype=float).reshape(-1, len(self.layers))
+        self.multipliers = np.ones((sim.npts, len(self.layers)))
+        self.change_days = np.zeros(sim.npts, dtype=bool)
+        for day,change in zip(np.sort(days), changes): # As change_beta pairs them
+            if 0 <= day < sim.npts:
+                self.multipliers[day:] = change
+                self.change_days[day] = True
+        self.days = cvu.true(self.change_days) # For plotting
+        return
+
+    def apply(self, sim):
+        ''' Set the betas on the days they change, as change_beta does '''
+        if self.change_days[sim.t]:
+            for l,lkey in enumerate(self.layers):
+                sim['beta_layer'][lkey] = self.orig_betas[l]*self.multipliers[sim.t,l]
+        return
+
+
+class test_schedule(cv.test_prob):
+    '''
+    Test people with probabilities that change on the dates in a table, optionally changing iso_factor too
+
+    Equivalent to a chain of back-to-back cv.test_prob interventions plus one cv.dynamic_pars
+    for iso_factor per change, but the table is compiled into daily arrays when the sim is
+    initialized, so there is a single testing pass each day. Each row applies from its
+    date until the date of the next row.
+
+    Args:
+        table   (dict/DataFrame): for each date, a dict of symp_prob, asymp_prob and optionally iso_factor (a number for all layers, or a dict by layer; None for no change)
+        end_day (int/str):        the last day of testing (default: no end)
+        kwargs  (dict):           passed to cv.test_prob(), e.g. symp_quar_prob and test_delay
+
+    **Example**::
+
+        testing = test_schedule({
+            '2020-03-16': dict(symp_prob=0.009, asymp_prob=0.0),
+            '2020-04-01': dict(symp_prob=0.012, asymp_prob=0.0, iso_factor=0.2),
+        }, symp_quar_prob=0.0, test_delay=1.0)
+        testing = test_schedule.from_csv('testing.csv', symp_quar_prob=0.0, test_delay=1.0)
+    '''
+
+    def __init__(self, table, end_day=None, **kwargs):
+        if isinstance(table, pd.DataFrame):
+            table = {row.pop('date'):row for row in table.to_dict('records')}
+        self.table = {} # Not an odict, since the dates may be given as integer days
+        for date,row in table.items():
+            iso_factor = row.get('iso_factor')
+            if iso_factor is not None and not isinstance(iso_factor, dict) and np.isnan(iso_factor): # Blank in a CSV
+                iso_factor = None
+            self.table[date] = dict(symp_prob=row['symp_prob'], asymp_prob=row['asymp_prob'], iso_factor=iso_factor)
+        if not len(self.table):
+            errormsg = 'The testing schedule must have at least one row'
+            raise ValueError(errormsg)
+        first_date, first = next(iter(self.table.items()))
+        super().__init__(symp_prob=first['symp_prob'], asymp_prob=first['asymp_prob'], start_day=first_date, end_day=end_day, **kwargs)
+        self.follow_symp  = kwargs.get('symp_quar_prob') is None # As in test_prob, quarantined people test at the same rate as everyone else unless specified
+        self.follow_asymp = kwargs.get('asymp_quar_prob') is None
+        return
+
+    @classmethod
+    def from_csv(cls, filename, **kwargs):
+        ''' Load the table from a CSV file with columns date, symp_prob, asymp_prob and (optionally) iso_factor '''
+        return cls(pd.read_csv(filename), **kwargs)
+
+    def initialize(self, sim):
+        ''' Compile the table into daily testing probabilities and iso_factor changes '''
+        days = np.array([sim.day(date) for date in self.table.keys()], dtype=int)
+        order = np.argsort(days, kind='stable')
+        self.start_day = days[order[0]] # In case the first row given is not the earliest
+        super().initialize(sim)
+        self.symp_probs  = np.full(sim.npts, np.nan)
+        self.asymp_probs = np.full(sim.npts, np.nan)
+        self.iso_changes = {}
+        rows = list(self.table.values())
+        for i in order:
+            day, row = days[i], rows[i]
+            if day < sim.npts:
+                self.symp_probs[day:]  = row['symp_prob']
+                self.asymp_probs[day:] = row['asymp_prob']
+                if row['iso_factor'] is not None:
+                    iso_factor = row['iso_factor']
+                    self.iso_changes[day] = iso_factor if isinstance(iso_factor, dict) else {k:iso_factor for k in sim['iso_factor'].keys()}
+        return
+
+    def apply(self, sim):
+        ''' Change iso_factor if needed, then test with today's probabilities '''
+        t = sim.t
+        if t in self.iso_changes:
+            sim['iso_factor'].update(self.iso_changes[t])
+        if not np.isnan(self.symp_probs[t]):
+            self.symp_prob  = self.symp_probs[t]
+            self.asymp_prob = self.asymp_probs[t]
+            if self.follow_symp:  self.symp_quar_prob  = self.symp_prob
+            if self.follow_asymp: self.asymp_quar_prob = self.asymp_prob
+        return super().apply(sim)
+
+
+class age_band(sc.prettyobj):
+    ''' A single age band of an age_subtargets provider; call with the sim to get the subtarget dict '''
+
+    def __init__(self, provider, start_age, end_age, prob, uptake=1.0):
+        self.provider  = provider
+        self.start_age = start_age
+        self.end_age   = end_age
+        self.prob      = prob
+        self.uptake    = uptake
+        return
+
+    def __call__(self, sim):
+        return self.provider.get(sim, self.start_age, self.end_age, self.prob, self.uptake)
@@ -0,0 +1,101 @@
+import os
+import sys
+import numpy as np
+import covasim as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '8_omicron_analysis'))
+import archive as ar
+
+
+def make_msim(n_runs=4):
+    ''' A small multisim with a second variant, so there are variant results too '''
+    sim = cv.Sim(pop_size=2000, n_days=70, start_day='2021-01-01', verbose=0,
+                 variants=cv.variant('delta', days=10, n_imports=20))
+    msim = cv.MultiSim(sim, n_runs=n_runs)
+    msim.run()
+    return msim
+
+
+def result_keys(sim):
+    return sim.result_keys('main'), sim.result_keys('variant')
+
+
+msim = make_msim()
+
+
+def test_sims(tmp_path):
+    ''' Each sim's results, label and seed come back unchanged '''
+    filename = ar.save_archive(str(tmp_path/'uk_sim.cvar'), msim, chunk_len=16)
+    lazy = ar.lazy_msim(filename)
+    assert len(lazy) == len(msim.sims)
+    mainkeys, variantkeys = result_keys(msim.sims[0])
+    for sim,lsim in zip(msim.sims, lazy.sims):
+        assert lsim.label == sim.label
+        assert lsim['rand_seed'] == sim['rand_seed']
+        assert lsim.npts == sim.npts
+        for key in mainkeys:
+            np.testing.assert_array_equal(lsim.results[key].values, sim.results[key].values)
+        for key in variantkeys:
+            np.testing.assert_array_equal(lsim.results['variant'][key].values, sim.results['variant'][key].values)
+    lazy.close()
+
+
+def test_reduced(tmp_path):
+    ''' The saved reduced results, and those reduced from the archive, match msim.reduce() '''
+    quantiles = [0.1, 0.9]
+    msim.reduce(quantiles=quantiles)
+    for compression in ['zlib', None]:
+        filename = ar.save_archive(str(tmp_path/f'uk_sim_{compression}.cvar'), msim, compression=compression, chunk_len=16)
+        saved = ar.lazy_msim(filename)
+        recomputed = ar.lazy_msim(filename)
+        recomputed.reduce(quantiles=quantiles)
+        mainkeys, variantkeys = result_keys(msim.sims[0])
+        for lazy in [saved, recomputed]:
+            for key in mainkeys:
+                for attr in ['values', 'low', 'high']:
+                    np.testing.assert_allclose(getattr(lazy.results[key], attr), getattr(msim.results[key], attr), rtol=1e-12)
+            for key in variantkeys:
+                for attr in ['values', 'low', 'high']:
+                    np.testing.assert_allclose(getattr(lazy.results['variant'][key], attr), getattr(msim.results['variant'][key], attr), rtol=1e-12)
+            lazy.close()
+
+    msim.reduce(use_mean=True, bounds=1.5)
+    lazy = ar.lazy_msim(ar.save_archive(str(tmp_path/'uk_sim_mean.cvar'), msim))
+    lazy.reduce(use_mean=True, bounds=1.5)
+    for attr in ['values', 'low', 'high']:
+        np.testing.assert_allclose(getattr(lazy.results['new_infections'], attr), getattr(msim.results['new_infections'], attr), rtol=1e-12)
+    lazy.close()
+
+
+def test_slicing(tmp_path):
+    ''' Indexing an archived array gives the same as indexing the full array, across chunk boundaries '''
+    stacked = np.array([sim.results['new_infections'].values for sim in msim.sims])
+    vstacked = np.array([sim.results['variant']['new_infections_by_variant'].values for sim in msim.sims])
+    for compression in ['zlib', None]:
+        filename = ar.save_archive(str(tmp_path/f'slices_{compression}.cvar'), msim, compression=compression, chunk_len=16)
+        with ar.result_archive(filename) as arch:
+            arr = arch['sims/new_infections']
+            varr = arch['sims/variant/new_infections_by_variant']
+            assert arr.shape == stacked.shape
+            assert varr.shape == vstacked.shape
+            for key in [np.s_[...], np.s_[:, 10:40], np.s_[1, 15:17], np.s_[:, 33], np.s_[2], np.s_[1:3, ::7], np.s_[:, -5:], np.s_[:, [3, 40, 16]], np.s_[:, np.array([50, 2])], np.s_[:, 20:20]]:
+                np.testing.assert_array_equal(arr[key], stacked[key])
+            for key in [np.s_[:, 1, 10:40], np.s_[0, :, 31:33], np.s_[..., 5]]:
+                np.testing.assert_array_equal(varr[key], vstacked[key])
+            inds = arch.day(['2021-01-10', '2021-02-20'])
+            np.testing.assert_array_equal(arr[:, inds[0]:inds[1]], stacked[:, 9:50])
+
+
+def test_obj(tmp_path):
+    ''' A pickled multisim is converted on first use, and the archive is used alone if the pickle is gone '''
+    msim.reduce()
+    objfile = str(tmp_path/'uk_sim.obj')
+    msim.save(objfile)
+    lazy = ar.lazy_msim(objfile)
+    assert os.path.isfile(str(tmp_path/'uk_sim.cvar'))
+    np.testing.assert_allclose(lazy.results['cum_deaths'].high, msim.results['cum_deaths'].high, rtol=1e-12)
+    lazy.close()
+    os.remove(objfile)
+    lazy = ar.lazy_msim(objfile)
+    np.testing.assert_array_equal(lazy.sims[2].results['new_diagnoses'].values, msim.sims[2].results['new_diagnoses'].values)
+    lazy.close()
@@ -0,0 +1,103 @@
+import os
+import sys
+import numpy as np
+import covasim as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '8_omicron_analysis'))
+import reducers as rd
+
+
+def make_msim(n_runs=4):
+    ''' A small multisim with a second variant, so there are variant results too '''
+    sim = cv.Sim(pop_size=2000, n_days=50, verbose=0, variants=cv.variant('delta', days=10, n_imports=20))
+    msim = cv.MultiSim(sim, n_runs=n_runs)
+    msim.run()
+    return msim
+
+
+def compare_results(results, msim, exact=True):
+    ''' Check reduced results against msim.results after msim.reduce() '''
+    check = np.testing.assert_array_equal if exact else lambda u,v: np.testing.assert_allclose(u, v, rtol=1e-10, atol=1e-10)
+    base = msim.sims[0]
+    for key in base.result_keys('main'):
+        for attr in ['values', 'low', 'high']:
+            check(getattr(results[key], attr), getattr(msim.results[key], attr))
+    for key in base.result_keys('variant'):
+        for attr in ['values', 'low', 'high']:
+            check(getattr(results['variant'][key], attr), getattr(msim.results['variant'][key], attr))
+
+
+def rank_errors(sketch, values, quantiles):
+    ''' How far the rank of each estimated quantile is from the quantile, for each element '''
+    errors = []
+    for q in quantiles:
+        est = sketch.quantile(q)
+        lower = (values < est).mean(axis=0) # The estimate lies between these ranks
+        upper = (values <= est).mean(axis=0)
+        errors.append(np.maximum(0, np.maximum(lower - q, q - upper)))
+    return np.array(errors)
+
+
+msim = make_msim()
+quantiles = [0.1, 0.9]
+
+
+def test_exact():
+    ''' With up to k sims, the reducer gives the same results as MultiSim.reduce() '''
+    msim.reduce(quantiles=quantiles)
+    reducer = rd.reduce_sims(msim, quantiles=quantiles, k=len(msim.sims))
+    assert all(sketch.exact for sketch in reducer.sketches.values())
+    compare_results(reducer.results(), msim)
+
+    msim.reduce(use_mean=True, bounds=1.5)
+    reducer = rd.reduce_sims(msim, use_mean=True, bounds=1.5)
+    compare_results(reducer.results(), msim, exact=False)
+
+
+def test_rank_error():
+    ''' With more than k values, each quantile is within the rank error bound '''
+    rng = np.random.default_rng(1)
+    k, n = 50, 3000
+    values = np.concatenate([rng.lognormal(size=(n, 3)), rng.poisson(4, size=(n, 2))], axis=1) # With and without ties
+    sketch = rd.quantile_sketch(k=k)
+    for row in values:
+        sketch.add(row)
+    assert sketch.n == n and not sketch.exact
+    assert sum(len(arr) for level in sketch.levels for arr in level) < 4*k*np.log2(n/k) # Memory grows with log(n), not n
+    errors = rank_errors(sketch, values, [0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95])
+    assert errors.max() <= np.log2(n/k)/k, errors.max()
+
+
+def test_merge():
+    ''' Reducers merged from several workers give the same results as one reducer over all the sims '''
+    msim.reduce(quantiles=quantiles)
+    parts = [rd.reduce_sims(msim.sims[i::2], quantiles=quantiles) for i in range(2)]
+    merged = rd.merge_reducers(parts)
+    assert merged.n_sims == len(msim.sims)
+    compare_results(merged.results(), msim)
+
+    # Beyond k, the means and variances are still exact, and the quantiles within the bound
+    rng = np.random.default_rng(2)
+    k, n = 40, 2000
+    values = rng.normal(size=(n, 4))
+    single = rd.quantile_sketch(k=k)
+    stats = rd.stream_stats()
+    sketches = [rd.quantile_sketch(k=k) for _ in range(4)]
+    all_stats = [rd.stream_stats() for _ in range(4)]
+    for i,row in enumerate(values):
+        single.add(row)
+        stats.add(row)
+        sketches[i % 4].add(row)
+        all_stats[i % 4].add(row)
+    merged = sketches[0]
+    merged_stats = all_stats[0]
+    for sketch,part_stats in zip(sketches[1:], all_stats[1:]):
+        merged.merge(sketch)
+        merged_stats.merge(part_stats)
+    assert merged.n == single.n == n
+    np.testing.assert_allclose(merged_stats.mean, stats.mean, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(merged_stats.std, values.std(axis=0), rtol=1e-10)
+    bound = np.log2(n/k)/k
+    qs = [0.1, 0.5, 0.9]
+    assert rank_errors(merged, values, qs).max() <= bound
+    assert rank_errors(single, values, qs).max() <= bound